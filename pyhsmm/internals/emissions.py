@@ -0,0 +1,142 @@
+from __future__ import division
+import numpy as np
+from scipy.linalg import solve_triangular
+import collections
+
+from pyhsmm.basic.distributions import Gaussian, DiagonalGaussian
+
+# NOTE: these compute the log likelihoods (or the mean field expected log
+# likelihoods) of a data sequence under all the states at once. the states
+# whose observation distributions are Gaussian or DiagonalGaussian are stacked,
+# so a few matrix products over the sequence replace a factorization and a data
+# pass per state; the other states are computed one at a time as before.
+#
+# the per-state factors are cached on the distribution objects, along with
+# copies of the parameters they were computed from, and recomputed when the
+# parameter values change, whether the arrays were replaced (as resampling and
+# the mean field updates do) or modified in place. so the Cholesky factors are
+# computed here, since the distributions' own sigma_chol caches only notice
+# replaced arrays.
+
+# a full covariance state's value at x is const - scale/2 * ||Linv (x - mu)||^2
+_Full = collections.namedtuple('_Full',['Linv','Linv_mu','scale','const','bad'])
+
+# a diagonal covariance state's value at x is x**2 . a + x . b + const
+_Diag = collections.namedtuple('_Diag',['a','b','const','bad'])
+
+# bad holds the value for time steps with missing data, matching what the
+# distribution's own method gives (nans are zeroed by the states classes)
+
+_CHUNKSIZE = 2**20 # number of elements in the temporaries for a block of steps
+
+def log_likelihoods(obs_distns,data,out):
+    return _fill(obs_distns,data,out,_gibbs_factors,'log_likelihood')
+
+def expected_log_likelihoods(obs_distns,data,out):
+    return _fill(obs_distns,data,out,_mf_factors,'expected_log_likelihood')
+
+### filling in the columns
+
+def _fill(obs_distns,data,out,get_factors,method):
+    factors = [get_factors(o) for o in obs_distns]
+    full = [idx for idx, f in enumerate(factors) if isinstance(f,_Full)]
+    diag = [idx for idx, f in enumerate(factors) if isinstance(f,_Diag)]
+
+    if full or diag:
+        f = factors[(full + diag)[0]]
+        D = f.Linv.shape[0] if isinstance(f,_Full) else f.a.shape[0]
+        x = np.reshape(data,(-1,D))
+        bads = np.isnan(x).any(1)
+        if bads.any():
+            x = np.nan_to_num(x)
+
+        if full:
+            _fill_full(x,[factors[idx] for idx in full],out,full)
+        if diag:
+            _fill_diag(x,[factors[idx] for idx in diag],out,diag)
+
+        if bads.any():
+            idx = full + diag
+            out[np.ix_(bads,idx)] = [factors[i].bad for i in idx]
+
+    for idx, (o, f) in enumerate(zip(obs_distns,factors)):
+        if f is None:
+            out[:,idx] = getattr(o,method)(data).ravel()
+
+    return out
+
+def _fill_full(x,factors,out,idx):
+    T, D = x.shape
+    K = len(factors)
+    W = np.vstack([f.Linv for f in factors]).T
+    W_mu = np.concatenate([f.Linv_mu for f in factors])
+    scales = np.array([f.scale for f in factors])
+    consts = np.array([f.const for f in factors])
+
+    step = max(1,_CHUNKSIZE // (K*D))
+    for start in xrange(0,T,step):
+        z = x[start:start+step].dot(W)
+        z -= W_mu
+        z *= z
+        out[start:start+step,idx] = consts - scales/2. * z.reshape((-1,K,D)).sum(2)
+
+def _fill_diag(x,factors,out,idx):
+    a = np.array([f.a for f in factors]).T
+    b = np.array([f.b for f in factors]).T
+    consts = np.array([f.const for f in factors])
+    out[:,idx] = (x**2).dot(a) + x.dot(b) + consts
+
+### per-state factors
+
+def _func(method):
+    return getattr(method,'im_func',method)
+
+def _cached(o,attr,params,make):
+    cached = getattr(o,attr,None)
+    if cached is None or not all(np.array_equal(a,b) for a, b in zip(cached[0],params)):
+        cached = ([np.copy(p) for p in params],make(o))
+        setattr(o,attr,cached)
+    return cached[1]
+
+def _gibbs_factors(o):
+    method = _func(type(o).log_likelihood)
+    if method is _func(Gaussian.log_likelihood):
+        return _cached(o,'_batched_factors',(o.mu,o.sigma),_full_gibbs)
+    elif method is _func(DiagonalGaussian.log_likelihood):
+        return _cached(o,'_batched_factors',(o.mu,o.sigmas),_diag_gibbs)
+    return None
+
+def _mf_factors(o):
+    method = _func(type(o).expected_log_likelihood)
+    if method is _func(Gaussian.expected_log_likelihood):
+        return _cached(o,'_batched_mf_factors',
+                (o.mu_mf,o.sigma_mf,o.kappa_mf,o.nu_mf),_full_mf)
+    elif method is _func(DiagonalGaussian.expected_log_likelihood):
+        return _cached(o,'_batched_mf_factors',
+                (o.mf_mu,o.mf_nus,o.mf_alphas,o.mf_betas),_diag_mf)
+    return None
+
+def _full_gibbs(o):
+    try:
+        L = np.linalg.cholesky(o.sigma)
+    except np.linalg.LinAlgError:
+        return None # degenerate, the distribution handles it
+    D = L.shape[0]
+    Linv = solve_triangular(L,np.eye(D),lower=True)
+    return _Full(Linv,Linv.dot(o.mu),1.,
+            -D/2.*np.log(2*np.pi) - np.log(L.diagonal()).sum(),0.)
+
+def _full_mf(o):
+    L = np.linalg.cholesky(o.sigma_mf)
+    D = L.shape[0]
+    Linv = solve_triangular(L,np.eye(D),lower=True)
+    return _Full(Linv,Linv.dot(o.mu_mf),o.nu_mf,
+            o._loglmbdatilde()/2. - D/(2.*o.kappa_mf) - D/2.*np.log(2*np.pi),np.nan)
+
+def _diag_gibbs(o):
+    Js = -1./(2*o.sigmas)
+    return _Diag(Js,-2*o.mu*Js,(o.mu**2*Js - 1./2*np.log(2*np.pi*o.sigmas)).sum(),np.nan)
+
+def _diag_mf(o):
+    a, b, c, d = o._expected_statistics(o.mf_alphas,o.mf_betas,o.mf_mu,o.mf_nus)
+    return _Diag(a,b,c.sum() + d.sum() - len(o.mf_mu)/2.*np.log(2*np.pi),np.nan)
@@ -0,0 +1,74 @@
+from __future__ import division
+import numpy as np
+
+# NOTE: these flatten the parameters that an EM step sets into one vector and
+# back, for extrapolating along the EM trajectory (see accelerated_EM_fit in
+# pyhsmm.models). unpack projects an extrapolated vector back onto valid
+# parameters where that's cheap: negative probabilities are zeroed and the
+# vectors (the last axis) renormalized, and positive parameters and
+# probabilities are clipped. it refuses a vector that still gives invalid
+# parameters, like a covariance matrix that isn't positive definite.
+#
+# (extrapolating in log coordinates instead looks safer, but probabilities on
+# their way to zero move by a constant in log space every step, which makes the
+# steplengths blow up.)
+#
+# parameters with integer values (e.g. the r of a NegativeBinomialIntegerR)
+# aren't extrapolated, and keep whatever value the last EM step gave them.
+
+_simplex = ('weights','trans_matrix')
+_positive = ('sigmas','lmbda','r')
+_unit = ('p',)
+_covariance = ('sigma',)
+
+_TINY = 1e-300
+
+def parameters(pairs):
+    'the (object, attribute name) pairs in pairs that can be extrapolated'
+    out = []
+    for o, name in pairs:
+        value = getattr(o,name)
+        if value is not None and not np.issubdtype(np.asarray(value).dtype,np.integer):
+            out.append((o,name))
+    return out
+
+def pack(params):
+    return np.concatenate([np.asarray(getattr(o,name),dtype='float64').ravel()
+        for o, name in params])
+
+def unpack(params,vec):
+    'sets the parameters from vec and returns True, or returns False if invalid'
+    values, start = [], 0
+    for o, name in params:
+        shape = np.shape(getattr(o,name))
+        size = int(np.prod(shape))
+        value = _project(name,vec[start:start+size].reshape(shape))
+        if not _valid(name,value):
+            return False
+        values.append(value)
+        start += size
+
+    for (o, name), value in zip(params,values):
+        setattr(o,name,value if np.ndim(value) > 0 else float(value))
+    return True
+
+def _project(name,x):
+    if name in _simplex:
+        out = np.maximum(x,0.)
+        return out / out.sum(-1)[...,None]
+    elif name in _positive:
+        return np.maximum(x,_TINY)
+    elif name in _unit:
+        return np.clip(x,_TINY,1.)
+    return x
+
+def _valid(name,value):
+    if not np.all(np.isfinite(value)):
+        return False
+    if name in _covariance:
+        try:
+            np.linalg.cholesky(value)
+        except np.linalg.LinAlgError:
+            return False
+        return np.allclose(value,value.T)
+    return True
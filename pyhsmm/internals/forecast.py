@@ -0,0 +1,73 @@
+from __future__ import division
+import numpy as np
+from scipy import sparse
+
+# NOTE: this computes predictive likelihoods for many forecast horizons at once.
+# the powers of the transition matrix for all the horizons are computed once,
+# each from the previous one, and stacked side by side, so a single matrix
+# product per block of time steps gives the predictive state distributions for
+# every horizon. the time steps are processed in blocks to bound the size of
+# the temporaries, and the blocks can be split over threads (see
+# pyhsmm.parallel.map_shards), since each block only reads the shared arrays
+# and writes its own slice of the outputs.
+
+_CHUNKSIZE = 2**20 # number of elements in the temporaries for a block of steps
+
+def predictive_likelihoods(alphal,trans_matrix,aBl,forecast_horizons,num_threads=0):
+    '''
+    For each k in forecast_horizons, returns an array of the log predictive
+    likelihoods log p(y[t+k] | y[:t+1]) for t = 0, ..., T-k-1, given the log
+    forward messages alphal and the observation log likelihoods aBl.
+    '''
+    T, N = aBl.shape
+    horizons = np.asarray(forecast_horizons,dtype=np.int64)
+    assert np.all(horizons > 0)
+    powers = _stacked_powers(trans_matrix,horizons)
+    outs = [np.empty(max(T-k,0)) for k in horizons]
+
+    step = max(1,_CHUNKSIZE // (len(horizons)*N))
+    def fill(starts):
+        for start in starts:
+            _fill(alphal,aBl,powers,horizons,outs,start,min(start+step,T))
+
+    starts = range(0,T,step)
+    if num_threads > 0:
+        from pyhsmm import parallel
+        parallel.map_shards(fill,starts,num_threads)
+    else:
+        fill(starts)
+
+    return outs
+
+def _stacked_powers(A,horizons):
+    # out[:,h*N:(h+1)*N] is A**horizons[h]
+    A = A.toarray() if sparse.issparse(A) else np.asarray(A)
+    N = A.shape[0]
+    out = np.empty((N,len(horizons),N))
+    power, prev_k = np.eye(N), 0
+    for h in np.argsort(horizons):
+        k = horizons[h]
+        power = power.dot(np.linalg.matrix_power(A,k-prev_k))
+        out[:,h] = power
+        prev_k = k
+    return out.reshape((N,-1))
+
+def _fill(alphal,aBl,powers,horizons,outs,start,stop):
+    T, N = aBl.shape
+    H = len(horizons)
+
+    alphan = np.exp(alphal[start:stop] - alphal[start:stop].max(1)[:,None])
+    alphan /= alphan.sum(1)[:,None]
+    predictions = alphan.dot(powers).reshape((-1,H,N))
+
+    targets = np.arange(start,stop)[:,None] + horizons
+    valid = targets < T
+    B = aBl[np.minimum(targets,T-1)]
+    cmaxes = B.max(2)
+    cmaxes[~np.isfinite(cmaxes)] = 0.
+    with np.errstate(divide='ignore'):
+        likes = np.log((predictions * np.exp(B - cmaxes[...,None])).sum(2)) + cmaxes
+
+    for h in range(H):
+        n = valid[:,h].sum() # the valid steps are a prefix of the block
+        outs[h][start:start+n] = likes[:n,h]
@@ -2,8 +2,9 @@
 #define HMM_MESSAGES_H
 
 #include <Eigen/Core>
-#include <stdint.h> // int32_t
+#include <stdint.h> // int32_t, uint8_t, uint16_t
 #include <limits> // infinity
+#include <algorithm> // min, max
 
 #include "nptypes.h"
 #include "util.h"
@@ -79,7 +80,7 @@ namespace hmm
     }
 
     template <typename Type>
-    Type expected_statistics_log(
+    double expected_statistics_log(
             int M, int T,
             Type *log_trans_potential, Type *log_likelihood_potential,
             Type *alphal, Type *betal,
@@ -99,26 +100,130 @@ namespace hmm
         Type pair_buf[M*M] __attribute__((aligned(16)));
         NPArray<Type> pair(pair_buf,M,M);
 #endif
+        // NOTE: the counts are summed over the whole sequence, so they're
+        // accumulated in double precision even when Type is float
+        Array<double,Dynamic,Dynamic> transcounts = Array<double,Dynamic,Dynamic>::Zero(M,M);
 
+        // NOTE: the normalizer is computed from the first time step and the
+        // last row of betal isn't assumed to be zero, so this also works on a
+        // block of a longer sequence given its (unscaled) messages
         Type cmax;
-        cmax = ealphal.row(T-1).maxCoeff();
-        Type log_normalizer = log((ealphal.row(T-1) - cmax).exp().sum()) + cmax;
+        cmax = (ealphal.row(0) + ebetal.row(0)).maxCoeff();
+        Type log_normalizer = log((ealphal.row(0) + ebetal.row(0) - cmax).exp().sum()) + cmax;
 
         for (int t=0; t<T-1; t++) {
             pair = eA - log_normalizer;
             pair.colwise() += ealphal.row(t).transpose().array();
             pair.rowwise() += ebetal.row(t+1) + eaBl.row(t+1);
 
-            eexpected_transcounts += pair.exp();
+            transcounts += pair.exp().template cast<double>();
             eexpected_states.row(t) += (ealphal.row(t) + ebetal.row(t) - log_normalizer).exp();
         }
-        eexpected_states.row(T-1) += (ealphal.row(T-1) - log_normalizer).exp();
+        eexpected_states.row(T-1) += (ealphal.row(T-1) + ebetal.row(T-1) - log_normalizer).exp();
+        eexpected_transcounts += transcounts.template cast<Type>();
 
         return log_normalizer;
     }
 
     template <typename Type>
-    Type messages_forwards_normalized(int M, int T, Type *A, Type *pi0, Type *aBl,
+    double expected_statistics_normalized(
+            int M, int T, Type *A, Type *pi0, Type *aBl,
+            Type *expected_states, Type *expected_transcounts)
+    {
+        // NOTE: this is forward-backward with normalized messages, so the only
+        // transcendentals are one exp per likelihood and one log per time step.
+        // the forward normalizers scale the backward messages too, so that
+        // alphan[t] * betan[t] is the marginal at time t, and the transition
+        // counts are the sum of the outer products of alphan[t] and
+        // likes[t+1] * betan[t+1] (times A), which is done as a matrix product
+        // over blocks of time steps. it returns nan if any normalizer is zero or
+        // a backward message isn't finite, so that callers can fall back to the
+        // log-domain version; otherwise it overwrites expected_states and
+        // expected_transcounts.
+        NPMatrix<Type> eA(A,M,M);
+        NPArray<Type> eaBl(aBl,T,M);
+
+        NPArray<Type> eexpected_states(expected_states,T,M);
+        NPArray<Type> eexpected_transcounts(expected_transcounts,M,M);
+
+        Matrix<Type,Dynamic,Dynamic,RowMajor> alphan(T,M), likes(T,M);
+        Matrix<Type,1,Dynamic> betan(M);
+        Array<double,Dynamic,Dynamic,RowMajor> transcounts(M,M);
+
+        double logtot = 0.;
+        Type cmax, norm;
+
+        for (int t=0; t<T; t++) {
+            cmax = eaBl.row(t).maxCoeff();
+            likes.row(t) = (eaBl.row(t) - cmax).exp().matrix();
+            if (t == 0) {
+                alphan.row(0) = (NPSubRowVectorArray<Type>(pi0,M)
+                        * likes.row(0).array()).matrix();
+            } else {
+                alphan.row(t).noalias() = alphan.row(t-1) * eA;
+                alphan.row(t).array() *= likes.row(t).array();
+            }
+            norm = alphan.row(t).sum();
+            if (unlikely(!(norm > 0) || !util::is_finite(norm))) {
+                return numeric_limits<double>::quiet_NaN();
+            }
+            alphan.row(t) /= norm;
+            likes.row(t) /= norm;
+            logtot += log(norm) + cmax;
+        }
+
+        // NOTE: likes[t] becomes likes[t] * betan[t] as the backward pass goes
+        eexpected_states.row(T-1) = alphan.row(T-1).array();
+        for (int t=T-2; t>=0; t--) {
+            betan.noalias() = likes.row(t+1) * eA.transpose();
+            if (unlikely(!util::is_finite(betan.maxCoeff()))) {
+                return numeric_limits<double>::quiet_NaN();
+            }
+            eexpected_states.row(t) = alphan.row(t).array() * betan.array();
+            eexpected_states.row(t) /= eexpected_states.row(t).sum();
+            likes.row(t).array() *= betan.array();
+        }
+
+        transcounts.setZero();
+        const int block = 256;
+        for (int t=0; t<T-1; t+=block) {
+            int n = min(block,T-1-t);
+            transcounts += (alphan.middleRows(t,n).transpose()
+                    * likes.middleRows(t+1,n)).array().template cast<double>();
+        }
+        eexpected_transcounts = eA.array() * transcounts.template cast<Type>();
+
+        return logtot;
+    }
+
+    template <typename Type>
+    double expected_statistics(
+            int M, int T, Type *A, Type *pi0, Type *aBl,
+            Type *expected_states, Type *expected_transcounts)
+    {
+        double log_normalizer = expected_statistics_normalized(M,T,A,pi0,aBl,
+                expected_states,expected_transcounts);
+        if (likely(log_normalizer == log_normalizer)) {
+            return log_normalizer;
+        }
+
+        // NOTE: the messages are temporaries here so that batched callers only
+        // need message buffers for the sequences currently being processed
+        Matrix<Type,Dynamic,Dynamic,RowMajor> alphal(T,M), betal(T,M), Al(M,M);
+
+        NPMatrix<Type>(expected_states,T,M).setZero();
+        NPMatrix<Type>(expected_transcounts,M,M).setZero();
+
+        Al = NPMatrix<Type>(A,M,M).array().log();
+        messages_forwards_log(M,T,A,pi0,aBl,alphal.data());
+        messages_backwards_log(M,T,A,aBl,betal.data());
+
+        return expected_statistics_log(M,T,Al.data(),aBl,alphal.data(),betal.data(),
+                expected_states,expected_transcounts);
+    }
+
+    template <typename Type>
+    double messages_forwards_normalized(int M, int T, Type *A, Type *pi0, Type *aBl,
             Type *alphan)
     {
         NPMatrix<Type> eA(A,M,M);
@@ -126,7 +231,7 @@ namespace hmm
 
         NPMatrix<Type> ealphan(alphan,T,M);
 
-        Type logtot = 0.;
+        double logtot = 0.;
         Type cmax, norm;
 
 #ifdef HMM_TEMPS_ON_HEAP
@@ -149,7 +254,7 @@ namespace hmm
 #ifndef HMM_NOT_ROBUST
             } else {
                 ealphan.block(t,0,T-t,M).setZero();
-                return -numeric_limits<Type>::infinity();
+                return -numeric_limits<double>::infinity();
             }
 #endif
             ein_potential = ealphan.row(t) * eA;
@@ -210,39 +315,489 @@ namespace hmm
 
     // Viterbi
 
-    // TODO use nptypes
-    template <typename FloatType, typename IntType>
-    void viterbi(int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl,
+    template <typename FloatType, typename IntType, typename BackType>
+    void viterbi_backpointers(int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl,
             IntType *stateseq)
     {
-        // inputs
-        Map<Matrix<FloatType,Dynamic,Dynamic>,Aligned> eA(A,M,M);
-        Map<Matrix<FloatType,Dynamic,Dynamic>,Aligned> eaBl(aBl,M,T);
-        Map<Array<FloatType,Dynamic,1>,Aligned> epi0(pi0,M);
-
-        // locals
-        MatrixXi args(M,T);
-        Matrix<FloatType,Dynamic,Dynamic> eAl(M,M);
-        eAl = eA.array().log();
-        Matrix<FloatType,Dynamic,1> scores(M);
-        Matrix<FloatType,Dynamic,1> prevscores(M);
-        Matrix<FloatType,Dynamic,1> tempvec(M);
-        int maxIndex;
-
-        // computation!
+        NPArray<FloatType> eA(A,M,M);
+        NPArray<FloatType> eaBl(aBl,T,M);
+
+        // NOTE: backpointers are stored in the narrowest integer type that can
+        // hold a state index, which is most of the memory for long sequences
+        Array<BackType,Dynamic,Dynamic,RowMajor> args(T,M);
+        Array<FloatType,Dynamic,Dynamic,RowMajor> eAlT(M,M);
+        Array<FloatType,1,Dynamic> scores(M), prevscores(M), nextscores(M);
+
+        eAlT = eA.transpose().log();
+
+        // NOTE: each step is a max over the columns of the log transition
+        // matrix, done one next state at a time so the inner loop runs over
+        // contiguous memory for all the current states at once
         scores.setZero();
         for (int t=T-2; t>=0; t--) {
+            BackType *targs = &args(t+1,0);
+            nextscores = scores + eaBl.row(t+1);
+
+            prevscores = eAlT.row(0) + nextscores(0);
+            for (int i=0; i<M; i++) { targs[i] = 0; }
+            for (int j=1; j<M; j++) {
+                FloatType nextscore = nextscores(j);
+                FloatType *col = &eAlT(j,0);
+                for (int i=0; i<M; i++) {
+                    FloatType val = col[i] + nextscore;
+                    if (val > prevscores(i)) {
+                        prevscores(i) = val;
+                        targs[i] = j;
+                    }
+                }
+            }
+
+            scores = prevscores;
+        }
+
+        int first;
+        (scores + NPSubRowVectorArray<FloatType>(pi0,M).log() + eaBl.row(0)).maxCoeff(&first);
+        stateseq[0] = first;
+        for (int t=1; t<T; t++) {
+            stateseq[t] = args(t,stateseq[t-1]);
+        }
+    }
+
+    template <typename FloatType, typename IntType>
+    void viterbi(int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl,
+            IntType *stateseq)
+    {
+        if (M <= 256) {
+            viterbi_backpointers<FloatType,IntType,uint8_t>(M,T,A,pi0,aBl,stateseq);
+        } else if (M <= 65536) {
+            viterbi_backpointers<FloatType,IntType,uint16_t>(M,T,A,pi0,aBl,stateseq);
+        } else {
+            viterbi_backpointers<FloatType,IntType,int32_t>(M,T,A,pi0,aBl,stateseq);
+        }
+    }
+
+    // Sparse and banded transition matrices
+
+    // NOTE: these wrap the arrays of a scipy.sparse csr_matrix or dia_matrix so
+    // that the kernels below can be written once for both formats. they
+    // provide x^T A, A x, the max-plus product for Viterbi, columns of A for
+    // backwards sampling, and the weighted outer product over the nonzeros
+    // (in the format's own data layout) for expected transition counts.
+
+    template <typename Type>
+    struct csr_trans
+    {
+        int M;
+        int32_t *indptr, *indices; Type *data;
+        int32_t *indptrT, *indicesT; Type *dataT; // transpose, for columns
+
+        csr_trans(int M, int32_t *indptr, int32_t *indices, Type *data,
+                int32_t *indptrT, int32_t *indicesT, Type *dataT)
+            : M(M), indptr(indptr), indices(indices), data(data),
+              indptrT(indptrT), indicesT(indicesT), dataT(dataT) {}
+
+        int nnz() const { return indptr[M]; }
+
+        void left_multiply(const Type *x, Type *out) const
+        {
+            for (int j=0; j<M; j++) { out[j] = 0; }
+            for (int i=0; i<M; i++) {
+                Type xi = x[i];
+                if (xi != 0) {
+                    for (int k=indptr[i]; k<indptr[i+1]; k++) {
+                        out[indices[k]] += xi * data[k];
+                    }
+                }
+            }
+        }
+
+        void right_multiply(const Type *x, Type *out) const
+        {
+            for (int i=0; i<M; i++) {
+                Type tot = 0;
+                for (int k=indptr[i]; k<indptr[i+1]; k++) {
+                    tot += data[k] * x[indices[k]];
+                }
+                out[i] = tot;
+            }
+        }
+
+        template <typename IntType>
+        void right_maxplus(const Type *x, Type *out, IntType *args) const
+        {
+            for (int i=0; i<M; i++) {
+                Type best = -numeric_limits<Type>::infinity();
+                int arg = 0;
+                for (int k=indptr[i]; k<indptr[i+1]; k++) {
+                    Type val = data[k] + x[indices[k]];
+                    if (val > best) { best = val; arg = indices[k]; }
+                }
+                out[i] = best;
+                args[i] = arg;
+            }
+        }
+
+        void column(int j, Type *out) const
+        {
+            for (int i=0; i<M; i++) { out[i] = 0; }
+            for (int k=indptrT[j]; k<indptrT[j+1]; k++) {
+                out[indicesT[k]] = dataT[k];
+            }
+        }
+
+        Type outer(const Type *a, const Type *b, Type *pair) const
+        {
+            Type tot = 0;
+            for (int i=0; i<M; i++) {
+                for (int k=indptr[i]; k<indptr[i+1]; k++) {
+                    pair[k] = a[i] * data[k] * b[indices[k]];
+                    tot += pair[k];
+                }
+            }
+            return tot;
+        }
+    };
+
+    template <typename Type>
+    struct banded_trans
+    {
+        // NOTE: as in scipy's dia_matrix, A[j-offsets[d],j] = data[d*M+j]
+        int M, ndiags;
+        int32_t *offsets; Type *data;
+
+        banded_trans(int M, int ndiags, int32_t *offsets, Type *data)
+            : M(M), ndiags(ndiags), offsets(offsets), data(data) {}
+
+        int nnz() const { return ndiags*M; }
+
+        void left_multiply(const Type *x, Type *out) const
+        {
+            for (int j=0; j<M; j++) { out[j] = 0; }
+            for (int d=0; d<ndiags; d++) {
+                int o = offsets[d];
+                Type *diag = data + d*M;
+                for (int j=max(0,o); j<min(M,M+o); j++) {
+                    out[j] += x[j-o] * diag[j];
+                }
+            }
+        }
+
+        void right_multiply(const Type *x, Type *out) const
+        {
+            for (int i=0; i<M; i++) { out[i] = 0; }
+            for (int d=0; d<ndiags; d++) {
+                int o = offsets[d];
+                Type *diag = data + d*M;
+                for (int j=max(0,o); j<min(M,M+o); j++) {
+                    out[j-o] += diag[j] * x[j];
+                }
+            }
+        }
+
+        template <typename IntType>
+        void right_maxplus(const Type *x, Type *out, IntType *args) const
+        {
             for (int i=0; i<M; i++) {
-                tempvec = eAl.col(i) + scores + eaBl.col(t+1);
-                prevscores(i) = tempvec.maxCoeff(&maxIndex);
-                args(i,t+1) = maxIndex;
+                out[i] = -numeric_limits<Type>::infinity();
+                args[i] = 0;
+            }
+            for (int d=0; d<ndiags; d++) {
+                int o = offsets[d];
+                Type *diag = data + d*M;
+                for (int j=max(0,o); j<min(M,M+o); j++) {
+                    Type val = diag[j] + x[j];
+                    if (val > out[j-o]) { out[j-o] = val; args[j-o] = j; }
+                }
+            }
+        }
+
+        void column(int j, Type *out) const
+        {
+            for (int i=0; i<M; i++) { out[i] = 0; }
+            for (int d=0; d<ndiags; d++) {
+                int i = j - offsets[d];
+                if (0 <= i && i < M) { out[i] = data[d*M+j]; }
+            }
+        }
+
+        Type outer(const Type *a, const Type *b, Type *pair) const
+        {
+            Type tot = 0;
+            for (int k=0; k<ndiags*M; k++) { pair[k] = 0; }
+            for (int d=0; d<ndiags; d++) {
+                int o = offsets[d];
+                Type *diag = data + d*M;
+                for (int j=max(0,o); j<min(M,M+o); j++) {
+                    pair[d*M+j] = a[j-o] * diag[j] * b[j];
+                    tot += pair[d*M+j];
+                }
+            }
+            return tot;
+        }
+    };
+
+    template <typename Type, typename Trans>
+    double messages_forwards_normalized_sparse(int M, int T, const Trans &trans,
+            Type *pi0, Type *aBl, Type *alphan)
+    {
+        NPArray<Type> eaBl(aBl,T,M);
+        NPArray<Type> ealphan(alphan,T,M);
+
+        double logtot = 0.;
+        Type cmax, norm;
+        Array<Type,1,Dynamic> ein_potential(M);
+
+        ein_potential = NPSubRowVectorArray<Type>(pi0,M);
+        for (int t=0; t<T; t++) {
+            cmax = eaBl.row(t).maxCoeff();
+            ealphan.row(t) = ein_potential * (eaBl.row(t) - cmax).exp();
+            norm = ealphan.row(t).sum();
+            if (likely(norm != 0)) {
+                ealphan.row(t) /= norm;
+                logtot += log(norm) + cmax;
+            } else {
+                ealphan.block(t,0,T-t,M).setZero();
+                return -numeric_limits<double>::infinity();
+            }
+            trans.left_multiply(&alphan[t*M],ein_potential.data());
+        }
+        return logtot;
+    }
+
+    template <typename Type, typename Trans>
+    void messages_forwards_log_sparse(int M, int T, const Trans &trans,
+            Type *pi0, Type *aBl, Type *alphal)
+    {
+        NPArray<Type> eaBl(aBl,T,M);
+        NPArray<Type> ealphal(alphal,T,M);
+
+        Type cmax;
+        Array<Type,1,Dynamic> scaled(M), in_potential(M);
+
+        ealphal.row(0) = NPSubRowVectorArray<Type>(pi0,M).log() + eaBl.row(0);
+        for (int t=0; t<T-1; t++) {
+            cmax = ealphal.row(t).maxCoeff();
+            if (likely(util::is_finite(cmax))) {
+                scaled = (ealphal.row(t) - cmax).exp();
+                trans.left_multiply(scaled.data(),in_potential.data());
+                ealphal.row(t+1) = in_potential.log() + cmax + eaBl.row(t+1);
+            } else {
+                ealphal.block(t+1,0,T-(t+1),M).setConstant(-numeric_limits<Type>::infinity());
+                return;
+            }
+        }
+    }
+
+    template <typename Type, typename Trans>
+    void messages_backwards_log_sparse(int M, int T, const Trans &trans,
+            Type *aBl, Type *betal)
+    {
+        NPArray<Type> eaBl(aBl,T,M);
+        NPArray<Type> ebetal(betal,T,M);
+
+        Type cmax;
+        Array<Type,1,Dynamic> thesum(M), out(M);
+
+        ebetal.row(T-1).setZero();
+        for (int t=T-2; t>=0; t--) {
+            thesum = eaBl.row(t+1) + ebetal.row(t+1);
+            cmax = thesum.maxCoeff();
+            thesum = (thesum - cmax).exp();
+            trans.right_multiply(thesum.data(),out.data());
+            ebetal.row(t) = out.log() + cmax;
+        }
+    }
+
+    template <typename Type, typename Trans>
+    double expected_statistics_log_sparse(int M, int T, const Trans &trans,
+            Type *aBl, Type *alphal, Type *betal,
+            Type *expected_states, Type *expected_transcounts)
+    {
+        NPArray<Type> eaBl(aBl,T,M);
+        NPArray<Type> ebetal(betal,T,M);
+        NPArray<Type> ealphal(alphal,T,M);
+
+        NPArray<Type> eexpected_states(expected_states,T,M);
+        NPSubVectorArray<Type> eexpected_transcounts(expected_transcounts,trans.nnz());
+
+        Array<Type,Dynamic,1> pair(trans.nnz());
+        Array<double,Dynamic,1> transcounts = Array<double,Dynamic,1>::Zero(trans.nnz());
+        Array<Type,1,Dynamic> a(M), b(M);
+        Type cmax, tot;
+
+        cmax = (ealphal.row(0) + ebetal.row(0)).maxCoeff();
+        Type log_normalizer = log((ealphal.row(0) + ebetal.row(0) - cmax).exp().sum()) + cmax;
+
+        // NOTE: each time slice's joint is normalized on its own, which keeps
+        // the sums stable without needing the exponents to line up
+        for (int t=0; t<T-1; t++) {
+            a = (ealphal.row(t) - ealphal.row(t).maxCoeff()).exp();
+            b = ebetal.row(t+1) + eaBl.row(t+1);
+            b = (b - b.maxCoeff()).exp();
+            tot = trans.outer(a.data(),b.data(),pair.data());
+            if (likely(tot > 0)) {
+                transcounts += (pair / tot).template cast<double>();
             }
+            eexpected_states.row(t) += (ealphal.row(t) + ebetal.row(t) - log_normalizer).exp();
+        }
+        eexpected_states.row(T-1) += (ealphal.row(T-1) + ebetal.row(T-1) - log_normalizer).exp();
+        eexpected_transcounts += transcounts.template cast<Type>();
+
+        return log_normalizer;
+    }
+
+    template <typename FloatType, typename IntType, typename Trans>
+    void sample_backwards_normalized_sparse(int M, int T, const Trans &trans,
+            FloatType *alphan, IntType *stateseq, FloatType *randseq)
+    {
+        NPArray<FloatType> ealphan(alphan,T,M);
+        Array<FloatType,1,Dynamic> etemp(M);
+
+        stateseq[T-1] = util::sample_discrete(M,ealphan.row(T-1).data(),randseq[T-1]);
+        for (int t=T-2; t>=0; t--) {
+            trans.column(stateseq[t+1],etemp.data());
+            etemp *= ealphan.row(t);
+            stateseq[t] = util::sample_discrete(M,etemp.data(),randseq[t]);
+        }
+    }
+
+    template <typename FloatType, typename IntType, typename Trans>
+    void viterbi_sparse(int M, int T, const Trans &logtrans,
+            FloatType *pi0, FloatType *aBl, IntType *stateseq)
+    {
+        NPArray<FloatType> eaBl(aBl,T,M);
+
+        Array<IntType,Dynamic,Dynamic,RowMajor> args(T,M);
+        Array<FloatType,1,Dynamic> scores(M), prevscores(M), tempvec(M);
+
+        scores.setZero();
+        for (int t=T-2; t>=0; t--) {
+            tempvec = scores + eaBl.row(t+1);
+            logtrans.right_maxplus(tempvec.data(),prevscores.data(),&args(t+1,0));
             scores = prevscores;
         }
 
-        (scores.array() + epi0.log() + eaBl.col(0).array()).maxCoeff(stateseq);
+        int first;
+        (scores + NPSubRowVectorArray<FloatType>(pi0,M).log() + eaBl.row(0)).maxCoeff(&first);
+        stateseq[0] = first;
         for (int t=1; t<T; t++) {
-            stateseq[t] = args(stateseq[t-1],t);
+            stateseq[t] = args(t,stateseq[t-1]);
+        }
+    }
+
+    // Parallel-in-time message passing
+
+    // NOTE: these work on one chunk of a long sequence's time axis, so that the
+    // chunks can be run in parallel. a chunk's pointers are offsets into the
+    // sequence's arrays, hence the unaligned maps. for a chunk of time steps
+    // s,...,e-1 the transfer matrix is D_s A D_{s+1} ... A D_{e-1}, where D_t
+    // is the diagonal matrix of likelihoods at time t, so that the (unnormalized)
+    // forward message at the end of the chunk is the forward potential coming
+    // into it times the transfer matrix. the chunks are combined sequentially
+    // in Python (that's only O(num_chunks * M^2) work) and then each chunk's
+    // messages are filled in from its incoming and outgoing potentials.
+    //
+    // computing a transfer matrix costs O(M^3) per time step instead of O(M^2),
+    // so this only pays off with more cores than states.
+
+    template <typename Type>
+    double chunk_transfer(int M, int T, Type *A, Type *aBl, Type *Q)
+    {
+        NPSubMatrix<Type> eA(A,M,M);
+        NPSubArray<Type> eaBl(aBl,T,M);
+        NPSubMatrix<Type> eQ(Q,M,M);
+        Matrix<Type,Dynamic,Dynamic,RowMajor> temp(M,M);
+
+        Type cmax = eaBl.row(0).maxCoeff();
+        double logscale = cmax;
+        Type norm;
+
+        eQ.setZero();
+        eQ.diagonal() = (eaBl.row(0) - cmax).exp().matrix().transpose();
+        for (int t=1; t<T; t++) {
+            cmax = eaBl.row(t).maxCoeff();
+            temp.noalias() = eQ * eA;
+            eQ.array() = temp.array().rowwise() * (eaBl.row(t) - cmax).exp();
+            norm = eQ.sum();
+            if (unlikely(norm == 0)) {
+                return -numeric_limits<double>::infinity();
+            }
+            eQ /= norm;
+            logscale += log(norm) + cmax;
+        }
+
+        return logscale;
+    }
+
+    template <typename Type>
+    void expected_statistics_chunk(int M, int T, Type *A, Type *in_potential,
+            Type *out_potential, Type *aBl,
+            Type *expected_states, Type *expected_transcounts)
+    {
+        NPSubArray<Type> eA(A,M,M);
+        NPSubArray<Type> eaBl(aBl,T,M);
+        NPSubArray<Type> eexpected_states(expected_states,T,M);
+        NPSubArray<Type> eexpected_transcounts(expected_transcounts,M,M);
+
+        Array<Type,Dynamic,Dynamic,RowMajor> alphan(T,M), betan(T,M), pair(M,M);
+        Array<double,Dynamic,Dynamic,RowMajor> transcounts(M,M);
+        Array<Type,1,Dynamic> in(M), likes(M);
+        Type cmax;
+
+        // forwards, starting from the incoming potential
+        in = NPSubRowVectorArray<Type>(in_potential,M);
+        for (int t=0; t<T; t++) {
+            cmax = eaBl.row(t).maxCoeff();
+            alphan.row(t) = in * (eaBl.row(t) - cmax).exp();
+            alphan.row(t) /= alphan.row(t).sum();
+            in = (alphan.row(t).matrix() * eA.matrix()).array();
+        }
+
+        // backwards, ending at the outgoing potential
+        betan.row(T-1) = NPSubRowVectorArray<Type>(out_potential,M);
+        for (int t=T-2; t>=0; t--) {
+            cmax = eaBl.row(t+1).maxCoeff();
+            likes = (eaBl.row(t+1) - cmax).exp() * betan.row(t+1);
+            betan.row(t) = (eA.matrix() * likes.matrix().transpose()).array().transpose();
+            betan.row(t) /= betan.row(t).maxCoeff();
+        }
+
+        eexpected_states = alphan * betan;
+        eexpected_states.colwise() /= eexpected_states.rowwise().sum();
+
+        transcounts.setZero();
+        for (int t=0; t<T-1; t++) {
+            cmax = eaBl.row(t+1).maxCoeff();
+            likes = (eaBl.row(t+1) - cmax).exp() * betan.row(t+1);
+            pair = eA * (alphan.row(t).matrix().transpose() * likes.matrix()).array();
+            transcounts += (pair / pair.sum()).template cast<double>();
+        }
+        eexpected_transcounts = transcounts.template cast<Type>();
+    }
+
+    template <typename FloatType, typename IntType>
+    void sample_chunk(int M, int T, FloatType *A, FloatType *in_potential,
+            FloatType *aBl, IntType *stateseq, FloatType *randseq)
+    {
+        // NOTE: the state at the chunk's last time step is already set
+        NPSubArray<FloatType> eA(A,M,M);
+        NPSubArray<FloatType> eaBl(aBl,T,M);
+
+        Array<FloatType,Dynamic,Dynamic,RowMajor> alphan(T,M);
+        Array<FloatType,1,Dynamic> in(M), temp(M);
+        FloatType cmax;
+
+        in = NPSubRowVectorArray<FloatType>(in_potential,M);
+        for (int t=0; t<T-1; t++) {
+            cmax = eaBl.row(t).maxCoeff();
+            alphan.row(t) = in * (eaBl.row(t) - cmax).exp();
+            alphan.row(t) /= alphan.row(t).sum();
+            in = (alphan.row(t).matrix() * eA.matrix()).array();
+        }
+
+        for (int t=T-2; t>=0; t--) {
+            temp = eA.col(stateseq[t+1]).transpose() * alphan.row(t);
+            stateseq[t] = util::sample_discrete(M,temp.data(),randseq[t]);
         }
     }
 }
@@ -269,7 +824,7 @@ class hmmc
             IntType *stateseq, FloatType *randseq)
     { hmm::sample_forwards_log(M,T,A,pi0,aBl,betal,stateseq,randseq); }
 
-    static FloatType messages_forwards_normalized(
+    static double messages_forwards_normalized(
             int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl,
             FloatType *alphan)
     { return hmm::messages_forwards_normalized(M,T,A,pi0,aBl,alphan); }
@@ -284,13 +839,121 @@ class hmmc
             IntType *stateseq)
     { hmm::viterbi(M,T,A,pi0,aBl,stateseq); }
 
-    static FloatType expected_statistics_log(
+    static double expected_statistics_log(
             int M, int T,
             FloatType *log_trans_potential, FloatType *log_likelihood_potential,
             FloatType *alphal, FloatType *betal,
             FloatType *expected_states, FloatType *expected_transcounts)
     { return hmm::expected_statistics_log(M,T,log_trans_potential,log_likelihood_potential,
             alphal,betal,expected_states,expected_transcounts); }
+
+    static double expected_statistics(
+            int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl,
+            FloatType *expected_states, FloatType *expected_transcounts)
+    { return hmm::expected_statistics(M,T,A,pi0,aBl,expected_states,expected_transcounts); }
+
+    static double chunk_transfer(
+            int M, int T, FloatType *A, FloatType *aBl, FloatType *Q)
+    { return hmm::chunk_transfer(M,T,A,aBl,Q); }
+
+    static void expected_statistics_chunk(
+            int M, int T, FloatType *A, FloatType *in_potential, FloatType *out_potential,
+            FloatType *aBl, FloatType *expected_states, FloatType *expected_transcounts)
+    { hmm::expected_statistics_chunk(M,T,A,in_potential,out_potential,aBl,
+            expected_states,expected_transcounts); }
+
+    static void sample_chunk(
+            int M, int T, FloatType *A, FloatType *in_potential, FloatType *aBl,
+            IntType *stateseq, FloatType *randseq)
+    { hmm::sample_chunk(M,T,A,in_potential,aBl,stateseq,randseq); }
+};
+
+// NOTE: sparse versions of the above, with the transition matrix passed as the
+// arrays of a scipy.sparse csr_matrix (and of its transpose) or dia_matrix
+
+template <typename FloatType, typename IntType = int32_t>
+class hmmc_sparse
+{
+    typedef hmm::csr_trans<FloatType> csr;
+    typedef hmm::banded_trans<FloatType> banded;
+
+    public:
+
+    static double messages_forwards_normalized_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, FloatType *data,
+            FloatType *pi0, FloatType *aBl, FloatType *alphan)
+    { return hmm::messages_forwards_normalized_sparse(M,T,
+            csr(M,indptr,indices,data,NULL,NULL,NULL),pi0,aBl,alphan); }
+
+    static double messages_forwards_normalized_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *data,
+            FloatType *pi0, FloatType *aBl, FloatType *alphan)
+    { return hmm::messages_forwards_normalized_sparse(M,T,
+            banded(M,ndiags,offsets,data),pi0,aBl,alphan); }
+
+    static void messages_forwards_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, FloatType *data,
+            FloatType *pi0, FloatType *aBl, FloatType *alphal)
+    { hmm::messages_forwards_log_sparse(M,T,
+            csr(M,indptr,indices,data,NULL,NULL,NULL),pi0,aBl,alphal); }
+
+    static void messages_forwards_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *data,
+            FloatType *pi0, FloatType *aBl, FloatType *alphal)
+    { hmm::messages_forwards_log_sparse(M,T,
+            banded(M,ndiags,offsets,data),pi0,aBl,alphal); }
+
+    static void messages_backwards_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, FloatType *data,
+            FloatType *aBl, FloatType *betal)
+    { hmm::messages_backwards_log_sparse(M,T,
+            csr(M,indptr,indices,data,NULL,NULL,NULL),aBl,betal); }
+
+    static void messages_backwards_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *data,
+            FloatType *aBl, FloatType *betal)
+    { hmm::messages_backwards_log_sparse(M,T,
+            banded(M,ndiags,offsets,data),aBl,betal); }
+
+    static double expected_statistics_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, FloatType *data,
+            FloatType *aBl, FloatType *alphal, FloatType *betal,
+            FloatType *expected_states, FloatType *expected_transcounts)
+    { return hmm::expected_statistics_log_sparse(M,T,
+            csr(M,indptr,indices,data,NULL,NULL,NULL),aBl,alphal,betal,
+            expected_states,expected_transcounts); }
+
+    static double expected_statistics_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *data,
+            FloatType *aBl, FloatType *alphal, FloatType *betal,
+            FloatType *expected_states, FloatType *expected_transcounts)
+    { return hmm::expected_statistics_log_sparse(M,T,
+            banded(M,ndiags,offsets,data),aBl,alphal,betal,
+            expected_states,expected_transcounts); }
+
+    static void sample_backwards_normalized_csr(
+            int M, int T, int32_t *indptrT, int32_t *indicesT, FloatType *dataT,
+            FloatType *alphan, IntType *stateseq, FloatType *randseq)
+    { hmm::sample_backwards_normalized_sparse(M,T,
+            csr(M,NULL,NULL,NULL,indptrT,indicesT,dataT),alphan,stateseq,randseq); }
+
+    static void sample_backwards_normalized_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *data,
+            FloatType *alphan, IntType *stateseq, FloatType *randseq)
+    { hmm::sample_backwards_normalized_sparse(M,T,
+            banded(M,ndiags,offsets,data),alphan,stateseq,randseq); }
+
+    static void viterbi_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, FloatType *logdata,
+            FloatType *pi0, FloatType *aBl, IntType *stateseq)
+    { hmm::viterbi_sparse(M,T,
+            csr(M,indptr,indices,logdata,NULL,NULL,NULL),pi0,aBl,stateseq); }
+
+    static void viterbi_banded(
+            int M, int T, int ndiags, int32_t *offsets, FloatType *logdata,
+            FloatType *pi0, FloatType *aBl, IntType *stateseq)
+    { hmm::viterbi_sparse(M,T,
+            banded(M,ndiags,offsets,logdata),pi0,aBl,stateseq); }
 };
 
 #endif
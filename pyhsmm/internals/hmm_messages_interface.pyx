@@ -19,6 +19,12 @@ from cython cimport floating
 
 from cython.parallel import prange
 
+from pyhsmm.util.stats import uniform_stream
+
+# NOTE: the samplers take an optional rng_key (see pyhsmm.util.stats) to draw
+# their uniforms from a counter-based stream instead of np.random; the
+# *_multiple versions take a list of them, one per sequence
+
 cdef extern from "hmm_messages.h":
     cdef cppclass hmmc[Type]: # NOTE: default states type is int32_t
         hmmc()
@@ -26,7 +32,7 @@ cdef extern from "hmm_messages.h":
             int M, int T, Type *A, Type *aBl, Type *betal) nogil
         void messages_forwards_log(
             int M, int T, Type *A, Type *pi0, Type *aBl, Type *alphal) nogil
-        Type messages_forwards_normalized(
+        double messages_forwards_normalized(
             int M, int T, Type *A, Type *pi0, Type *aBl, Type *alphan) nogil
         void sample_forwards_log(
             int M, int T, Type *A, Type *pi0, Type *aBl, Type *betal,
@@ -36,10 +42,62 @@ cdef extern from "hmm_messages.h":
             int32_t *stateseq, Type *randseq) nogil
         void viterbi(
             int M, int T, Type *A, Type *pi0, Type *aBl, int32_t *stateseq) nogil
-        Type expected_statistics_log(
+        double expected_statistics_log(
             int M, int T, Type *log_trans_potential, Type *log_likelihood_potential,
             Type *alphal, Type *betal,
-            Type *expected_states, Type *expected_transcounts)
+            Type *expected_states, Type *expected_transcounts) nogil
+        double expected_statistics(
+            int M, int T, Type *A, Type *pi0, Type *aBl,
+            Type *expected_states, Type *expected_transcounts) nogil
+        double chunk_transfer(
+            int M, int T, Type *A, Type *aBl, Type *Q) nogil
+        void expected_statistics_chunk(
+            int M, int T, Type *A, Type *in_potential, Type *out_potential,
+            Type *aBl, Type *expected_states, Type *expected_transcounts) nogil
+        void sample_chunk(
+            int M, int T, Type *A, Type *in_potential, Type *aBl,
+            int32_t *stateseq, Type *randseq) nogil
+
+    cdef cppclass hmmc_sparse[Type]:
+        hmmc_sparse()
+        double messages_forwards_normalized_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, Type *data,
+            Type *pi0, Type *aBl, Type *alphan) nogil
+        double messages_forwards_normalized_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *data,
+            Type *pi0, Type *aBl, Type *alphan) nogil
+        void messages_forwards_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, Type *data,
+            Type *pi0, Type *aBl, Type *alphal) nogil
+        void messages_forwards_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *data,
+            Type *pi0, Type *aBl, Type *alphal) nogil
+        void messages_backwards_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, Type *data,
+            Type *aBl, Type *betal) nogil
+        void messages_backwards_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *data,
+            Type *aBl, Type *betal) nogil
+        double expected_statistics_log_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, Type *data,
+            Type *aBl, Type *alphal, Type *betal,
+            Type *expected_states, Type *expected_transcounts) nogil
+        double expected_statistics_log_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *data,
+            Type *aBl, Type *alphal, Type *betal,
+            Type *expected_states, Type *expected_transcounts) nogil
+        void sample_backwards_normalized_csr(
+            int M, int T, int32_t *indptrT, int32_t *indicesT, Type *dataT,
+            Type *alphan, int32_t *stateseq, Type *randseq) nogil
+        void sample_backwards_normalized_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *data,
+            Type *alphan, int32_t *stateseq, Type *randseq) nogil
+        void viterbi_csr(
+            int M, int T, int32_t *indptr, int32_t *indices, Type *logdata,
+            Type *pi0, Type *aBl, int32_t *stateseq) nogil
+        void viterbi_banded(
+            int M, int T, int ndiags, int32_t *offsets, Type *logdata,
+            Type *pi0, Type *aBl, int32_t *stateseq) nogil
 
 def messages_backwards_log(
         floating[:,::1] A not None,
@@ -47,7 +105,8 @@ def messages_backwards_log(
         np.ndarray[floating,ndim=2,mode="c"] betal not None,
         ):
     cdef hmmc[floating] ref
-    ref.messages_backwards_log(A.shape[0],aBl.shape[0],&A[0,0],&aBl[0,0],&betal[0,0])
+    with nogil:
+        ref.messages_backwards_log(A.shape[0],aBl.shape[0],&A[0,0],&aBl[0,0],&betal[0,0])
     return betal
 
 def messages_forwards_log(
@@ -57,8 +116,9 @@ def messages_forwards_log(
         np.ndarray[floating,ndim=2,mode="c"] alphal not None,
         ):
     cdef hmmc[floating] ref
-    ref.messages_forwards_log(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
-            &alphal[0,0])
+    with nogil:
+        ref.messages_forwards_log(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
+                &alphal[0,0])
     return alphal
 
 def sample_forwards_log(
@@ -67,17 +127,19 @@ def sample_forwards_log(
         floating[::1] pi0 not None,
         floating[:,::1] betal not None,
         np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        rng_key=None,
         ):
     cdef hmmc[floating] ref
 
     cdef floating[:] randseq
     if floating is double:
-        randseq = np.random.random(size=aBl.shape[0]).astype(np.double)
+        randseq = uniform_stream(aBl.shape[0],rng_key,dtype=np.double)
     else:
-        randseq = np.random.random(size=aBl.shape[0]).astype(np.float)
+        randseq = uniform_stream(aBl.shape[0],rng_key,dtype=np.float32)
 
-    ref.sample_forwards_log(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
-            &betal[0,0],&stateseq[0],&randseq[0])
+    with nogil:
+        ref.sample_forwards_log(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
+                &betal[0,0],&stateseq[0],&randseq[0])
 
     return stateseq
 
@@ -101,14 +163,32 @@ def expected_statistics_log(
     # return expected_states, expected_transcounts, normalizer
 
     cdef hmmc[floating] ref
-    cdef floating log_normalizer = ref.expected_statistics_log(
-            log_trans_potential.shape[0],alphal.shape[0],
-            &log_trans_potential[0,0],
-            &log_likelihood_potential[0,0],
-            &alphal[0,0],
-            &betal[0,0],
-            &expected_states[0,0],
-            &expected_transcounts[0,0])
+    cdef double log_normalizer
+    with nogil:
+        log_normalizer = ref.expected_statistics_log(
+                log_trans_potential.shape[0],alphal.shape[0],
+                &log_trans_potential[0,0],
+                &log_likelihood_potential[0,0],
+                &alphal[0,0],
+                &betal[0,0],
+                &expected_states[0,0],
+                &expected_transcounts[0,0])
+    return expected_states, expected_transcounts, log_normalizer
+
+# NOTE: this uses normalized messages, falling back to the log-domain messages
+# if they underflow, and doesn't need the messages as arguments
+def expected_statistics(
+        floating[:,::1] A not None,
+        floating[::1] pi0 not None,
+        floating[:,::1] aBl not None,
+        np.ndarray[floating,ndim=2,mode='c'] expected_states not None,
+        np.ndarray[floating,ndim=2,mode='c'] expected_transcounts not None,
+        ):
+    cdef hmmc[floating] ref
+    cdef double log_normalizer
+    with nogil:
+        log_normalizer = ref.expected_statistics(A.shape[0],aBl.shape[0],
+                &A[0,0],&pi0[0],&aBl[0,0],&expected_states[0,0],&expected_transcounts[0,0])
     return expected_states, expected_transcounts, log_normalizer
 
 def messages_forwards_normalized(
@@ -118,26 +198,29 @@ def messages_forwards_normalized(
         np.ndarray[floating,ndim=2,mode="c"] alphan not None,
         ):
     cdef hmmc[floating] ref
-    cdef floating loglike = \
-            ref.messages_forwards_normalized(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],
-                &aBl[0,0],&alphan[0,0])
+    cdef double loglike
+    with nogil:
+        loglike = ref.messages_forwards_normalized(A.shape[0],aBl.shape[0],&A[0,0],
+                &pi0[0],&aBl[0,0],&alphan[0,0])
     return alphan, loglike
 
 def sample_backwards_normalized(
         floating[:,::1] AT not None,
         floating[:,::1] alphan not None,
         np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        rng_key=None,
         ):
     cdef hmmc[floating] ref
 
     cdef floating[:] randseq
     if floating is double:
-        randseq = np.random.random(size=alphan.shape[0]).astype(np.double)
+        randseq = uniform_stream(alphan.shape[0],rng_key,dtype=np.double)
     else:
-        randseq = np.random.random(size=alphan.shape[0]).astype(np.float)
+        randseq = uniform_stream(alphan.shape[0],rng_key,dtype=np.float32)
 
-    ref.sample_backwards_normalized(AT.shape[0],alphan.shape[0],&AT[0,0],
-            &alphan[0,0],&stateseq[0],&randseq[0])
+    with nogil:
+        ref.sample_backwards_normalized(AT.shape[0],alphan.shape[0],&AT[0,0],
+                &alphan[0,0],&stateseq[0],&randseq[0])
 
     return stateseq
 
@@ -148,6 +231,7 @@ def resample_normalized_multiple(
         floating[::1] pi0 not None,
         list aBls not None,
         list stateseqs not None,
+        list rng_keys=None,
         ):
     cdef hmmc[floating] ref
     cdef int i
@@ -163,7 +247,8 @@ def resample_normalized_multiple(
 
     # NOTE: allocate temps, pad to avoid false sharing in the cache
 
-    alphans = [np.empty((aBl.shape[0]+1,aBl.shape[1])) for aBl in aBls]
+    alphans = [np.empty((aBl.shape[0]+1,aBl.shape[1]),dtype=np.asarray(A).dtype)
+            for aBl in aBls]
 
     # NOTE: this next bit is converting python lists to C++ vectors for nogil
 
@@ -180,14 +265,16 @@ def resample_normalized_multiple(
         temp2 = stateseqs[i]
         stateseqs_vect.push_back(&temp2[0])
 
-    cdef floating[:] loglikes
+    cdef double[:] loglikes = np.empty(num,dtype=np.double)
     cdef floating[:] randseq
+    if rng_keys is None:
+        rng_keys = [None]*num
     if floating is double:
-        loglikes = np.empty(num,dtype=np.double)
-        randseq = np.random.random(size=np.sum(Ts)).astype(np.double)
+        randseq = np.concatenate([uniform_stream(T,key,dtype=np.double)
+            for T, key in zip(np.asarray(Ts),rng_keys)] + [np.empty(0)])
     else:
-        loglikes = np.empty(num,dtype=np.float)
-        randseq = np.random.random(size=np.sum(Ts)).astype(np.float)
+        randseq = np.concatenate([uniform_stream(T,key,dtype=np.float32)
+            for T, key in zip(np.asarray(Ts),rng_keys)] + [np.empty(0,dtype=np.float32)])
 
     with nogil:
         for i in prange(num):
@@ -198,6 +285,50 @@ def resample_normalized_multiple(
 
     return np.asarray(loglikes)
 
+# NOTE: like resample_normalized_multiple, this method is for dispatching to
+# OpenMP. expected transition counts are kept per sequence so that threads
+# never write to the same output.
+def expected_statistics_multiple(
+        floating[:,::1] A not None,
+        floating[::1] pi0 not None,
+        list aBls not None,
+        ):
+    cdef hmmc[floating] ref
+    cdef int i
+
+    cdef int num = len(aBls)
+    cdef int N = A.shape[0]
+    cdef int[:] Ts = np.array([aBl.shape[0] for aBl in aBls],dtype=np.int32)
+
+    if floating is double:
+        dtype = np.double
+    else:
+        dtype = np.float32
+
+    # NOTE: separate allocations keep each output aligned for Eigen's maps
+    expected_states_list = [np.zeros((aBl.shape[0],N),dtype=dtype) for aBl in aBls]
+    expected_transcounts_list = [np.zeros((N,N),dtype=dtype) for aBl in aBls]
+    cdef double[:] normalizers = np.empty(num,dtype=np.double)
+
+    cdef vector[floating*] aBls_vect
+    cdef vector[floating*] expected_states_vect
+    cdef vector[floating*] expected_transcounts_vect
+    cdef floating[:,::1] temp
+    for i in range(num):
+        temp = aBls[i]
+        aBls_vect.push_back(&temp[0,0])
+        temp = expected_states_list[i]
+        expected_states_vect.push_back(&temp[0,0])
+        temp = expected_transcounts_list[i]
+        expected_transcounts_vect.push_back(&temp[0,0])
+
+    with nogil:
+        for i in prange(num):
+            normalizers[i] = ref.expected_statistics(N,Ts[i],&A[0,0],&pi0[0],
+                    aBls_vect[i],expected_states_vect[i],expected_transcounts_vect[i])
+
+    return expected_states_list, expected_transcounts_list, np.asarray(normalizers)
+
 def viterbi(
         floating[:,::1] A not None,
         floating[:,::1] aBl not None,
@@ -205,7 +336,320 @@ def viterbi(
         np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
         ):
     cdef hmmc[floating] ref
-    ref.viterbi(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
+    with nogil:
+        ref.viterbi(A.shape[0],aBl.shape[0],&A[0,0],&pi0[0],&aBl[0,0],
                 &stateseq[0])
     return stateseq
 
+def viterbi_multiple(
+        floating[:,::1] A not None,
+        floating[::1] pi0 not None,
+        list aBls not None,
+        list stateseqs not None,
+        ):
+    cdef hmmc[floating] ref
+    cdef int i
+
+    cdef int num = len(aBls)
+    cdef int N = A.shape[0]
+    cdef int[:] Ts = np.array([aBl.shape[0] for aBl in aBls],dtype=np.int32)
+
+    cdef vector[floating*] aBls_vect
+    cdef vector[int32_t*] stateseqs_vect
+    cdef floating[:,::1] temp
+    cdef int32_t[::1] temp2
+    for i in range(num):
+        temp = aBls[i]
+        aBls_vect.push_back(&temp[0,0])
+        temp2 = stateseqs[i]
+        stateseqs_vect.push_back(&temp2[0])
+
+    with nogil:
+        for i in prange(num):
+            ref.viterbi(N,Ts[i],&A[0,0],&pi0[0],aBls_vect[i],stateseqs_vect[i])
+
+    return stateseqs
+
+
+### parallel-in-time message passing over chunks of one sequence
+
+def chunk_transfers(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        int[::1] starts not None,
+        int[::1] stops not None,
+        ):
+    cdef hmmc[floating] ref
+    cdef int c
+    cdef int num = starts.shape[0]
+    cdef int N = A.shape[0]
+
+    if floating is double:
+        dtype = np.double
+    else:
+        dtype = np.float32
+
+    cdef floating[:,:,::1] transfers = np.empty((num,N,N),dtype=dtype)
+    cdef double[::1] logscales = np.empty(num,dtype=np.double)
+
+    with nogil:
+        for c in prange(num):
+            logscales[c] = ref.chunk_transfer(N,stops[c]-starts[c],&A[0,0],
+                    &aBl[starts[c],0],&transfers[c,0,0])
+
+    return np.asarray(transfers), np.asarray(logscales)
+
+def expected_statistics_chunks(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        int[::1] starts not None,
+        int[::1] stops not None,
+        floating[:,::1] in_potentials not None,
+        floating[:,::1] out_potentials not None,
+        floating[:,::1] expected_states not None,
+        ):
+    cdef hmmc[floating] ref
+    cdef int c
+    cdef int num = starts.shape[0]
+    cdef int N = A.shape[0]
+
+    if floating is double:
+        dtype = np.double
+    else:
+        dtype = np.float32
+
+    cdef floating[:,:,::1] expected_transcounts = np.empty((num,N,N),dtype=dtype)
+
+    with nogil:
+        for c in prange(num):
+            ref.expected_statistics_chunk(N,stops[c]-starts[c],&A[0,0],
+                    &in_potentials[c,0],&out_potentials[c,0],&aBl[starts[c],0],
+                    &expected_states[starts[c],0],&expected_transcounts[c,0,0])
+
+    return np.asarray(expected_states), np.asarray(expected_transcounts)
+
+def sample_chunks(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        int[::1] starts not None,
+        int[::1] stops not None,
+        floating[:,::1] in_potentials not None,
+        np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        rng_key=None,
+        ):
+    cdef hmmc[floating] ref
+    cdef int c
+    cdef int num = starts.shape[0]
+    cdef int N = A.shape[0]
+    cdef int32_t[::1] _stateseq = stateseq
+
+    cdef floating[::1] randseq
+    if floating is double:
+        randseq = uniform_stream(stateseq.shape[0],rng_key,dtype=np.double)
+    else:
+        randseq = uniform_stream(stateseq.shape[0],rng_key,dtype=np.float32)
+
+    with nogil:
+        for c in prange(num):
+            ref.sample_chunk(N,stops[c]-starts[c],&A[0,0],&in_potentials[c,0],
+                    &aBl[starts[c],0],&_stateseq[starts[c]],&randseq[starts[c]])
+
+    return stateseq
+
+
+### sparse and banded transition matrices
+
+# NOTE: these take the transition matrix as a scipy.sparse csr_matrix (sparse)
+# or dia_matrix (banded) with the same dtype as aBl, and otherwise mirror the
+# dense functions above. for the banded format, data must have one column per
+# state, as it does for a dia_matrix built from a dense array.
+
+def _as_supported(trans):
+    return trans if trans.format in ('csr','dia') else trans.tocsr()
+
+def _csr_arrays(trans):
+    return np.asarray(trans.indptr,dtype=np.int32), \
+            np.asarray(trans.indices,dtype=np.int32), trans.data
+
+def _banded_arrays(trans):
+    assert trans.data.shape[1] == trans.shape[0]
+    return np.asarray(trans.offsets,dtype=np.int32), \
+            np.ascontiguousarray(trans.data)
+
+def messages_forwards_normalized_sparse(
+        trans not None,
+        floating[:,::1] aBl not None,
+        floating[::1] pi0 not None,
+        np.ndarray[floating,ndim=2,mode="c"] alphan not None,
+        ):
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] data
+    cdef floating[:,::1] diags
+    cdef double loglike
+
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, data = _csr_arrays(trans)
+        with nogil:
+            loglike = ref.messages_forwards_normalized_csr(aBl.shape[1],aBl.shape[0],
+                    &indptr[0],&indices[0],&data[0],&pi0[0],&aBl[0,0],&alphan[0,0])
+    else:
+        offsets, diags = _banded_arrays(trans)
+        with nogil:
+            loglike = ref.messages_forwards_normalized_banded(aBl.shape[1],aBl.shape[0],
+                    offsets.shape[0],&offsets[0],&diags[0,0],&pi0[0],&aBl[0,0],&alphan[0,0])
+
+    return alphan, loglike
+
+def messages_forwards_log_sparse(
+        trans not None,
+        floating[:,::1] aBl not None,
+        floating[::1] pi0 not None,
+        np.ndarray[floating,ndim=2,mode="c"] alphal not None,
+        ):
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] data
+    cdef floating[:,::1] diags
+
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, data = _csr_arrays(trans)
+        with nogil:
+            ref.messages_forwards_log_csr(aBl.shape[1],aBl.shape[0],
+                    &indptr[0],&indices[0],&data[0],&pi0[0],&aBl[0,0],&alphal[0,0])
+    else:
+        offsets, diags = _banded_arrays(trans)
+        with nogil:
+            ref.messages_forwards_log_banded(aBl.shape[1],aBl.shape[0],
+                    offsets.shape[0],&offsets[0],&diags[0,0],&pi0[0],&aBl[0,0],&alphal[0,0])
+
+    return alphal
+
+def messages_backwards_log_sparse(
+        trans not None,
+        floating[:,::1] aBl not None,
+        np.ndarray[floating,ndim=2,mode="c"] betal not None,
+        ):
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] data
+    cdef floating[:,::1] diags
+
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, data = _csr_arrays(trans)
+        with nogil:
+            ref.messages_backwards_log_csr(aBl.shape[1],aBl.shape[0],
+                    &indptr[0],&indices[0],&data[0],&aBl[0,0],&betal[0,0])
+    else:
+        offsets, diags = _banded_arrays(trans)
+        with nogil:
+            ref.messages_backwards_log_banded(aBl.shape[1],aBl.shape[0],
+                    offsets.shape[0],&offsets[0],&diags[0,0],&aBl[0,0],&betal[0,0])
+
+    return betal
+
+def expected_statistics_log_sparse(
+        trans not None,
+        np.ndarray[floating,ndim=2,mode='c'] log_likelihood_potential not None,
+        np.ndarray[floating,ndim=2,mode='c'] alphal not None,
+        np.ndarray[floating,ndim=2,mode='c'] betal not None,
+        np.ndarray[floating,ndim=2,mode='c'] expected_states not None,
+        ):
+    # NOTE: returns the expected transition counts as a dense array; they are
+    # accumulated over the nonzeros of trans and scattered at the end
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] data, counts
+    cdef floating[:,::1] diags, diag_counts
+    cdef double log_normalizer
+    cdef int M = alphal.shape[1], T = alphal.shape[0]
+
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, data = _csr_arrays(trans)
+        counts = np.zeros_like(trans.data)
+        with nogil:
+            log_normalizer = ref.expected_statistics_log_csr(M,T,
+                    &indptr[0],&indices[0],&data[0],&log_likelihood_potential[0,0],
+                    &alphal[0,0],&betal[0,0],&expected_states[0,0],&counts[0])
+        expected_transcounts = trans.__class__(
+                (np.asarray(counts),trans.indices,trans.indptr),shape=trans.shape)
+    else:
+        offsets, diags = _banded_arrays(trans)
+        diag_counts = np.zeros_like(diags)
+        with nogil:
+            log_normalizer = ref.expected_statistics_log_banded(M,T,
+                    offsets.shape[0],&offsets[0],&diags[0,0],&log_likelihood_potential[0,0],
+                    &alphal[0,0],&betal[0,0],&expected_states[0,0],&diag_counts[0,0])
+        expected_transcounts = trans.__class__(
+                (np.asarray(diag_counts),trans.offsets),shape=trans.shape)
+
+    return expected_states, expected_transcounts.toarray(), log_normalizer
+
+def sample_backwards_normalized_sparse(
+        trans not None,
+        floating[:,::1] alphan not None,
+        np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        rng_key=None,
+        trans_T=None,
+        ):
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] data
+    cdef floating[:,::1] diags
+
+    cdef floating[:] randseq
+    if floating is double:
+        randseq = uniform_stream(alphan.shape[0],rng_key,dtype=np.double)
+    else:
+        randseq = uniform_stream(alphan.shape[0],rng_key,dtype=np.float32)
+
+    # NOTE: the csr kernel walks the columns of trans, so it takes trans.T as
+    # a csr_matrix; callers sampling repeatedly can pass it in as trans_T
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, data = _csr_arrays(trans.T.tocsr() if trans_T is None else trans_T)
+        with nogil:
+            ref.sample_backwards_normalized_csr(alphan.shape[1],alphan.shape[0],
+                    &indptr[0],&indices[0],&data[0],&alphan[0,0],&stateseq[0],&randseq[0])
+    else:
+        offsets, diags = _banded_arrays(trans)
+        with nogil:
+            ref.sample_backwards_normalized_banded(alphan.shape[1],alphan.shape[0],
+                    offsets.shape[0],&offsets[0],&diags[0,0],&alphan[0,0],
+                    &stateseq[0],&randseq[0])
+
+    return stateseq
+
+def viterbi_sparse(
+        trans not None,
+        floating[:,::1] aBl not None,
+        floating[::1] pi0 not None,
+        np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        ):
+    cdef hmmc_sparse[floating] ref
+    cdef int32_t[::1] indptr, indices, offsets
+    cdef floating[::1] logdata
+    cdef floating[:,::1] logdiags
+
+    errs = np.seterr(divide='ignore')
+    trans = _as_supported(trans)
+    if trans.format == 'csr':
+        indptr, indices, logdata = _csr_arrays(trans)
+        logdata = np.log(logdata)
+        with nogil:
+            ref.viterbi_csr(aBl.shape[1],aBl.shape[0],
+                    &indptr[0],&indices[0],&logdata[0],&pi0[0],&aBl[0,0],&stateseq[0])
+    else:
+        offsets, logdiags = _banded_arrays(trans)
+        logdiags = np.log(logdiags)
+        with nogil:
+            ref.viterbi_banded(aBl.shape[1],aBl.shape[0],
+                    offsets.shape[0],&offsets[0],&logdiags[0,0],&pi0[0],&aBl[0,0],
+                    &stateseq[0])
+    np.seterr(**errs)
+
+    return stateseq
@@ -0,0 +1,286 @@
+from __future__ import division
+import numpy as np
+
+from pyhsmm.internals import emissions, suffstats
+from pyhsmm.util.general import bump_version
+
+# NOTE: these classes do inference on a stream of observations for an HMM,
+# keeping only a constant amount of state between calls to update. they use
+# the message passing methods of the model's states class, so an HMM (or a
+# WeakLimitHDPHMM, etc.) runs them through the kernels in hmm_messages.h.
+#
+# the model parameters are read when an object is made and when reset is
+# called, so reset after updating the model.
+
+class _OnlineBase(object):
+    def __init__(self,model,pi_0=None):
+        self.model = model
+        self.reset(pi_0)
+
+    def reset(self,pi_0=None):
+        self.trans_matrix = np.asarray(self.model.trans_distn.trans_matrix,dtype=self.dtype)
+        self.pi_0 = np.asarray(pi_0 if pi_0 is not None else self.model.init_state_distn.pi_0,
+                dtype=self.dtype)
+        self.t = 0
+
+    @property
+    def num_states(self):
+        return self.model.num_states
+
+    @property
+    def dtype(self):
+        return self.model.dtype
+
+    @property
+    def _states_class(self):
+        return self.model._states_class
+
+    def _log_likelihoods(self,obs_chunk):
+        aBl = np.empty((obs_chunk.shape[0],self.num_states),dtype=self.dtype)
+        emissions.log_likelihoods(self.model.obs_distns,obs_chunk,aBl)
+        aBl[np.isnan(aBl).any(1)] = 0.
+        return aBl
+
+    def update(self,obs_chunk):
+        return self.update_loglikes(self._log_likelihoods(obs_chunk))
+
+
+class HMMFilter(_OnlineBase):
+    '''
+    Forward filtering. update takes a chunk of observations (an array whose
+    first axis is time) and returns the filtered state marginals for the chunk
+    and the chunk's incremental log likelihood, i.e.
+    log p(chunk | everything before it).
+    '''
+
+    def reset(self,pi_0=None):
+        super(HMMFilter,self).reset(pi_0)
+        self._in_potential = self.pi_0
+        self.alphan = None
+        self.log_likelihood = 0.
+
+    def update_loglikes(self,aBl):
+        alphan, loglike = self._states_class._messages_forwards_normalized(
+                self.trans_matrix,self._in_potential,aBl)
+
+        self._in_potential = self.trans_matrix.T.dot(alphan[-1])
+        self.alphan = alphan[-1]
+        self.log_likelihood += loglike
+        self.t += aBl.shape[0]
+
+        return alphan, loglike
+
+    def predict(self,steps=1):
+        'predictive state distribution for the time step steps ahead'
+        assert steps > 0
+        if self.alphan is None:
+            return np.linalg.matrix_power(self.trans_matrix.T,steps-1).dot(self.pi_0)
+        return np.linalg.matrix_power(self.trans_matrix.T,steps).dot(self.alphan)
+
+
+class HMMFixedLagSmoother(_OnlineBase):
+    '''
+    Fixed-lag smoothing. After the observation at time t arrives, the state
+    marginal for time t-lag is computed given everything up to time t, using
+    a backward pass over a ring buffer of the last lag+1 steps. update returns
+    the marginals that became available, which are for consecutive time steps
+    starting at the first one not yet returned; flush returns the rest,
+    smoothed on everything seen, at the end of a stream.
+    '''
+
+    def __init__(self,model,lag,pi_0=None):
+        self.lag = lag
+        super(HMMFixedLagSmoother,self).__init__(model,pi_0)
+
+    def reset(self,pi_0=None):
+        super(HMMFixedLagSmoother,self).reset(pi_0)
+        self.filter = HMMFilter(self.model,pi_0)
+        self._alphans = np.empty((self.lag+1,self.num_states),dtype=self.dtype)
+        self._aBls = np.empty((self.lag+1,self.num_states),dtype=self.dtype)
+
+    def update_loglikes(self,aBl):
+        alphan, _ = self.filter.update_loglikes(aBl)
+
+        out = []
+        for alphan_t, aBl_t in zip(alphan,aBl):
+            self._alphans[self.t % (self.lag+1)] = alphan_t
+            self._aBls[self.t % (self.lag+1)] = aBl_t
+            self.t += 1
+            if self.t > self.lag:
+                out.append(self._smooth(self.t-self.lag-1,self.t)[0])
+
+        return np.array(out).reshape((-1,self.num_states))
+
+    def flush(self):
+        start = max(self.t-self.lag,0)
+        return self._smooth(start,self.t) if self.t > start \
+                else np.empty((0,self.num_states))
+
+    def _window(self,buf,start,stop):
+        return buf[np.arange(start,stop) % (self.lag+1)]
+
+    def _smooth(self,start,stop):
+        # marginals for times start...stop-1 given everything up to stop-1
+        betal = self._states_class._messages_backwards_log(
+                self.trans_matrix,self._window(self._aBls,start,stop))
+        marginals = self._window(self._alphans,start,stop) \
+                * np.exp(betal - betal.max(1)[:,None])
+        return marginals / marginals.sum(1)[:,None]
+
+
+class HMMOnlineViterbi(_OnlineBase):
+    '''
+    Online Viterbi decoding. This runs the max-sum recursion forwards, keeping
+    backpointers for the undecided steps in a ring buffer of length lag. The
+    states up to a time step are decided as soon as the traceback paths from
+    all the current states meet there, and if the paths haven't met after lag
+    steps the oldest undecided state is decided by tracing back from the
+    current best state, which bounds the delay (at the price of exactness).
+    update returns the newly decided states, which follow the ones returned
+    before; flush decides the rest at the end of a stream.
+    '''
+
+    def __init__(self,model,lag,pi_0=None):
+        self.lag = lag
+        super(HMMOnlineViterbi,self).__init__(model,pi_0)
+
+    def reset(self,pi_0=None):
+        super(HMMOnlineViterbi,self).reset(pi_0)
+        errs = np.seterr(divide='ignore')
+        self._Al = np.log(self.trans_matrix)
+        self._scores = np.log(self.pi_0)
+        np.seterr(**errs)
+        self._args = np.empty((self.lag,self.num_states),dtype=np.int32)
+        self.decided = 0 # the first undecided time step
+
+    def update_loglikes(self,aBl):
+        out = []
+        for aBl_t in aBl:
+            if self.t > 0:
+                vals = self._scores[:,None] + self._Al
+                args = self._args[self.t % self.lag] = vals.argmax(0)
+                self._scores = vals[args,np.arange(self.num_states)] + aBl_t
+            else:
+                self._scores = self._scores + aBl_t
+            self._scores -= self._scores.max()
+            self.t += 1
+
+            out.extend(self._decide())
+
+        return np.array(out,dtype=np.int32)
+
+    def flush(self):
+        out = self._traceback(self._scores.argmax(),self.t-1,self.decided)
+        self.decided = self.t
+        return out
+
+    def _traceback(self,state,t,start):
+        # the best path ending in state at time t, for times start...t
+        path = np.empty(t-start+1,dtype=np.int32)
+        path[-1] = state
+        for u in xrange(t,start,-1):
+            path[u-start-1] = state = self._args[u % self.lag][state]
+        return path
+
+    def _decide(self):
+        t = self.t-1
+        states = np.arange(self.num_states)
+        for u in xrange(t,self.decided,-1):
+            states = np.unique(self._args[u % self.lag][states])
+            if len(states) == 1:
+                out = self._traceback(states[0],u-1,self.decided)
+                self.decided = u
+                return out
+
+        if t - self.decided + 1 == self.lag:
+            out = self._traceback(self._scores.argmax(),t,self.decided)[:1]
+            self.decided += 1
+            return out
+
+        return []
+
+
+class HMMOnlineEM(_OnlineBase):
+    '''
+    Online (stepwise) EM, as in Cappe (2011) and Liang and Klein (2009). update
+    takes a chunk of observations and computes its expected statistics given
+    the filtered state distribution at the end of the previous chunk. Those are
+    blended into running statistics with stepsize (num_updates + tau)**-kappa.
+    The model's transition and observation parameters are then set by maximum
+    likelihood from the running statistics. update returns the chunk's
+    incremental log likelihood under the parameters it started with.
+
+    Memory stays constant: the running statistics have a fixed size and only
+    the filtered distribution of the last step is carried between chunks. The
+    observation distributions need to be Gaussian or DiagonalGaussian (see
+    pyhsmm.internals.suffstats). The initial state distribution isn't updated,
+    since a stream only starts once. reset starts over, forgetting the
+    running statistics.
+    '''
+
+    def __init__(self,model,kappa=0.6,tau=1.,pi_0=None):
+        assert 0.5 < kappa <= 1. and tau >= 1.
+        if not suffstats.reducible(model.obs_distns):
+            raise NotImplementedError(
+                'online EM is only implemented for Gaussian '
+                'and DiagonalGaussian observation distributions')
+        self.kappa, self.tau = kappa, tau
+        super(HMMOnlineEM,self).__init__(model,pi_0)
+
+    def reset(self,pi_0=None):
+        super(HMMOnlineEM,self).reset(pi_0)
+        self._in_potential = self.pi_0
+        self.alphan = None
+        self.stats = None
+        self.num_updates = 0
+        self.log_likelihood = 0.
+
+    @property
+    def stepsize(self):
+        return (self.num_updates + self.tau)**(-self.kappa)
+
+    def update(self,obs_chunk):
+        s = self._states_class(model=self.model,data=obs_chunk,generate=False)
+        expected_states, expected_transcounts, loglike = s._expected_statistics(
+                self.trans_matrix,self._in_potential,s.aBl)
+
+        if self.alphan is not None:
+            # the transition into the chunk, given the previous filtered state
+            # and the smoothed first state of the chunk
+            expected_transcounts = expected_transcounts + np.nan_to_num(
+                    self.alphan[:,None] * self.trans_matrix
+                    * (expected_states[0] / self._in_potential)[None,:])
+
+        chunk_stats = dict(
+            obs=[suffstats.weighted_statistics(o,[obs_chunk],[expected_states[:,state]])
+                for state, o in enumerate(self.model.obs_distns)],
+            trans=expected_transcounts)
+        self._blend(chunk_stats)
+        self._M_step()
+
+        # the smoothed distribution of the last step is its filtered one
+        self.alphan = expected_states[-1]
+        self._in_potential = self.trans_matrix.T.dot(self.alphan)
+        self.log_likelihood += loglike
+        self.t += obs_chunk.shape[0]
+
+        return loglike
+
+    def _blend(self,chunk_stats):
+        rho = self.stepsize
+        if self.stats is None:
+            self.stats = chunk_stats
+        else:
+            self.stats = dict(
+                obs=[(1-rho)*a + rho*b for a, b in zip(self.stats['obs'],chunk_stats['obs'])],
+                trans=(1-rho)*self.stats['trans'] + rho*chunk_stats['trans'])
+        self.num_updates += 1
+
+    def _M_step(self):
+        for o, stats in zip(self.model.obs_distns,self.stats['obs']):
+            if suffstats.identifiable(o,stats):
+                suffstats.max_likelihood(o,stats)
+                bump_version(o)
+        self.model.trans_distn.max_likelihood(expected_transcounts=[self.stats['trans']])
+        bump_version(self.model.trans_distn)
+        self.trans_matrix = np.asarray(self.model.trans_distn.trans_matrix,dtype=self.dtype)
@@ -1,17 +1,20 @@
 from __future__ import division
 import numpy as np
 from numpy import newaxis as na
-import abc, copy, warnings
+from scipy import sparse
+import abc, copy, warnings, collections
 import matplotlib.pyplot as plt
 
 import pyhsmm
-from pyhsmm.util.stats import sample_discrete, sample_discrete_from_log
+from pyhsmm.util.stats import sample_discrete, sample_discrete_from_log, \
+        uniform_stream
 try:
     from pyhsmm.util.cstats import sample_markov
 except ImportError:
     from pyhsmm.util.stats import sample_markov
-from pyhsmm.util.general import rle, top_eigenvector, rcumsum, cumsum
+from pyhsmm.util.general import rle, top_eigenvector, rcumsum, cumsum, version, versions
 from pyhsmm.util.profiling import line_profiled
+from pyhsmm.internals import emissions
 
 ######################
 #  Mixins and bases  #
@@ -21,8 +24,9 @@ class _StatesBase(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self,model,T=None,data=None,stateseq=None,
-            generate=True,initialize_from_prior=True):
+            generate=True,initialize_from_prior=True,rng_key=None):
         self.model = model
+        self.rng_key = rng_key
 
         self.T = T if T is not None else data.shape[0]
         self.data = data
@@ -46,19 +50,32 @@ class _StatesBase(object):
 
     _kwargs = {} # used in subclasses for joblib stuff
 
+    # NOTE: when the model sets rng_key, usually to (seed, iteration, sequence
+    # index), the samplers draw from its counter-based stream instead of
+    # np.random (see pyhsmm.util.stats.uniform_stream), so the sampled states
+    # don't depend on how sequences are batched or split over processes
+    rng_key = None
+
     ### model properties
 
+    # NOTE: the model's dtype is used for the likelihoods, message buffers and
+    # the parameters handed to the message passing code
+
+    @property
+    def dtype(self):
+        return self.model.dtype
+
     @property
     def obs_distns(self):
         return self.model.obs_distns
 
     @property
     def trans_matrix(self):
-        return self.model.trans_distn.trans_matrix
+        return np.asarray(self.model.trans_distn.trans_matrix,dtype=self.dtype)
 
     @property
     def pi_0(self):
-        return self.model.init_state_distn.pi_0
+        return np.asarray(self.model.init_state_distn.pi_0,dtype=self.dtype)
 
     @property
     def num_states(self):
@@ -83,28 +100,93 @@ class _StatesBase(object):
     ### messages and likelihoods
 
     # some cached things depends on model parameters, so caches should be
-    # cleared when the model changes (e.g. when parameters are updated)
+    # cleared when the model changes (e.g. when parameters are updated).
+    # clear_stale_caches only drops what depends on parameter objects whose
+    # versions changed (see pyhsmm.util.general.bump_version), and recomputes
+    # just the columns of aBl and mf_aBl for the states whose observation
+    # distributions changed
 
     def clear_caches(self):
         self._aBl = self._mf_aBl = None
         self._normalizer = None
+        self._cache_versions = {}
+
+    def clear_stale_caches(self):
+        current = dict((kind,versions(params))
+                for kind, params in self._parameters.iteritems())
+        recorded = self._cache_versions.get('parameters',{})
+        changed = set(kind for kind in current if recorded.get(kind) != current[kind])
+        self._cache_versions['parameters'] = current
+        if changed:
+            self._clear_stale(changed)
 
     @property
-    def aBl(self):
-        if self._aBl is None:
-            data = self.data
+    def _parameters(self):
+        # the parameter objects cached things can depend on, by kind
+        return dict(obs=self.obs_distns,trans=[self.model.trans_distn],
+                init=[self.model.init_state_distn])
 
-            aBl = self._aBl = np.empty((data.shape[0],self.num_states))
-            for idx, obs_distn in enumerate(self.obs_distns):
-                aBl[:,idx] = obs_distn.log_likelihood(data).ravel()
-            aBl[np.isnan(aBl).any(1)] = 0.
+    def _clear_stale(self,changed):
+        self._normalizer = None
+        if 'obs' in changed:
+            self._aBl = self._update_columns(
+                    '_aBl',emissions.log_likelihoods)
+            self._mf_aBl = self._update_columns(
+                    '_mf_aBl',emissions.expected_log_likelihoods)
+
+    def _update_columns(self,name,fill):
+        arr, recorded = getattr(self,name), self._cache_versions.get(name)
+        if arr is None or recorded is None:
+            return None
+        new = versions(self.obs_distns)
+        stale = [idx for idx, (v1, v2) in enumerate(zip(recorded,new)) if v1 != v2]
+        if len(stale) == len(new):
+            return None
+        if len(stale) > 0:
+            cols = fill([self.obs_distns[idx] for idx in stale],self.data,
+                    np.empty((arr.shape[0],len(stale))))
+            arr[:,stale] = cols
+            arr[np.isnan(cols).any(1)] = 0.
+            self._cache_versions[name] = new
+        return arr
 
+    @property
+    def aBl(self):
+        if self._aBl is None:
+            self._aBl = self._log_likelihoods(self.data)
+            self._cache_versions['_aBl'] = versions(self.obs_distns)
         return self._aBl
 
+    def _log_likelihoods(self,data):
+        aBl = np.empty((data.shape[0],self.num_states),dtype=self.dtype)
+        emissions.log_likelihoods(self.obs_distns,data,aBl)
+        aBl[np.isnan(aBl).any(1)] = 0.
+        return aBl
+
     @abc.abstractmethod
     def log_likelihood(self):
         pass
 
+    ### updates over multiple sequences
+
+    # subclasses can override these to batch the work over all the sequences,
+    # e.g. to dispatch to native code that runs without the GIL
+
+    @classmethod
+    def _E_step_multiple(cls,states_list):
+        for s in states_list:
+            s.E_step()
+
+    @classmethod
+    def _meanfieldupdate_multiple(cls,states_list):
+        for s in states_list:
+            s.meanfieldupdate()
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        for s in states_list:
+            s.Viterbi()
+
 class _SeparateTransMixin(object):
     def __init__(self,group_id,**kwargs):
         assert not isinstance(group_id,np.ndarray)
@@ -119,21 +201,53 @@ class _SeparateTransMixin(object):
 
     @property
     def trans_matrix(self):
-        return self.model.trans_distns[self.group_id].trans_matrix
+        return np.asarray(self.model.trans_distns[self.group_id].trans_matrix,
+                dtype=self.dtype)
+
+    @property
+    def _parameters(self):
+        return dict(super(_SeparateTransMixin,self)._parameters,
+                trans=[self.model.trans_distns[self.group_id]],
+                init=[self.model.init_state_distns[self.group_id]])
 
     @property
     def pi_0(self):
-        return self.model.init_state_distns[self.group_id].pi_0
+        return np.asarray(self.model.init_state_distns[self.group_id].pi_0,
+                dtype=self.dtype)
 
     @property
     def mf_trans_matrix(self):
         return np.maximum(
                 self.model.trans_distns[self.group_id].exp_expected_log_trans_matrix,
-                1e-3)
+                1e-3).astype(self.dtype,copy=False)
 
     @property
     def mf_pi_0(self):
-        return self.model.init_state_distns[self.group_id].exp_expected_log_init_state_distn
+        return np.asarray(
+                self.model.init_state_distns[self.group_id].exp_expected_log_init_state_distn,
+                dtype=self.dtype)
+
+    @staticmethod
+    def _group_by_id(states_list):
+        groups = collections.OrderedDict()
+        for s in states_list:
+            groups.setdefault(s.group_id,[]).append(s)
+        return groups.values()
+
+    @classmethod
+    def _E_step_multiple(cls,states_list):
+        for group in cls._group_by_id(states_list):
+            super(_SeparateTransMixin,cls)._E_step_multiple(group)
+
+    @classmethod
+    def _meanfieldupdate_multiple(cls,states_list):
+        for group in cls._group_by_id(states_list):
+            super(_SeparateTransMixin,cls)._meanfieldupdate_multiple(group)
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        for group in cls._group_by_id(states_list):
+            super(_SeparateTransMixin,cls)._Viterbi_multiple(group)
 
 class _PossibleChangepointsMixin(object):
     def __init__(self,model,data,changepoints=None,**kwargs):
@@ -158,6 +272,11 @@ class _PossibleChangepointsMixin(object):
         self._stateseq = None
         super(_PossibleChangepointsMixin,self).clear_caches()
 
+    def _clear_stale(self,changed):
+        if 'obs' in changed:
+            self._aBBl = self._mf_aBBl = None
+        super(_PossibleChangepointsMixin,self)._clear_stale(changed)
+
     @property
     def Tblock(self):
         return len(self.changepoints)
@@ -190,16 +309,22 @@ class _PossibleChangepointsMixin(object):
     def aBl(self):
         if self._aBBl is None:
             aBl = super(_PossibleChangepointsMixin,self).aBl
-            aBBl = self._aBBl = np.empty((self.Tblock,self.num_states))
+            aBBl = self._aBBl = np.empty((self.Tblock,self.num_states),dtype=self.dtype)
             for idx, (start,stop) in enumerate(self.changepoints):
                 aBBl[idx] = aBl[start:stop].sum(0)
         return self._aBBl
 
+    def _aBl_block(self,start,stop):
+        return self.aBl[start:stop]
+
+    def _mf_aBl_block(self,start,stop):
+        return self.mf_aBl[start:stop]
+
     @property
     def mf_aBl(self):
         if self._mf_aBBl is None:
             aBl = super(_PossibleChangepointsMixin,self).mf_aBl
-            aBBl = self._mf_aBBl = np.empty((self.Tblock,self.num_states))
+            aBBl = self._mf_aBBl = np.empty((self.Tblock,self.num_states),dtype=self.dtype)
             for idx, (start,stop) in enumerate(self.changepoints):
                 aBBl[idx] = aBl[start:stop].sum(0)
         return self._mf_aBBl
@@ -211,11 +336,48 @@ class _PossibleChangepointsMixin(object):
 
     # TODO do generate() and generate_states() actually work?
 
+def _backpointer_dtype(num_states):
+    # the smallest integer type that can hold a state index
+    if num_states <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    elif num_states <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.int32
+
+def _subkey(rng_key,idx):
+    # a stream for a piece of a sequence, e.g. a checkpoint block
+    return rng_key + (idx,) if rng_key is not None else None
+
+def _column(trans_matrix,j):
+    if sparse.issparse(trans_matrix):
+        return trans_matrix[:,j].toarray().ravel()
+    return trans_matrix[:,j]
+
+def _trans_weighted_outer(trans_matrix,a,b):
+    if sparse.issparse(trans_matrix):
+        return trans_matrix.multiply(np.outer(a,b)).toarray()
+    return trans_matrix * np.outer(a,b)
+
 ####################
 #  States classes  #
 ####################
 
 class HMMStatesPython(_StatesBase):
+    '''
+    If checkpoint_interval is set, E_step, meanfieldupdate, resample and
+    log_likelihood keep forward messages only at the boundaries of blocks of
+    that many time steps and recompute the messages inside each block during
+    the backward sweep, along with the block's observation likelihoods. That
+    takes O(T/interval + interval) messages of memory instead of O(T), and
+    about twice the computation; sqrt(T) is a good interval.
+    '''
+
+    def __init__(self,model,checkpoint_interval=None,**kwargs):
+        self.checkpoint_interval = checkpoint_interval
+        if checkpoint_interval is not None:
+            self._kwargs = dict(self._kwargs,checkpoint_interval=checkpoint_interval)
+        super(HMMStatesPython,self).__init__(model,**kwargs)
+
     ### generation
 
     def generate_states(self):
@@ -224,8 +386,9 @@ class HMMStatesPython(_StatesBase):
         A = self.trans_matrix
 
         stateseq = np.zeros(T,dtype=np.int32)
+        randseq = uniform_stream(T,self.rng_key)
         for idx in xrange(T):
-            stateseq[idx] = sample_discrete(nextstate_distn)
+            stateseq[idx] = sample_discrete(nextstate_distn,u=randseq[idx])
             nextstate_distn = A[stateseq[idx]]
 
         self.stateseq = stateseq
@@ -233,9 +396,19 @@ class HMMStatesPython(_StatesBase):
 
     ### message passing
 
+    # NOTE: message passing gets the transition matrix through this property so
+    # that subclasses can hand their kernels another representation of it
+    @property
+    def _messages_trans_matrix(self):
+        return self.trans_matrix
+
     def log_likelihood(self):
         if self._normalizer is None:
-            self.messages_forwards_normalized() # NOTE: sets self._normalizer
+            if self.checkpoint_interval:
+                self._normalizer = self._checkpointed_forwards(
+                        self._messages_trans_matrix,self.pi_0,self._aBl_block)[1]
+            else:
+                self.messages_forwards_normalized() # NOTE: sets self._normalizer
         return self._normalizer
 
     def _messages_log(self,trans_matrix,init_state_distn,log_likelihoods):
@@ -244,7 +417,7 @@ class HMMStatesPython(_StatesBase):
         return alphal, betal
 
     def messages_log(self):
-        return self._messages_log(self.trans_matrix,self.pi_0,self.aBl)
+        return self._messages_log(self._messages_trans_matrix,self.pi_0,self.aBl)
 
     @staticmethod
     def _messages_backwards_log(trans_matrix,log_likelihoods):
@@ -261,7 +434,7 @@ class HMMStatesPython(_StatesBase):
         return betal
 
     def messages_backwards_log(self):
-        betal = self._messages_backwards_log(self.trans_matrix,self.aBl)
+        betal = self._messages_backwards_log(self._messages_trans_matrix,self.aBl)
         assert not np.isnan(betal).any()
         self._normalizer = np.logaddexp.reduce(np.log(self.pi_0) + betal[0] + self.aBl[0])
         return betal
@@ -282,7 +455,7 @@ class HMMStatesPython(_StatesBase):
         return alphal
 
     def messages_forwards_log(self):
-        alphal = self._messages_forwards_log(self.trans_matrix,self.pi_0,self.aBl)
+        alphal = self._messages_forwards_log(self._messages_trans_matrix,self.pi_0,self.aBl)
         assert not np.any(np.isnan(alphal))
         self._normalizer = np.logaddexp.reduce(alphal[-1])
         return alphal
@@ -339,8 +512,8 @@ class HMMStatesPython(_StatesBase):
         return alphan, logtot
 
     def messages_forwards_normalized(self):
-        alphan, self._normalizer = \
-                self._messages_forwards_normalized(self.trans_matrix,self.pi_0,self.aBl)
+        alphan, self._normalizer = self._messages_forwards_normalized(
+                self._messages_trans_matrix,self.pi_0,self.aBl)
         return alphan
 
     ### Gibbs sampling
@@ -354,91 +527,107 @@ class HMMStatesPython(_StatesBase):
         self.sample_backwards_normalized(alphan)
 
     def resample(self):
+        if self.checkpoint_interval:
+            return self.resample_checkpointed()
         return self.resample_normalized()
 
+    def resample_checkpointed(self):
+        self.stateseq, self._normalizer = self._sample_checkpointed(
+                self._messages_trans_matrix,self.pi_0,self._aBl_block)
+
     @staticmethod
-    def _sample_forwards_log(betal,trans_matrix,init_state_distn,log_likelihoods):
+    def _sample_forwards_log(betal,trans_matrix,init_state_distn,log_likelihoods,
+            rng_key=None):
         A = trans_matrix
         aBl = log_likelihoods
         T = aBl.shape[0]
 
         stateseq = np.empty(T,dtype=np.int32)
+        randseq = uniform_stream(T,rng_key)
 
         nextstate_unsmoothed = init_state_distn
         for idx in xrange(T):
             logdomain = betal[idx] + aBl[idx]
             logdomain[nextstate_unsmoothed == 0] = -np.inf
             if np.any(np.isfinite(logdomain)):
-                stateseq[idx] = sample_discrete(nextstate_unsmoothed * np.exp(logdomain - np.amax(logdomain)))
+                stateseq[idx] = sample_discrete(nextstate_unsmoothed * np.exp(logdomain - np.amax(logdomain)),u=randseq[idx])
             else:
-                stateseq[idx] = sample_discrete(nextstate_unsmoothed)
+                stateseq[idx] = sample_discrete(nextstate_unsmoothed,u=randseq[idx])
             nextstate_unsmoothed = A[stateseq[idx]]
 
         return stateseq
 
     def sample_forwards_log(self,betal):
-        self.stateseq = self._sample_forwards_log(betal,self.trans_matrix,self.pi_0,self.aBl)
+        self.stateseq = self._sample_forwards_log(
+                betal,self.trans_matrix,self.pi_0,self.aBl,self.rng_key)
 
     @staticmethod
-    def _sample_forwards_normalized(betan,trans_matrix,init_state_distn,log_likelihoods):
+    def _sample_forwards_normalized(betan,trans_matrix,init_state_distn,log_likelihoods,
+            rng_key=None):
         A = trans_matrix
         aBl = log_likelihoods
         T = aBl.shape[0]
 
         stateseq = np.empty(T,dtype=np.int32)
+        randseq = uniform_stream(T,rng_key)
 
         nextstate_unsmoothed = init_state_distn
         for idx in xrange(T):
             logdomain = aBl[idx]
             logdomain[nextstate_unsmoothed == 0] = -np.inf
-            stateseq[idx] = sample_discrete(nextstate_unsmoothed * betan * np.exp(logdomain - np.amax(logdomain)))
+            stateseq[idx] = sample_discrete(nextstate_unsmoothed * betan * np.exp(logdomain - np.amax(logdomain)),u=randseq[idx])
             nextstate_unsmoothed = A[stateseq[idx]]
 
         return stateseq
 
     def sample_forwards_normalized(self,betan):
         self.stateseq = self._sample_forwards_normalized(
-                betan,self.trans_matrix,self.pi_0,self.aBl)
+                betan,self.trans_matrix,self.pi_0,self.aBl,self.rng_key)
 
     @staticmethod
-    def _sample_backwards_normalized(alphan,trans_matrix_transpose):
+    def _sample_backwards_normalized(alphan,trans_matrix_transpose,rng_key=None):
         AT = trans_matrix_transpose
         T = alphan.shape[0]
 
         stateseq = np.empty(T,dtype=np.int32)
+        randseq = uniform_stream(T,rng_key)
 
         next_potential = np.ones(AT.shape[0])
         for t in xrange(T-1,-1,-1):
-            stateseq[t] = sample_discrete(next_potential * alphan[t])
+            stateseq[t] = sample_discrete(next_potential * alphan[t],u=randseq[t])
             next_potential = AT[stateseq[t]]
 
         return stateseq
 
     def sample_backwards_normalized(self,alphan):
-        self.stateseq = self._sample_backwards_normalized(alphan,self.trans_matrix.T.copy())
+        self.stateseq = self._sample_backwards_normalized(
+                alphan,self._messages_trans_matrix.T.copy(),self.rng_key)
 
     ### Mean Field
 
     @property
     def mf_aBl(self):
         if self._mf_aBl is None:
-            T = self.data.shape[0]
-            self._mf_aBl = aBl = np.empty((T,self.num_states))
-
-            for idx, o in enumerate(self.obs_distns):
-                aBl[:,idx] = o.expected_log_likelihood(self.data).ravel()
-            aBl[np.isnan(aBl).any(1)] = 0.
-
+            self._mf_aBl = self._expected_log_likelihoods(self.data)
+            self._cache_versions['_mf_aBl'] = versions(self.obs_distns)
         return self._mf_aBl
 
+    def _expected_log_likelihoods(self,data):
+        aBl = np.empty((data.shape[0],self.num_states),dtype=self.dtype)
+        emissions.expected_log_likelihoods(self.obs_distns,data,aBl)
+        aBl[np.isnan(aBl).any(1)] = 0.
+        return aBl
+
     @property
     def mf_trans_matrix(self):
-        return self.model.trans_distn.exp_expected_log_trans_matrix
+        return np.asarray(self.model.trans_distn.exp_expected_log_trans_matrix,
+                dtype=self.dtype)
         # return np.maximum(self.model.trans_distn.exp_expected_log_trans_matrix,1e-5)
 
     @property
     def mf_pi_0(self):
-        return self.model.init_state_distn.exp_expected_log_init_state_distn
+        return np.asarray(self.model.init_state_distn.exp_expected_log_init_state_distn,
+                dtype=self.dtype)
 
     @property
     def all_expected_stats(self):
@@ -451,8 +640,12 @@ class HMMStatesPython(_StatesBase):
 
     def meanfieldupdate(self):
         self.clear_caches()
-        self.all_expected_stats = self._expected_statistics(
-                self.mf_trans_matrix,self.mf_pi_0,self.mf_aBl)
+        if self.checkpoint_interval:
+            self.all_expected_stats = self._expected_statistics_checkpointed(
+                    self.mf_trans_matrix,self.mf_pi_0,self._mf_aBl_block)
+        else:
+            self.all_expected_stats = self._expected_statistics(
+                    self.mf_trans_matrix,self.mf_pi_0,self.mf_aBl)
 
     def get_vlb(self):
         if self._normalizer is None:
@@ -490,8 +683,115 @@ class HMMStatesPython(_StatesBase):
 
     def E_step(self):
         self.clear_caches()
-        self.all_expected_stats = self._expected_statistics(
-                self.trans_matrix,self.pi_0,self.aBl)
+        if self.checkpoint_interval:
+            self.all_expected_stats = self._expected_statistics_checkpointed(
+                    self._messages_trans_matrix,self.pi_0,self._aBl_block)
+        else:
+            self.all_expected_stats = self._expected_statistics(
+                    self._messages_trans_matrix,self.pi_0,self.aBl)
+
+    ### checkpointed message passing
+
+    # NOTE: these only ever hold the messages and observation likelihoods for
+    # one block at a time. the blocks' likelihoods are sliced out of aBl if
+    # it's already cached and computed on the fly otherwise.
+
+    def _aBl_block(self,start,stop):
+        if self._aBl is not None:
+            return self._aBl[start:stop]
+        return self._log_likelihoods(self.data[start:stop])
+
+    def _mf_aBl_block(self,start,stop):
+        if self._mf_aBl is not None:
+            return self._mf_aBl[start:stop]
+        return self._expected_log_likelihoods(self.data[start:stop])
+
+    def _blocks(self):
+        starts = range(0,self.T,self.checkpoint_interval)
+        return zip(starts,starts[1:] + [self.T])
+
+    def _checkpointed_forwards(self,trans_matrix,init_state_distn,aBl_block):
+        # returns the incoming potential for each block, which is all we need
+        # to recompute its normalized forward messages, and the normalizer
+        in_potentials, logtot = [], 0.
+        in_potential = init_state_distn
+        for start, stop in self._blocks():
+            in_potentials.append(in_potential)
+            alphan, blocklogtot = self._messages_forwards_normalized(
+                    trans_matrix,in_potential,aBl_block(start,stop))
+            logtot += blocklogtot
+            in_potential = trans_matrix.T.dot(alphan[-1])
+        return in_potentials, logtot
+
+    def _sample_checkpointed(self,trans_matrix,init_state_distn,aBl_block):
+        in_potentials, logtot = self._checkpointed_forwards(
+                trans_matrix,init_state_distn,aBl_block)
+
+        stateseq = np.empty(self.T,dtype=np.int32)
+        next_state = None
+        blocks = list(enumerate(zip(self._blocks(),in_potentials)))
+        for idx, ((start,stop), in_potential) in reversed(blocks):
+            alphan, _ = self._messages_forwards_normalized(
+                    trans_matrix,in_potential,aBl_block(start,stop))
+            if next_state is not None:
+                alphan[-1] *= _column(trans_matrix,next_state)
+            stateseq[start:stop] = self._sample_backwards_normalized(
+                    alphan,trans_matrix.T.copy(),_subkey(self.rng_key,idx))
+            next_state = stateseq[start]
+
+        return stateseq, logtot
+
+    def _expected_statistics_checkpointed(self,trans_potential,init_potential,aBl_block):
+        # forward sweep: keep unscaled log forward messages only at the block
+        # boundaries, as an incoming potential and a log scale
+        checkpoints = []
+        in_potential, offset = init_potential, 0.
+        for start, stop in self._blocks():
+            checkpoints.append((in_potential,offset))
+            alphal = self._messages_forwards_log(
+                    trans_potential,in_potential,aBl_block(start,stop))
+            cmax = alphal[-1].max()
+            in_potential = trans_potential.T.dot(np.exp(alphal[-1] - cmax))
+            offset += cmax
+
+        # backward sweep: recompute each block's messages and collect its
+        # statistics, including the pair that straddles the block boundary
+        expected_states = np.empty((self.T,self.num_states),dtype=self.dtype)
+        expected_transcounts = 0.
+        next_potential = None
+        for (start,stop), (in_potential,offset) in \
+                reversed(zip(self._blocks(),checkpoints)):
+            aBl = aBl_block(start,stop)
+            alphal = self._messages_forwards_log(trans_potential,in_potential,aBl) + offset
+
+            if next_potential is None:
+                betal = self._messages_backwards_log(trans_potential,aBl)
+            else:
+                cmax = next_potential.max()
+                end_betal = np.log(trans_potential.dot(np.exp(next_potential - cmax))) + cmax
+
+                # NOTE: adding the last message into the last likelihoods makes
+                # the kernels' zero last message come out right for the others
+                aBl_end = aBl.copy()
+                aBl_end[-1] += end_betal
+                betal = self._messages_backwards_log(trans_potential,aBl_end)
+                betal[-1] = end_betal
+
+                pair = _trans_weighted_outer(trans_potential,
+                        np.exp(alphal[-1] - alphal[-1].max()),
+                        np.exp(next_potential - cmax))
+                expected_transcounts += pair / pair.sum()
+
+            block_expected_states, block_expected_transcounts, normalizer = \
+                    self._expected_statistics_from_messages(
+                            trans_potential,aBl,alphal,betal)
+            expected_states[start:stop] = block_expected_states
+            expected_transcounts += block_expected_transcounts
+
+            next_potential = betal[0] + aBl[0]
+
+        assert not np.isinf(expected_states).any()
+        return expected_states, expected_transcounts, normalizer
 
     ### Viterbi
 
@@ -525,11 +825,12 @@ class HMMStatesPython(_StatesBase):
         aBl = log_likelihoods
 
         scores = np.zeros_like(aBl)
-        args = np.zeros(aBl.shape,dtype=np.int32)
+        args = np.zeros(aBl.shape,dtype=_backpointer_dtype(aBl.shape[1]))
 
+        vals = np.empty_like(Al)
         for t in xrange(scores.shape[0]-2,-1,-1):
-            vals = Al + scores[t+1] + aBl[t+1]
-            vals.argmax(axis=1,out=args[t+1])
+            np.add(Al,scores[t+1] + aBl[t+1],out=vals)
+            args[t+1] = vals.argmax(axis=1)
             vals.max(axis=1,out=scores[t])
 
         return scores, args
@@ -548,30 +849,101 @@ class HMMStatesPython(_StatesBase):
         return stateseq
 
 class HMMStatesEigen(HMMStatesPython):
+    '''
+    trans_format can be 'sparse' or 'banded' to run the message passing with
+    the transition matrix as a scipy.sparse csr_matrix or dia_matrix, so that
+    it costs O(T*nnz) instead of O(T*N^2). That's a win for models with mostly
+    zero transition matrices, like left-right models with many states.
+
+    If parallel_time_chunks is set, log_likelihood, E_step and resample split
+    the time axis into that many chunks and run the message passing over them
+    in parallel, so that a single long sequence can use all the cores. Each
+    chunk's work is O(T/chunks * N^3) instead of O(T/chunks * N^2), so it's
+    worth it when there are many more cores than states.
+    '''
+
+    def __init__(self,model,trans_format='dense',parallel_time_chunks=None,**kwargs):
+        assert trans_format in ('dense','sparse','banded')
+        assert not parallel_time_chunks or (trans_format == 'dense'
+                and not kwargs.get('checkpoint_interval'))
+        self.trans_format = trans_format
+        self.parallel_time_chunks = parallel_time_chunks
+        if trans_format != 'dense':
+            self._kwargs = dict(self._kwargs,trans_format=trans_format)
+        if parallel_time_chunks is not None:
+            self._kwargs = dict(self._kwargs,parallel_time_chunks=parallel_time_chunks)
+        super(HMMStatesEigen,self).__init__(model,**kwargs)
+
+    @property
+    def _messages_trans_matrix(self):
+        if self.trans_format == 'dense':
+            return self.trans_matrix
+        return self._sparse_operators[0]
+
+    # NOTE: the sparse operator and the transpose the backward sampler needs
+    # are cached on the transition distribution and keyed on its version, so
+    # all the states objects sharing a transition matrix build them once
+
+    @property
+    def _sparse_operators(self):
+        trans_distn = self._parameters['trans'][0]
+        key = (version(trans_distn),self.trans_format,np.dtype(self.dtype))
+        cached = getattr(trans_distn,'_sparse_operators',None)
+        if cached is None or cached[0] != key:
+            if self.trans_format == 'sparse':
+                op = sparse.csr_matrix(self.trans_matrix)
+                cached = (key,op,op.T.tocsr())
+            else:
+                cached = (key,sparse.dia_matrix(self.trans_matrix),None)
+            trans_distn._sparse_operators = cached
+        return cached[1:]
+
     def generate_states(self):
         self.stateseq = sample_markov(
                 T=self.T,
                 trans_matrix=self.trans_matrix,
-                init_state_distn=self.pi_0)
+                init_state_distn=self.pi_0,
+                rng_key=self.rng_key)
 
     ### common messages (Gibbs, EM, likelihood calculation)
 
+    def log_likelihood(self):
+        if self._normalizer is None and self.parallel_time_chunks:
+            self._normalizer = self._parallel_forwards(
+                    self.trans_matrix,self.pi_0,self.aBl)[-1]
+        return super(HMMStatesEigen,self).log_likelihood()
+
+    # NOTE: these also accept the transition matrix as a scipy.sparse matrix
+
     @staticmethod
     def _messages_backwards_log(trans_matrix,log_likelihoods):
-        from hmm_messages_interface import messages_backwards_log
+        from hmm_messages_interface import messages_backwards_log, \
+                messages_backwards_log_sparse
+        if sparse.issparse(trans_matrix):
+            return messages_backwards_log_sparse(
+                    trans_matrix,log_likelihoods,
+                    np.empty_like(log_likelihoods))
         return messages_backwards_log(
                 trans_matrix,log_likelihoods,
                 np.empty_like(log_likelihoods))
 
     @staticmethod
     def _messages_forwards_log(trans_matrix,init_state_distn,log_likelihoods):
-        from hmm_messages_interface import messages_forwards_log
+        from hmm_messages_interface import messages_forwards_log, \
+                messages_forwards_log_sparse
+        if sparse.issparse(trans_matrix):
+            return messages_forwards_log_sparse(trans_matrix,log_likelihoods,
+                    init_state_distn,np.empty_like(log_likelihoods))
         return messages_forwards_log(trans_matrix,log_likelihoods,
                 init_state_distn,np.empty_like(log_likelihoods))
 
     @staticmethod
     def _messages_forwards_normalized(trans_matrix,init_state_distn,log_likelihoods):
-        from hmm_messages_interface import messages_forwards_normalized
+        from hmm_messages_interface import messages_forwards_normalized, \
+                messages_forwards_normalized_sparse
+        if sparse.issparse(trans_matrix):
+            return messages_forwards_normalized_sparse(trans_matrix,log_likelihoods,
+                    init_state_distn,np.empty_like(log_likelihoods))
         return messages_forwards_normalized(trans_matrix,log_likelihoods,
                 init_state_distn,np.empty_like(log_likelihoods))
 
@@ -592,16 +964,36 @@ class HMMStatesEigen(HMMStatesPython):
     ### sampling
 
     @staticmethod
-    def _sample_forwards_log(betal,trans_matrix,init_state_distn,log_likelihoods):
+    def _sample_forwards_log(betal,trans_matrix,init_state_distn,log_likelihoods,
+            rng_key=None):
         from hmm_messages_interface import sample_forwards_log
         return sample_forwards_log(trans_matrix,log_likelihoods,
-                init_state_distn,betal,np.empty(log_likelihoods.shape[0],dtype='int32'))
+                init_state_distn,betal,np.empty(log_likelihoods.shape[0],dtype='int32'),
+                rng_key)
 
     @staticmethod
-    def _sample_backwards_normalized(alphan,trans_matrix_transpose):
-        from hmm_messages_interface import sample_backwards_normalized
+    def _sample_backwards_normalized(alphan,trans_matrix_transpose,rng_key=None):
+        from hmm_messages_interface import sample_backwards_normalized, \
+                sample_backwards_normalized_sparse
+        if sparse.issparse(trans_matrix_transpose):
+            return sample_backwards_normalized_sparse(trans_matrix_transpose.T,alphan,
+                    np.empty(alphan.shape[0],dtype='int32'),rng_key)
         return sample_backwards_normalized(trans_matrix_transpose,alphan,
-                np.empty(alphan.shape[0],dtype='int32'))
+                np.empty(alphan.shape[0],dtype='int32'),rng_key)
+
+    def sample_backwards_normalized(self,alphan):
+        from hmm_messages_interface import sample_backwards_normalized_sparse
+        if self.trans_format == 'dense':
+            return super(HMMStatesEigen,self).sample_backwards_normalized(alphan)
+        trans_matrix, trans_matrix_transpose = self._sparse_operators
+        self.stateseq = sample_backwards_normalized_sparse(trans_matrix,alphan,
+                np.empty(alphan.shape[0],dtype='int32'),self.rng_key,
+                trans_matrix_transpose)
+
+    def resample(self):
+        if self.parallel_time_chunks:
+            return self.resample_parallel()
+        return super(HMMStatesEigen,self).resample()
 
     @staticmethod
     def _resample_multiple(states_list):
@@ -609,31 +1001,189 @@ class HMMStatesEigen(HMMStatesPython):
         if len(states_list) > 0:
             loglikes = resample_normalized_multiple(
                     states_list[0].trans_matrix,states_list[0].pi_0,
-                    [s.aBl for s in states_list],[s.stateseq for s in states_list])
+                    [s.aBl for s in states_list],[s.stateseq for s in states_list],
+                    [s.rng_key for s in states_list])
             for s, loglike in zip(states_list,loglikes):
                 s._normalizer = loglike
 
     ### EM
 
+    @staticmethod
+    def _expected_statistics_multiple(trans_potential,init_potential,
+            likelihood_log_potentials):
+        from hmm_messages_interface import expected_statistics_multiple
+        expected_states_list, expected_transcounts_list, normalizers = \
+                expected_statistics_multiple(trans_potential,init_potential,
+                        likelihood_log_potentials)
+        return zip(expected_states_list,expected_transcounts_list,normalizers)
+
+    def E_step(self):
+        if self.parallel_time_chunks:
+            self.clear_caches()
+            self.all_expected_stats = self._expected_statistics_parallel(
+                    self.trans_matrix,self.pi_0,self.aBl)
+        else:
+            super(HMMStatesEigen,self).E_step()
+
+    @classmethod
+    def _E_step_multiple(cls,states_list):
+        if len(states_list) > 0 and (states_list[0].trans_format != 'dense'
+                or states_list[0].checkpoint_interval
+                or states_list[0].parallel_time_chunks):
+            super(HMMStatesEigen,cls)._E_step_multiple(states_list)
+        elif len(states_list) > 0:
+            for s in states_list:
+                s.clear_caches()
+            allstats = cls._expected_statistics_multiple(
+                    states_list[0].trans_matrix,states_list[0].pi_0,
+                    [s.aBl for s in states_list])
+            for s, stats in zip(states_list,allstats):
+                s.all_expected_stats = stats
+
+    @classmethod
+    def _meanfieldupdate_multiple(cls,states_list):
+        if len(states_list) > 0 and states_list[0].checkpoint_interval:
+            super(HMMStatesEigen,cls)._meanfieldupdate_multiple(states_list)
+        elif len(states_list) > 0:
+            for s in states_list:
+                s.clear_caches()
+            allstats = cls._expected_statistics_multiple(
+                    states_list[0].mf_trans_matrix,states_list[0].mf_pi_0,
+                    [s.mf_aBl for s in states_list])
+            for s, stats in zip(states_list,allstats):
+                s.all_expected_stats = stats
+
+    def _expected_statistics(self,trans_potential,init_potential,likelihood_log_potential):
+        from hmm_messages_interface import expected_statistics
+        if sparse.issparse(trans_potential):
+            return super(HMMStatesEigen,self)._expected_statistics(
+                    trans_potential,init_potential,likelihood_log_potential)
+        return expected_statistics(trans_potential,init_potential,likelihood_log_potential,
+                np.empty_like(likelihood_log_potential),np.empty_like(trans_potential))
+
     @staticmethod
     def _expected_statistics_from_messages(
             trans_potential,likelihood_log_potential,alphal,betal,
             expected_states=None,expected_transcounts=None):
-        from hmm_messages_interface import expected_statistics_log
+        from hmm_messages_interface import expected_statistics_log, \
+                expected_statistics_log_sparse
         expected_states = np.zeros_like(alphal) \
                 if expected_states is None else expected_states
+        if sparse.issparse(trans_potential):
+            expected_states, sparse_transcounts, normalizer = \
+                    expected_statistics_log_sparse(
+                            trans_potential,likelihood_log_potential,alphal,betal,
+                            expected_states)
+            if expected_transcounts is not None:
+                sparse_transcounts += expected_transcounts
+            return expected_states, sparse_transcounts, normalizer
         expected_transcounts = np.zeros_like(trans_potential) \
                 if expected_transcounts is None else expected_transcounts
         return expected_statistics_log(
                 np.log(trans_potential),likelihood_log_potential,alphal,betal,
                 expected_states,expected_transcounts)
 
+    ### parallel-in-time message passing
+
+    # NOTE: the chunks' transfer matrices are computed in parallel and combined
+    # here to get each chunk's incoming forward potential and outgoing backward
+    # potential, then the chunks' messages are filled in in parallel. see the
+    # notes in hmm_messages.h.
+
+    def _time_chunks(self):
+        bounds = np.unique(np.linspace(0,self.T,self.parallel_time_chunks+1).astype('int32'))
+        return bounds[:-1], bounds[1:]
+
+    def _parallel_forwards(self,trans_matrix,init_state_distn,log_likelihoods):
+        from hmm_messages_interface import chunk_transfers
+        starts, stops = self._time_chunks()
+        transfers, logscales = chunk_transfers(trans_matrix,log_likelihoods,starts,stops)
+
+        # in_potentials are the forward potentials coming into each chunk and
+        # alphans are the filtered marginals at the end of each chunk
+        in_potentials = np.empty((len(starts),trans_matrix.shape[0]),dtype=trans_matrix.dtype)
+        alphans = np.empty_like(in_potentials)
+        in_potential, logtot = init_state_distn, 0.
+        for c, (transfer, logscale) in enumerate(zip(transfers,logscales)):
+            in_potentials[c] = in_potential
+            alphan = in_potential.dot(transfer)
+            norm = alphan.sum()
+            if norm == 0 or np.isinf(logscale):
+                return starts, stops, transfers, in_potentials, alphans, -np.inf
+            alphans[c] = alphan / norm
+            logtot += np.log(norm) + logscale
+            in_potential = alphans[c].dot(trans_matrix)
+
+        return starts, stops, transfers, in_potentials, alphans, logtot
+
+    def _expected_statistics_parallel(self,trans_potential,init_potential,
+            likelihood_log_potential):
+        from hmm_messages_interface import expected_statistics_chunks
+        starts, stops, transfers, in_potentials, alphans, normalizer = \
+                self._parallel_forwards(trans_potential,init_potential,
+                        likelihood_log_potential)
+
+        # out_potentials are the backward messages at the end of each chunk,
+        # and the transitions between chunks are counted here
+        out_potentials = np.ones_like(in_potentials)
+        expected_transcounts = np.zeros_like(trans_potential)
+        for c in xrange(len(starts)-1,0,-1):
+            likes = transfers[c].dot(out_potentials[c])
+            pair = trans_potential * np.outer(alphans[c-1],likes)
+            expected_transcounts += pair / pair.sum()
+            out_potential = trans_potential.dot(likes)
+            out_potentials[c-1] = out_potential / out_potential.max()
+
+        expected_states, chunk_transcounts = expected_statistics_chunks(
+                trans_potential,likelihood_log_potential,starts,stops,
+                in_potentials,out_potentials,np.empty_like(likelihood_log_potential))
+        expected_transcounts += chunk_transcounts.sum(0)
+
+        return expected_states, expected_transcounts, normalizer
+
+    def resample_parallel(self):
+        from hmm_messages_interface import sample_chunks
+        trans_matrix = self.trans_matrix
+        starts, stops, transfers, in_potentials, alphans, self._normalizer = \
+                self._parallel_forwards(trans_matrix,self.pi_0,self.aBl)
+
+        # sample the states at the ends of the chunks, then fill in the chunks
+        # (the boundary draws come after the chunks' draws in the stream)
+        randseq = uniform_stream(len(starts),self.rng_key,offset=self.T)
+        stateseq = np.empty(self.T,dtype='int32')
+        stateseq[-1] = sample_discrete(alphans[-1],u=randseq[-1])
+        for c in xrange(len(starts)-2,-1,-1):
+            stateseq[stops[c]-1] = sample_discrete(
+                    alphans[c] * trans_matrix.dot(transfers[c+1][:,stateseq[stops[c+1]-1]]),
+                    u=randseq[c])
+
+        self.stateseq = sample_chunks(trans_matrix,self.aBl,starts,stops,
+                in_potentials,stateseq,self.rng_key)
+
     ### Vitberbi
 
     def Viterbi(self):
-        from hmm_messages_interface import viterbi
-        self.stateseq = viterbi(self.trans_matrix,self.aBl,self.pi_0,
-                np.empty(self.aBl.shape[0],dtype='int32'))
+        from hmm_messages_interface import viterbi, viterbi_sparse
+        trans_matrix = self._messages_trans_matrix
+        if sparse.issparse(trans_matrix):
+            self.stateseq = viterbi_sparse(trans_matrix,self.aBl,self.pi_0,
+                    np.empty(self.aBl.shape[0],dtype='int32'))
+        else:
+            self.stateseq = viterbi(trans_matrix,self.aBl,self.pi_0,
+                    np.empty(self.aBl.shape[0],dtype='int32'))
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        from hmm_messages_interface import viterbi_multiple
+        if len(states_list) > 0 and states_list[0].trans_format != 'dense':
+            super(HMMStatesEigen,cls)._Viterbi_multiple(states_list)
+        elif len(states_list) > 0:
+            stateseqs = viterbi_multiple(
+                    states_list[0].trans_matrix,states_list[0].pi_0,
+                    [s.aBl for s in states_list],
+                    [np.empty(s.aBl.shape[0],dtype='int32') for s in states_list])
+            for s, stateseq in zip(states_list,stateseqs):
+                s.stateseq = stateseq
 
 class HMMStatesEigenSeparateTrans(_SeparateTransMixin,HMMStatesEigen):
     pass
@@ -46,7 +46,7 @@ class _HSMMStatesIntegerNegativeBinomialBase(HSMMStatesEigen, HMMStatesEigen):
         if not self.left_censoring:
             rs = self.rs
             starts = np.concatenate(((0,),rs.cumsum()[:-1]))
-            pi_0 = np.zeros(rs.sum())
+            pi_0 = np.zeros(rs.sum(),dtype=self.dtype)
             pi_0[starts] = self.pi_0
             return pi_0
         else:
@@ -56,6 +56,11 @@ class _HSMMStatesIntegerNegativeBinomialBase(HSMMStatesEigen, HMMStatesEigen):
         super(_HSMMStatesIntegerNegativeBinomialBase,self).clear_caches()
         self._hmm_aBl = None
 
+    def _clear_stale(self,changed):
+        super(_HSMMStatesIntegerNegativeBinomialBase,self)._clear_stale(changed)
+        if changed & set(['obs','dur']):
+            self._hmm_aBl = None
+
     def _map_states(self):
         themap = np.arange(self.num_states).repeat(self.rs).astype('int32')
         self.stateseq = themap[self.stateseq]
@@ -63,7 +68,7 @@ class _HSMMStatesIntegerNegativeBinomialBase(HSMMStatesEigen, HMMStatesEigen):
     def generate_states(self):
         self.stateseq = sample_markov(
                 T=self.T,trans_matrix=self.hmm_trans_matrix,
-                init_state_distn=self.hmm_pi_0)
+                init_state_distn=self.hmm_pi_0,rng_key=self.rng_key)
         self._map_states()
 
     def Viterbi_hmm(self):
@@ -78,7 +83,7 @@ class _HSMMStatesIntegerNegativeBinomialBase(HSMMStatesEigen, HMMStatesEigen):
                 HMMStatesEigen._messages_forwards_normalized(
                         self.hmm_trans_matrix,self.hmm_pi_0,self.hmm_aBl)
         self.stateseq = HMMStatesEigen._sample_backwards_normalized(
-                alphan,self.hmm_trans_matrix.T.copy())
+                alphan,self.hmm_trans_matrix.T.copy(),self.rng_key)
         self._map_states()
 
         self.alphan = alphan  # TODO remove
@@ -107,7 +112,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
     def hmm_bwd_trans_matrix(self):
         rs, ps = self.rs, self.ps
         starts, ends = cumsum(rs,strict=True), cumsum(rs,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         enters = self.bwd_enter_rows
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
@@ -128,7 +133,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
     def hmm_fwd_trans_matrix(self):
         rs, ps = self.rs, self.ps
         starts, ends = cumsum(rs,strict=True), cumsum(rs,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         exits = self.fwd_exit_cols
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
@@ -192,7 +197,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
 
         self.expected_states = np.zeros((self.T,self.num_states))
         self.expected_transcounts = np.zeros((self.num_states,self.num_states))
-        self.expected_durations = np.zeros((self.num_states,self.T))
+        self.expected_durations = np.zeros((self.T,self.num_states))
 
         eye = np.eye(self.num_states)/num_r_samples
         for i in xrange(num_r_samples):
@@ -206,7 +211,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
                 count_transitions(self.stateseq_norep,minlength=self.num_states)\
                 / num_r_samples
             for state in xrange(self.num_states):
-                self.expected_durations[state] += \
+                self.expected_durations[:,state] += \
                     np.bincount(
                             self.durations_censored[self.stateseq_norep == state],
                             minlength=self.T)[:self.T].astype(np.double)/num_r_samples
@@ -220,7 +225,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
 
         self.expected_states = np.zeros((self.T,self.num_states))
         self.expected_transcounts = np.zeros((self.num_states,self.num_states))
-        self.expected_durations = np.zeros((self.num_states,self.T))
+        self.expected_durations = np.zeros((self.T,self.num_states))
 
         mf_aBl = self.mf_aBl
 
@@ -250,7 +255,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
             for j in xrange(num_stateseq_samples_per_r):
                 self._resample_from_mf(trans,init,aBl,hmm_alphal,hmm_betal)
                 for state in xrange(self.num_states):
-                    self.expected_durations[state] += \
+                    self.expected_durations[:,state] += \
                         np.bincount(
                                 self.durations_censored[self.stateseq_norep == state],
                                 minlength=self.T)[:self.T].astype(np.double) \
@@ -271,14 +276,14 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
 
     def _resample_from_mf(self,trans,init,aBl,hmm_alphal,hmm_betal):
         self.stateseq = HMMStatesEigen._sample_forwards_log(
-                hmm_betal,trans,init,aBl)
+                hmm_betal,trans,init,aBl,self.rng_key)
         self._map_states()
 
     @property
     def hmm_mf_bwd_pi_0(self):
         rs = self.rs
         starts = np.concatenate(((0,),rs.cumsum()[:-1]))
-        mf_pi_0 = np.zeros(rs.sum())
+        mf_pi_0 = np.zeros(rs.sum(),dtype=self.dtype)
         mf_pi_0[starts] = self.mf_pi_0
         return mf_pi_0
 
@@ -286,7 +291,7 @@ class HSMMStatesIntegerNegativeBinomial(_HSMMStatesIntegerNegativeBinomialBase):
     def mf_bwd_trans_matrix(self):
         rs = self.rs
         starts, ends = cumsum(rs,strict=True), cumsum(rs,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         Elnps, Eln1mps = zip(*[d._fixedr_distns[d.ridx]._mf_expected_statistics() for d in self.dur_distns])
         Eps, E1mps = np.exp(Elnps), np.exp(Eln1mps) # NOTE: actually exp(E[ln(p)]) etc
@@ -320,7 +325,7 @@ class HSMMStatesIntegerNegativeBinomialVariant(_HSMMStatesIntegerNegativeBinomia
     def hmm_bwd_trans_matrix(self):
         rs, ps = self.rs, self.ps
         starts, ends = cumsum(rs,strict=True), cumsum(rs,strict=False)
-        trans_matrix = np.zeros((rs.sum(),rs.sum()))
+        trans_matrix = np.zeros((rs.sum(),rs.sum()),dtype=self.dtype)
 
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
             block = trans_matrix[starts[i]:ends[i],starts[j]:ends[j]]
@@ -349,7 +354,7 @@ class HSMMStatesDelayedIntegerNegativeBinomial(HSMMStatesIntegerNegativeBinomial
     def hmm_trans_matrix_orig(self):
         rs, ps, delays = self.rs, self.ps, self.delays
         starts, ends = cumsum(rs+delays,strict=True), cumsum(rs+delays,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         enters = self.bwd_enter_rows
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
@@ -374,7 +379,7 @@ class HSMMStatesDelayedIntegerNegativeBinomial(HSMMStatesIntegerNegativeBinomial
     def hmm_trans_matrix_1(self):
         rs, ps, delays = self.rs, self.ps, self.delays
         starts, ends = cumsum(rs+delays,strict=True), cumsum(rs+delays,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         enters = self.bwd_enter_rows
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
@@ -396,7 +401,7 @@ class HSMMStatesDelayedIntegerNegativeBinomial(HSMMStatesIntegerNegativeBinomial
     def hmm_trans_matrix_2(self):
         rs, ps, delays = self.rs, self.ps, self.delays
         starts, ends = cumsum(rs+delays,strict=True), cumsum(rs+delays,strict=False)
-        trans_matrix = np.zeros((ends[-1],ends[-1]))
+        trans_matrix = np.zeros((ends[-1],ends[-1]),dtype=self.dtype)
 
         enters = self.bwd_enter_rows
         for (i,j), Aij in np.ndenumerate(self.trans_matrix):
@@ -427,7 +432,7 @@ class HSMMStatesDelayedIntegerNegativeBinomial(HSMMStatesIntegerNegativeBinomial
         else:
             rs, delays = self.rs, self.delays
             starts = np.concatenate(((0,),(rs+delays).cumsum()[:-1]))
-            pi_0 = np.zeros((rs+delays).sum())
+            pi_0 = np.zeros((rs+delays).sum(),dtype=self.dtype)
             pi_0[starts] = self.pi_0
             return pi_0
 
@@ -53,7 +53,9 @@ namespace hsmm
                     ((ebetastarl.row(t) - maxes).exp() + (result - maxes).exp()).log() + maxes;
             }
             if (right_censoring && T-t-1 < trunc) {
-                result = eaBl.block(t,0,T-t,M).colwise().sum() + eaDsl.row(T-1-t);
+                // NOTE: the loop above summed all of aBl[t:], so sumsofar is
+                // the cumulative potential of the censored segment
+                result = sumsofar + eaDsl.row(T-1-t);
                 maxes = ebetastarl.row(t).cwiseMax(result);
                 ebetastarl.row(t) =
                     ((ebetastarl.row(t) - maxes).exp() + (result - maxes).exp()).log() + maxes;
@@ -77,11 +79,12 @@ namespace hsmm
     }
 
     template <typename Type>
-    void messages_forwards_log(
+    Type messages_forwards_log(
         int M, int T, Type *A, Type *aBl, Type *aDl, Type *aDsl, Type *pil,
-        Type *alphal, Type *alphastarl)
+        Type *alphal, Type *alphastarl, int right_censoring, int trunc)
     {
-        // TODO trunc, censoring
+        // returns the log likelihood, with the duration of the last segment
+        // censored if right_censoring (matching messages_backwards_log)
 
         NPMatrix<Type> eA(A,M,M);
         NPArray<Type> eaBl(aBl,T,M);
@@ -96,6 +99,7 @@ namespace hsmm
         Array<Type,1,Dynamic> sumsofar(M);
         Array<Type,1,Dynamic> result(M);
         Array<Type,1,Dynamic> maxes(M);
+        Array<Type,1,Dynamic> ends(M);
 #else
         Type sumsofar_buf[M] __attribute__((aligned(16)));
         NPRowVectorArray<Type> sumsofar(sumsofar_buf,M);
@@ -103,19 +107,287 @@ namespace hsmm
         NPRowVectorArray<Type> result(result_buf,M);
         Type maxes_buf[M] __attribute__((aligned(16)));
         NPRowVectorArray<Type> maxes(maxes_buf,M);
+        Type ends_buf[M] __attribute__((aligned(16)));
+        NPRowVectorArray<Type> ends(ends_buf,M);
 #endif
 
-        // TODO
+        // NOTE: each alphal row is a log-sum-exp over the segment durations,
+        // done in two passes (one for the maxes, one for the sums) so there's
+        // one exp per term; the selects keep rows of -infs from becoming nans
 
+        const Type ninf = -1.0*numeric_limits<Type>::infinity();
+        Type cmax;
+        ealphastarl.row(0) = epil;
+        for(int t=0; t<T; t++) {
+            sumsofar.setZero();
+            maxes.setConstant(ninf);
+            for(int tau=0; tau < min(trunc,t+1); tau++) {
+                sumsofar += eaBl.row(t-tau);
+                maxes = maxes.cwiseMax(ealphastarl.row(t-tau) + sumsofar + eaDl.row(tau));
+            }
+            sumsofar.setZero();
+            result.setZero();
+            for(int tau=0; tau < min(trunc,t+1); tau++) {
+                sumsofar += eaBl.row(t-tau);
+                result += (ealphastarl.row(t-tau) + sumsofar + eaDl.row(tau) - maxes).exp();
+            }
+            ealphal.row(t) = (maxes == ninf).select(maxes,result.log() + maxes);
+
+            if (likely(t < T-1)) {
+                cmax = ealphal.row(t).maxCoeff();
+                if (cmax == ninf) {
+                    ealphastarl.row(t+1).setConstant(ninf);
+                } else {
+                    ealphastarl.row(t+1) = ((ealphal.row(t) - cmax).exp().matrix() * eA
+                            ).array().log() + cmax;
+                }
+            }
+        }
+
+        ends = ealphal.row(T-1);
+        if (right_censoring) {
+            sumsofar.setZero();
+            for(int tau=0; tau < min(trunc,T); tau++) {
+                sumsofar += eaBl.row(T-1-tau);
+                result = ealphastarl.row(T-1-tau) + sumsofar + eaDsl.row(tau);
+                maxes = ends.cwiseMax(result);
+                ends = (maxes == ninf).select(maxes,
+                    ((ends - maxes).exp() + (result - maxes).exp()).log() + maxes);
+            }
+        }
+
+        cmax = ends.maxCoeff();
+        if (cmax == ninf) {
+            return ninf;
+        }
+        return log((ends - cmax).exp().sum()) + cmax;
+    }
+
+    inline double expected_statistics_log(
+        int M, int T, double *A, double *aBl, double *aDl, double *aDsl, double *pil,
+        int right_censoring, int trunc,
+        double *expected_states, double *expected_transcounts, double *expected_durations)
+    {
+        // NOTE: this is the whole E step: the messages are passed both ways
+        // (into temporaries, so batched callers only need buffers for the
+        // sequences currently being processed) and then combined into the
+        // expected states (T x M), the expected transition counts (M x M) and
+        // the expected durations (min(trunc,T) x M, column i being the expected
+        // histogram of the durations of the segments in state i that end
+        // before T, as in HSMMStatesPython._expected_durations), all in
+        // O(T*trunc*M) time. it returns the log likelihood. the expected states
+        // aren't clipped or renormalized here, so that callers can check them.
+
+        Array<double,Dynamic,Dynamic,RowMajor> alphal(T,M), alphastarl(T,M),
+            betal(T,M), betastarl(T,M);
+
+        double normalizer = messages_forwards_log(M,T,A,aBl,aDl,aDsl,pil,
+                alphal.data(),alphastarl.data(),right_censoring,trunc);
+        messages_backwards_log(M,T,A,aBl,aDl,aDsl,
+                betal.data(),betastarl.data(),right_censoring,trunc);
+
+        NPMatrix<double> eA(A,M,M);
+        NPArray<double> eaBl(aBl,T,M);
+        NPArray<double> eaDl(aDl,T,M);
+        NPArray<double> eexpected_states(expected_states,T,M);
+        NPArray<double> eexpected_transcounts(expected_transcounts,M,M);
+        const int D = min(trunc,T);
+        NPArray<double> eexpected_durations(expected_durations,D,M);
+
+        const double ninf = -1.0*numeric_limits<double>::infinity();
+        if (unlikely(normalizer == ninf)) {
+            eexpected_states.setZero();
+            eexpected_transcounts.setZero();
+            eexpected_durations.setZero();
+            return normalizer;
+        }
+
+        // expected states, from the probabilities of segments starting at t
+        // (gammastar) and ending at t (gamma)
+        Array<double,1,Dynamic> running = Array<double,1,Dynamic>::Zero(M);
+        for (int t=0; t<T; t++) {
+            running += (alphastarl.row(t) + betastarl.row(t) - normalizer).exp();
+            eexpected_states.row(t) = running;
+            running -= (alphal.row(t) + betal.row(t) - normalizer).exp();
+        }
+
+        eexpected_transcounts.setZero();
+        Matrix<double,Dynamic,1> ea(M);
+        Matrix<double,1,Dynamic> eb(M);
+        double amax, bmax;
+        for (int t=0; t<T-1; t++) {
+            amax = alphal.row(t).maxCoeff();
+            bmax = betastarl.row(t+1).maxCoeff();
+            if (amax == ninf || bmax == ninf) {
+                continue;
+            }
+            ea = (alphal.row(t) - amax).exp().matrix().transpose();
+            eb = (betastarl.row(t+1) - bmax).exp().matrix();
+            eexpected_transcounts += (ea * eb).array() * eA.array()
+                * exp(amax + bmax - normalizer);
+        }
+
+        // expected durations, summing over the segments starting at each t
+        eexpected_durations.setZero();
+        Array<double,1,Dynamic> sumsofar(M);
+        for (int t=0; t<T; t++) {
+            sumsofar = alphastarl.row(t) - normalizer;
+            for (int tau=0; tau < min(D,T-t); tau++) {
+                sumsofar += eaBl.row(t+tau);
+                eexpected_durations.row(tau) +=
+                    (sumsofar + eaDl.row(tau) + betal.row(t+tau)).exp();
+            }
+        }
+
+        return normalizer;
+    }
+
+    template <typename Type>
+    double expected_statistics_log(
+        int M, int T, Type *A, Type *aBl, Type *aDl, Type *aDsl, Type *pil,
+        int right_censoring, int trunc,
+        Type *expected_states, Type *expected_transcounts, Type *expected_durations)
+    {
+        // NOTE: the log messages aren't normalized, so over long sequences
+        // single precision can't resolve the differences the expected states
+        // are computed from. the inputs are promoted and the whole E step is
+        // run in double; only the results are stored as Type.
+
+        const int D = min(trunc,T);
+        Array<double,Dynamic,Dynamic,RowMajor> dA = NPArray<Type>(A,M,M).template cast<double>();
+        Array<double,Dynamic,Dynamic,RowMajor> daBl = NPArray<Type>(aBl,T,M).template cast<double>();
+        Array<double,Dynamic,Dynamic,RowMajor> daDl = NPArray<Type>(aDl,T,M).template cast<double>();
+        Array<double,Dynamic,Dynamic,RowMajor> daDsl = NPArray<Type>(aDsl,T,M).template cast<double>();
+        Array<double,1,Dynamic> dpil = NPRowVectorArray<Type>(pil,M).template cast<double>();
+
+        Array<double,Dynamic,Dynamic,RowMajor> dexpected_states(T,M),
+            dexpected_transcounts(M,M), dexpected_durations(D,M);
+
+        double normalizer = expected_statistics_log(M,T,dA.data(),daBl.data(),
+                daDl.data(),daDsl.data(),dpil.data(),right_censoring,trunc,
+                dexpected_states.data(),dexpected_transcounts.data(),
+                dexpected_durations.data());
+
+        NPArray<Type>(expected_states,T,M) = dexpected_states.template cast<Type>();
+        NPArray<Type>(expected_transcounts,M,M) = dexpected_transcounts.template cast<Type>();
+        NPArray<Type>(expected_durations,D,M) = dexpected_durations.template cast<Type>();
+
+        return normalizer;
+    }
+
+    // Viterbi
+
+    template <typename FloatType, typename IntType, typename BackType>
+    FloatType viterbi_backpointers(
+        int M, int T, FloatType *A, FloatType *pil, FloatType *aBl,
+        FloatType *aDl, FloatType *aDsl, int right_censoring, int trunc,
+        IntType *stateseq)
+    {
+        // NOTE: this is the max-sum version of messages_backwards_log, keeping
+        // a duration backpointer for each (t,state) where a segment can start
+        // and a next state backpointer for each (t,state) where one can end.
+        // a censored last segment gets the same duration backpointer as the
+        // uncensored one running to the end. it returns the log score of the
+        // maximizing assignment.
+
+        NPArray<FloatType> eaBl(aBl,T,M);
+        NPArray<FloatType> eaDl(aDl,T,M);
+        NPArray<FloatType> eaDsl(aDsl,T,M);
+
+        Array<FloatType,Dynamic,Dynamic,RowMajor> scores(T,M), starscores(T,M);
+        Array<BackType,Dynamic,Dynamic,RowMajor> durargs(T,M), stateargs(T,M);
+        Array<FloatType,Dynamic,Dynamic,RowMajor> eAlT(M,M);
+        Array<FloatType,1,Dynamic> sumsofar(M), vals(M);
+
+        eAlT = NPMatrix<FloatType>(A,M,M).transpose().array().log();
+
+        const FloatType ninf = -1.0*numeric_limits<FloatType>::infinity();
+        scores.row(T-1).setZero();
+        for (int t=T-1; t>=0; t--) {
+            BackType *targs = &durargs(t,0);
+            starscores.row(t).setConstant(ninf);
+            for (int i=0; i<M; i++) { targs[i] = 0; }
+
+            sumsofar.setZero();
+            for (int tau=0; tau < min(trunc,T-t); tau++) {
+                sumsofar += eaBl.row(t+tau);
+                vals = scores.row(t+tau) + sumsofar + eaDl.row(tau);
+                for (int i=0; i<M; i++) {
+                    if (vals(i) > starscores(t,i)) {
+                        starscores(t,i) = vals(i);
+                        targs[i] = tau;
+                    }
+                }
+            }
+            if (right_censoring && T-t-1 < trunc) {
+                // NOTE: as in messages_backwards_log, sumsofar covers aBl[t:]
+                vals = sumsofar + eaDsl.row(T-1-t);
+                for (int i=0; i<M; i++) {
+                    if (vals(i) > starscores(t,i)) {
+                        starscores(t,i) = vals(i);
+                        targs[i] = T-t-1;
+                    }
+                }
+            }
+
+            // NOTE: same loop order as hmm::viterbi_backpointers
+            if (likely(t > 0)) {
+                BackType *sargs = &stateargs(t-1,0);
+                scores.row(t-1) = eAlT.row(0) + starscores(t,0);
+                for (int i=0; i<M; i++) { sargs[i] = 0; }
+                for (int j=1; j<M; j++) {
+                    FloatType nextscore = starscores(t,j);
+                    FloatType *col = &eAlT(j,0);
+                    for (int i=0; i<M; i++) {
+                        FloatType val = col[i] + nextscore;
+                        if (val > scores(t-1,i)) {
+                            scores(t-1,i) = val;
+                            sargs[i] = j;
+                        }
+                    }
+                }
+            }
+        }
+
+        int state;
+        FloatType score = (starscores.row(0) + NPRowVectorArray<FloatType>(pil,M)).maxCoeff(&state);
+        for (int t=0; t<T;) {
+            int dur = durargs(t,state) + 1;
+            for (int tau=0; tau<dur; tau++) { stateseq[t+tau] = state; }
+            t += dur;
+            if (t < T) {
+                state = stateargs(t-1,state);
+            }
+        }
+        return score;
+    }
+
+    template <typename FloatType, typename IntType>
+    FloatType viterbi(
+        int M, int T, FloatType *A, FloatType *pil, FloatType *aBl,
+        FloatType *aDl, FloatType *aDsl, int right_censoring, int trunc,
+        IntType *stateseq)
+    {
+        // NOTE: the backpointers are most of the memory for long sequences, so
+        // they're int16 when both the states and the durations fit
+        if (max(M,min(trunc,T)) <= 32767) {
+            return viterbi_backpointers<FloatType,IntType,int16_t>(
+                    M,T,A,pil,aBl,aDl,aDsl,right_censoring,trunc,stateseq);
+        } else {
+            return viterbi_backpointers<FloatType,IntType,int32_t>(
+                    M,T,A,pil,aBl,aDl,aDsl,right_censoring,trunc,stateseq);
+        }
     }
 
     template <typename FloatType, typename IntType>
     void sample_forwards_log(
-        int M, int T, FloatType *A, FloatType *pi0, FloatType *caBl, FloatType *aDl,
+        int M, int T, FloatType *A, FloatType *pi0, double *caBl, FloatType *aDl,
         FloatType *betal, FloatType *betastarl, IntType *stateseq, FloatType *randseq)
     {
+        // NOTE: caBl has T+1 rows, row t being the sum of aBl[:t]. it's double
+        // even for float32 messages, and only the differences are cast down
         NPArray<FloatType> eA(A,M,M);
-        NPArray<FloatType> ecaBl(caBl,T,M);
+        NPArray<double> ecaBl(caBl,T+1,M);
         NPArray<FloatType> eaDl(aDl,T,M);
         NPArray<FloatType> ebetal(betal,T,M);
         NPArray<FloatType> ebetastarl(betastarl,T,M);
@@ -156,7 +428,7 @@ namespace hsmm
                 if (0.0 == p_d_prior) {
                     continue;
                 }
-                p_d = p_d_prior * exp(ecaBl(t+dur+1,state) - ecaBl(t,state)
+                p_d = p_d_prior * exp((FloatType) (ecaBl(t+dur+1,state) - ecaBl(t,state))
                             + ebetal(t+dur,state) - ebetastarl(t,state));
                 durprob -= p_d;
             }
@@ -183,11 +455,32 @@ class hsmmc
     { hsmm::messages_backwards_log(M,T,A,aBl,aDl,aDsl,betal,betastarl,
             right_censoring,trunc); }
 
+    static FloatType messages_forwards_log(
+        int M, int T, FloatType *A, FloatType *aBl, FloatType *aDl, FloatType *aDsl,
+        FloatType *pil, FloatType *alphal, FloatType *alphastarl,
+        bool right_censoring, int trunc)
+    { return hsmm::messages_forwards_log(M,T,A,aBl,aDl,aDsl,pil,alphal,alphastarl,
+            right_censoring,trunc); }
+
+    static double expected_statistics_log(
+        int M, int T, FloatType *A, FloatType *aBl, FloatType *aDl, FloatType *aDsl,
+        FloatType *pil, bool right_censoring, int trunc,
+        FloatType *expected_states, FloatType *expected_transcounts,
+        FloatType *expected_durations)
+    { return hsmm::expected_statistics_log(M,T,A,aBl,aDl,aDsl,pil,right_censoring,trunc,
+            expected_states,expected_transcounts,expected_durations); }
+
+    static FloatType viterbi(
+        int M, int T, FloatType *A, FloatType *pil, FloatType *aBl,
+        FloatType *aDl, FloatType *aDsl, bool right_censoring, int trunc,
+        IntType *stateseq)
+    { return hsmm::viterbi(M,T,A,pil,aBl,aDl,aDsl,right_censoring,trunc,stateseq); }
+
     static void sample_forwards_log(
-        int M, int T, FloatType *A, FloatType *pi0, FloatType *aBl, FloatType *aDl,
+        int M, int T, FloatType *A, FloatType *pi0, double *caBl, FloatType *aDl,
         FloatType *betal, FloatType *betastarl,
         IntType *stateseq, FloatType *randseq)
-    { hsmm::sample_forwards_log(M,T,A,pi0,aBl,aDl,betal,betastarl,stateseq,randseq); }
+    { hsmm::sample_forwards_log(M,T,A,pi0,caBl,aDl,betal,betastarl,stateseq,randseq); }
 };
 
 #endif
@@ -16,14 +16,26 @@ from cython cimport floating
 
 from cython.parallel import prange
 
+from pyhsmm.util.stats import uniform_stream
+
 cdef extern from "hsmm_messages.h":
     cdef cppclass hsmmc[Type]:
         hsmmc()
         void messages_backwards_log(
             int M, int T, Type *A, Type *aBl, Type *aDl, Type *aDsl,
             Type *betal, Type *betastarl, int right_censoring, int trunc) nogil
+        Type messages_forwards_log(
+            int M, int T, Type *A, Type *aBl, Type *aDl, Type *aDsl, Type *pil,
+            Type *alphal, Type *alphastarl, int right_censoring, int trunc) nogil
+        double expected_statistics_log(
+            int M, int T, Type *A, Type *aBl, Type *aDl, Type *aDsl, Type *pil,
+            int right_censoring, int trunc, Type *expected_states,
+            Type *expected_transcounts, Type *expected_durations) nogil
+        Type viterbi(
+            int M, int T, Type *A, Type *pil, Type *aBl, Type *aDl, Type *aDsl,
+            int right_censoring, int trunc, int32_t *stateseq) nogil
         void sample_forwards_log(
-            int M, int T, Type *A, Type *pi0, Type *aBl, Type *aD,
+            int M, int T, Type *A, Type *pi0, double *caBl, Type *aD,
             Type *betal, Type *betastarl, int32_t *stateseq, Type *randseq) nogil
 
 def messages_backwards_log(
@@ -36,20 +48,61 @@ def messages_backwards_log(
         int right_censoring, int trunc):
     cdef hsmmc[floating] ref
 
-    ref.messages_backwards_log(A.shape[0],aBl.shape[0],&A[0,0],
-            &aBl[0,0],&aDl[0,0],&aDsl[0,0],&betal[0,0],&betastarl[0,0],
-            right_censoring,trunc)
+    with nogil:
+        ref.messages_backwards_log(A.shape[0],aBl.shape[0],&A[0,0],
+                &aBl[0,0],&aDl[0,0],&aDsl[0,0],&betal[0,0],&betastarl[0,0],
+                right_censoring,trunc)
 
     return betal, betastarl
 
+def messages_forwards_log(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        floating[:,::1] aDl not None,
+        floating[:,::1] aDsl not None,
+        floating[::1] pil not None,
+        np.ndarray[floating,ndim=2,mode="c"] alphal not None,
+        np.ndarray[floating,ndim=2,mode="c"] alphastarl not None,
+        int right_censoring, int trunc):
+    cdef hsmmc[floating] ref
+    cdef floating normalizer
+
+    with nogil:
+        normalizer = ref.messages_forwards_log(A.shape[0],aBl.shape[0],&A[0,0],
+                &aBl[0,0],&aDl[0,0],&aDsl[0,0],&pil[0],&alphal[0,0],&alphastarl[0,0],
+                right_censoring,trunc)
+
+    return alphal, alphastarl, normalizer
+
+def expected_statistics_log(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        floating[:,::1] aDl not None,
+        floating[:,::1] aDsl not None,
+        floating[::1] pil not None,
+        int right_censoring, int trunc,
+        np.ndarray[floating,ndim=2,mode="c"] expected_states not None,
+        np.ndarray[floating,ndim=2,mode="c"] expected_transcounts not None,
+        np.ndarray[floating,ndim=2,mode="c"] expected_durations not None):
+    cdef hsmmc[floating] ref
+    cdef double normalizer
+
+    with nogil:
+        normalizer = ref.expected_statistics_log(A.shape[0],aBl.shape[0],&A[0,0],
+                &aBl[0,0],&aDl[0,0],&aDsl[0,0],&pil[0],right_censoring,trunc,
+                &expected_states[0,0],&expected_transcounts[0,0],&expected_durations[0,0])
+
+    return expected_states, expected_transcounts, expected_durations, normalizer
+
 def sample_forwards_log(
         floating[:,::1] A not None,
-        floating[:,::1] caBl not None,
+        double[:,::1] caBl not None,
         floating[:,::1] aDl not None,
         floating[::1] pi0 not None,
         floating[:,::1] betal not None,
         floating[:,::1] betastarl not None,
         np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        rng_key=None,
         ):
     cdef hsmmc[floating] ref
 
@@ -58,12 +111,15 @@ def sample_forwards_log(
     # duration is deterministically 1
     cdef floating[:] randseq
     if floating is double:
-        randseq = np.random.random(size=2*caBl.shape[0]).astype(np.double)
+        randseq = uniform_stream(2*betal.shape[0],rng_key,dtype=np.double)
     else:
-        randseq = np.random.random(size=2*caBl.shape[0]).astype(np.float)
+        randseq = uniform_stream(2*betal.shape[0],rng_key,dtype=np.float32)
 
-    ref.sample_forwards_log(A.shape[0],caBl.shape[0],&A[0,0],&pi0[0],
-            &caBl[0,0],&aDl[0,0],&betal[0,0],&betastarl[0,0],&stateseq[0],&randseq[0])
+    # NOTE: caBl is the T+1 prefix sums of aBl (see HSMMStatesPython.caBl),
+    # which are double whatever the type of the messages
+    with nogil:
+        ref.sample_forwards_log(A.shape[0],betal.shape[0],&A[0,0],&pi0[0],
+                &caBl[0,0],&aDl[0,0],&betal[0,0],&betastarl[0,0],&stateseq[0],&randseq[0])
 
     return stateseq
 
@@ -73,9 +129,11 @@ def resample_log_multiple(
         floating[:,::1] aDl not None,
         floating[:,::1] aDsl not None,
         list aBls not None,
+        list caBls not None,
         int[::1] right_censorings not None,
         int[::1] truncs not None,
         list stateseqs not None,
+        list rng_keys=None,
         ):
     cdef hsmmc[floating] ref
     cdef int i
@@ -89,20 +147,20 @@ def resample_log_multiple(
 
     betals = [np.empty((aBl.shape[0]+1,aBl.shape[1]),dtype=aBl.dtype) for aBl in aBls]
     betastarls = [np.empty_like(betal) for betal in betals]
-    caBls = [np.vstack((np.zeros(N,dtype=aBl.dtype),np.cumsum(aBl[:-1],axis=0))) for aBl in aBls]
 
     cdef vector[floating*] aBls_vect
-    cdef vector[floating*] caBls_vect
+    cdef vector[double*] caBls_vect
     cdef vector[floating*] betals_vect
     cdef vector[floating*] betastarls_vect
     cdef vector[int32_t*] stateseqs_vect
     cdef floating[:,:] temp
+    cdef double[:,:] dtemp
     cdef int32_t[:] temp2
     for i in range(num):
         temp = aBls[i]
         aBls_vect.push_back(&temp[0,0])
-        temp = caBls[i]
-        caBls_vect.push_back(&temp[0,0])
+        dtemp = caBls[i]
+        caBls_vect.push_back(&dtemp[0,0])
         temp = betals[i]
         betals_vect.push_back(&temp[0,0])
         temp = betastarls[i]
@@ -111,13 +169,15 @@ def resample_log_multiple(
         stateseqs_vect.push_back(&temp2[0])
 
     cdef floating[:] randseq
-    cdef floating[:] loglikes
+    cdef double[:] loglikes = np.empty(num,dtype=np.double)
+    if rng_keys is None:
+        rng_keys = [None]*num
     if floating is double:
-        randseq = np.random.random(size=2*np.sum(Ts)).astype(np.double)
-        loglikes = np.empty(num,dtype=np.double)
+        randseq = np.concatenate([uniform_stream(2*T,key,dtype=np.double)
+            for T, key in zip(np.asarray(Ts),rng_keys)] + [np.empty(0)])
     else:
-        randseq = np.random.random(size=2*np.sum(Ts)).astype(np.float)
-        loglikes = np.empty(num,dtype=np.float)
+        randseq = np.concatenate([uniform_stream(2*T,key,dtype=np.float32)
+            for T, key in zip(np.asarray(Ts),rng_keys)] + [np.empty(0,dtype=np.float32)])
 
     with nogil:
         for i in prange(num):
@@ -135,3 +195,111 @@ def resample_log_multiple(
 
     return np.asarray(loglikes)
 
+# NOTE: like resample_log_multiple, this is for dispatching to OpenMP. the
+# duration potentials are shared, so they have to be as long as the longest
+# sequence, and each sequence gets its own outputs so that threads never write
+# to the same memory.
+def expected_statistics_log_multiple(
+        floating[:,::1] A not None,
+        floating[::1] pil not None,
+        floating[:,::1] aDl not None,
+        floating[:,::1] aDsl not None,
+        list aBls not None,
+        int[::1] right_censorings not None,
+        int[::1] truncs not None,
+        ):
+    cdef hsmmc[floating] ref
+    cdef int i
+
+    cdef int num = len(aBls)
+    cdef int N = A.shape[0]
+    cdef int[:] Ts = np.array([aBl.shape[0] for aBl in aBls],dtype=np.int32)
+
+    if floating is double:
+        dtype = np.double
+    else:
+        dtype = np.float32
+
+    expected_states_list = [np.empty((aBl.shape[0],N),dtype=dtype) for aBl in aBls]
+    expected_transcounts_list = [np.empty((N,N),dtype=dtype) for aBl in aBls]
+    expected_durations_list = [np.empty((min(trunc,aBl.shape[0]),N),dtype=dtype)
+            for aBl, trunc in zip(aBls,np.asarray(truncs))]
+    cdef double[:] normalizers = np.empty(num,dtype=np.double)
+
+    cdef vector[floating*] aBls_vect
+    cdef vector[floating*] expected_states_vect
+    cdef vector[floating*] expected_transcounts_vect
+    cdef vector[floating*] expected_durations_vect
+    cdef floating[:,::1] temp
+    for i in range(num):
+        temp = aBls[i]
+        aBls_vect.push_back(&temp[0,0])
+        temp = expected_states_list[i]
+        expected_states_vect.push_back(&temp[0,0])
+        temp = expected_transcounts_list[i]
+        expected_transcounts_vect.push_back(&temp[0,0])
+        temp = expected_durations_list[i]
+        expected_durations_vect.push_back(&temp[0,0])
+
+    with nogil:
+        for i in prange(num):
+            normalizers[i] = ref.expected_statistics_log(N,Ts[i],&A[0,0],
+                    aBls_vect[i],&aDl[0,0],&aDsl[0,0],&pil[0],
+                    right_censorings[i],truncs[i],expected_states_vect[i],
+                    expected_transcounts_vect[i],expected_durations_vect[i])
+
+    return expected_states_list, expected_transcounts_list, expected_durations_list, \
+            np.asarray(normalizers)
+
+def viterbi(
+        floating[:,::1] A not None,
+        floating[:,::1] aBl not None,
+        floating[:,::1] aDl not None,
+        floating[:,::1] aDsl not None,
+        floating[::1] pil not None,
+        int right_censoring, int trunc,
+        np.ndarray[np.int32_t,ndim=1,mode="c"] stateseq not None,
+        ):
+    cdef hsmmc[floating] ref
+    cdef floating score
+
+    with nogil:
+        score = ref.viterbi(A.shape[0],aBl.shape[0],&A[0,0],&pil[0],&aBl[0,0],
+                &aDl[0,0],&aDsl[0,0],right_censoring,trunc,&stateseq[0])
+
+    return stateseq, score
+
+def viterbi_multiple(
+        floating[:,::1] A not None,
+        floating[::1] pil not None,
+        floating[:,::1] aDl not None,
+        floating[:,::1] aDsl not None,
+        list aBls not None,
+        int[::1] right_censorings not None,
+        int[::1] truncs not None,
+        list stateseqs not None,
+        ):
+    cdef hsmmc[floating] ref
+    cdef int i
+
+    cdef int num = len(aBls)
+    cdef int N = A.shape[0]
+    cdef int[:] Ts = np.array([aBl.shape[0] for aBl in aBls],dtype=np.int32)
+    cdef double[:] scores = np.empty(num,dtype=np.double)
+
+    cdef vector[floating*] aBls_vect
+    cdef vector[int32_t*] stateseqs_vect
+    cdef floating[:,::1] temp
+    cdef int32_t[::1] temp2
+    for i in range(num):
+        temp = aBls[i]
+        aBls_vect.push_back(&temp[0,0])
+        temp2 = stateseqs[i]
+        stateseqs_vect.push_back(&temp2[0])
+
+    with nogil:
+        for i in prange(num):
+            scores[i] = ref.viterbi(N,Ts[i],&A[0,0],&pil[0],aBls_vect[i],
+                    &aDl[0,0],&aDsl[0,0],right_censorings[i],truncs[i],stateseqs_vect[i])
+
+    return stateseqs, np.asarray(scores)
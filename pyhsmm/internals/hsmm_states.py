@@ -6,9 +6,11 @@ from matplotlib import pyplot as plt
 import abc, copy, warnings
 
 import pyhsmm
-from pyhsmm.util.stats import sample_discrete, sample_discrete_from_log, sample_markov
-from pyhsmm.util.general import rle, top_eigenvector, rcumsum, cumsum
+from pyhsmm.util.stats import sample_discrete, sample_discrete_from_log, sample_markov, \
+        uniform_stream
+from pyhsmm.util.general import rle, top_eigenvector, rcumsum, cumsum, versions
 from pyhsmm.util.profiling import line_profiled
+from pyhsmm.internals import emissions
 
 import hmm_states
 from hmm_states import _StatesBase, _SeparateTransMixin, \
@@ -79,9 +81,10 @@ class HSMMStatesPython(_StatesBase):
     @property
     def pi_0(self):
         if not self.left_censoring:
-            return self.model.init_state_distn.pi_0
+            pi_0 = self.model.init_state_distn.pi_0
         else:
-            return self.model.left_censoring_init_state_distn.pi_0
+            pi_0 = self.model.left_censoring_init_state_distn.pi_0
+        return np.asarray(pi_0,dtype=self.dtype)
 
     @property
     def dur_distns(self):
@@ -96,7 +99,8 @@ class HSMMStatesPython(_StatesBase):
 
     @property
     def mf_pi_0(self):
-        return self.model.init_state_distn.exp_expected_log_init_state_distn
+        return np.asarray(self.model.init_state_distn.exp_expected_log_init_state_distn,
+                dtype=self.dtype)
 
     @property
     def mf_log_trans_matrix(self):
@@ -106,7 +110,8 @@ class HSMMStatesPython(_StatesBase):
 
     @property
     def mf_trans_matrix(self):
-        return np.maximum(self.model.trans_distn.exp_expected_log_trans_matrix,1e-3)
+        return np.maximum(self.model.trans_distn.exp_expected_log_trans_matrix,
+                1e-3).astype(self.dtype,copy=False)
 
     ### generation
 
@@ -141,17 +146,32 @@ class HSMMStatesPython(_StatesBase):
 
     def clear_caches(self):
         self._aBl = self._mf_aBl = None
+        self._caBl = self._mf_caBl = None
         self._aDl = self._mf_aDl = None
         self._aDsl = self._mf_aDsl = None
         self._log_trans_matrix = self._mf_log_trans_matrix = None
         self._normalizer = None
         super(HSMMStatesPython,self).clear_caches()
 
+    @property
+    def _parameters(self):
+        return dict(super(HSMMStatesPython,self)._parameters,dur=self.dur_distns)
+
+    def _clear_stale(self,changed):
+        if 'obs' in changed:
+            self._caBl = self._mf_caBl = None
+        if 'dur' in changed:
+            self._aDl = self._mf_aDl = None
+            self._aDsl = self._mf_aDsl = None
+        if 'trans' in changed:
+            self._log_trans_matrix = self._mf_log_trans_matrix = None
+        super(HSMMStatesPython,self)._clear_stale(changed)
+
     ### array properties for homog model
     @property
     def aDl(self):
         if self._aDl is None:
-            aDl = np.empty((self.T,self.num_states))
+            aDl = np.empty((self.T,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.T + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDl[:,idx] = dur_distn.log_pmf(possible_durations)
@@ -161,7 +181,7 @@ class HSMMStatesPython(_StatesBase):
     @property
     def aDsl(self):
         if self._aDsl is None:
-            aDsl = np.empty((self.T,self.num_states))
+            aDsl = np.empty((self.T,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.T + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDsl[:,idx] = dur_distn.log_sf(possible_durations)
@@ -171,17 +191,17 @@ class HSMMStatesPython(_StatesBase):
     @property
     def mf_aBl(self):
         if self._mf_aBl is None:
-            T = self.data.shape[0]
-            self._mf_aBl = aBl = np.empty((self.data.shape[0],self.num_states))
-            for idx, o in enumerate(self.obs_distns):
-                aBl[:,idx] = o.expected_log_likelihood(self.data).reshape((T,))
+            self._mf_aBl = aBl = np.empty((self.data.shape[0],self.num_states),
+                    dtype=self.dtype)
+            emissions.expected_log_likelihoods(self.obs_distns,self.data,aBl)
             aBl[np.isnan(aBl).any(1)] = 0.
+            self._cache_versions['_mf_aBl'] = versions(self.obs_distns)
         return self._mf_aBl
 
     @property
     def mf_aDl(self):
         if self._mf_aDl is None:
-            self._mf_aDl = aDl = np.empty((self.T,self.num_states))
+            self._mf_aDl = aDl = np.empty((self.T,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.T + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDl[:,idx] = dur_distn.expected_log_pmf(possible_durations)
@@ -190,12 +210,38 @@ class HSMMStatesPython(_StatesBase):
     @property
     def mf_aDsl(self):
         if self._mf_aDsl is None:
-            self._mf_aDsl = aDsl = np.empty((self.T,self.num_states))
+            self._mf_aDsl = aDsl = np.empty((self.T,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.T + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDsl[:,idx] = dur_distn.expected_log_sf(possible_durations)
         return self._mf_aDsl
 
+    # NOTE: caBl[t] is the sum of aBl[:t], so the cumulative observation
+    # potentials of any segment are differences of two of its rows, and the
+    # potentials below (and the native sampler) all index into it instead of
+    # summing aBl for each t. -infs are floored, like aDl is for the native
+    # code, so that the differences don't become nans. the sums are always
+    # float64, since in float32 a difference of two sums over a long sequence
+    # loses most of its digits; only the per-segment differences are cast down
+
+    @property
+    def caBl(self):
+        if self._caBl is None:
+            self._caBl = self._prefix_sums(self.aBl)
+        return self._caBl
+
+    @property
+    def mf_caBl(self):
+        if self._mf_caBl is None:
+            self._mf_caBl = self._prefix_sums(self.mf_aBl)
+        return self._mf_caBl
+
+    @staticmethod
+    def _prefix_sums(aBl):
+        out = np.zeros((aBl.shape[0]+1,aBl.shape[1]))
+        np.cumsum(np.maximum(aBl,-1e6),axis=0,dtype=np.float64,out=out[1:])
+        return out
+
     # @property
     # def betal(self):
     #     if self._betal is None:
@@ -229,7 +275,8 @@ class HSMMStatesPython(_StatesBase):
                 self.reverse_cumulative_obs_potentials,
                 self.reverse_dur_potentials,
                 self.reverse_dur_survival_potentials,
-                np.empty((self.T,self.num_states)),np.empty((self.T,self.num_states)))
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                np.empty((self.T,self.num_states),dtype=self.dtype))
         return alphal, alphastarl
 
     def messages_backwards(self):
@@ -239,7 +286,9 @@ class HSMMStatesPython(_StatesBase):
                 self.cumulative_obs_potentials,
                 self.dur_potentials,
                 self.dur_survival_potentials,
-                np.empty((self.T,self.num_states)),np.empty((self.T,self.num_states)))
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                right_censoring=self.right_censoring)
         self._normalizer = loglike
         return betal, betastarl
 
@@ -261,22 +310,21 @@ class HSMMStatesPython(_StatesBase):
         return self.log_trans_matrix
 
     def cumulative_obs_potentials(self,t):
-        stop = None if self.trunc is None else min(self.T,t+self.trunc)
-        return np.cumsum(self.aBl[t:stop],axis=0), 0.
+        return self.caBl[t+1:][:self.trunc], self.caBl[t]
 
     def dur_potentials(self,t):
         stop = self.T-t if self.trunc is None else min(self.T-t,self.trunc)
         return self.aDl[:stop]
 
     def dur_survival_potentials(self,t):
-        return self.aDsl[self.T-t -1] if (self.trunc is None or self.T-t > self.trunc) \
+        return self.aDsl[self.T-t -1] if (self.trunc is None or self.T-t <= self.trunc) \
                 else -np.inf
 
     # backwards messages potentials
 
     def reverse_cumulative_obs_potentials(self,t):
         start = 0 if self.trunc is None else max(0,t-self.trunc+1)
-        return rcumsum(self.aBl[start:t+1])
+        return (self.caBl[t+1] - self.caBl[start:t+1]).astype(self.dtype,copy=False)
 
     def reverse_dur_potentials(self,t):
         stop = t+1 if self.trunc is None else min(t+1,self.trunc)
@@ -284,7 +332,7 @@ class HSMMStatesPython(_StatesBase):
 
     def reverse_dur_survival_potentials(self,t):
         # NOTE: untested, unused without left-censoring
-        return self.aDsl[t] if (self.trunc is None or t+1 < self.trunc) \
+        return self.aDsl[t] if (self.trunc is None or t+1 <= self.trunc) \
                 else -np.inf
 
     # mean field messages potentials
@@ -293,12 +341,11 @@ class HSMMStatesPython(_StatesBase):
         return self.mf_log_trans_matrix
 
     def mf_cumulative_obs_potentials(self,t):
-        stop = None if self.trunc is None else min(self.T,t+self.trunc)
-        return np.cumsum(self.mf_aBl[t:stop],axis=0), 0.
+        return self.mf_caBl[t+1:][:self.trunc], self.mf_caBl[t]
 
     def mf_reverse_cumulative_obs_potentials(self,t):
         start = 0 if self.trunc is None else max(0,t-self.trunc+1)
-        return rcumsum(self.mf_aBl[start:t+1])
+        return (self.mf_caBl[t+1] - self.mf_caBl[start:t+1]).astype(self.dtype,copy=False)
 
     def mf_dur_potentials(self,t):
         stop = self.T-t if self.trunc is None else min(self.T-t,self.trunc)
@@ -309,12 +356,12 @@ class HSMMStatesPython(_StatesBase):
         return self.mf_aDl[:stop][::-1]
 
     def mf_dur_survival_potentials(self,t):
-        return self.mf_aDsl[self.T-t -1] if (self.trunc is None or self.T-t > self.trunc) \
+        return self.mf_aDsl[self.T-t -1] if (self.trunc is None or self.T-t <= self.trunc) \
                 else -np.inf
 
     def mf_reverse_dur_survival_potentials(self,t):
         # NOTE: untested, unused without left-censoring
-        return self.mf_aDsl[t] if (self.trunc is None or t+1 < self.trunc) \
+        return self.mf_aDsl[t] if (self.trunc is None or t+1 <= self.trunc) \
                 else -np.inf
 
     ### Gibbs sampling
@@ -335,7 +382,8 @@ class HSMMStatesPython(_StatesBase):
                 self.cumulative_obs_potentials,
                 self.dur_potentials,
                 self.dur_survival_potentials,
-                betal, betastarl)
+                betal, betastarl,
+                rng_key=self.rng_key)
         return self.stateseq
 
     ### Viterbi
@@ -346,7 +394,8 @@ class HSMMStatesPython(_StatesBase):
             self.trans_potentials, np.log(self.pi_0),
             self.cumulative_obs_potentials,
             self.reverse_cumulative_obs_potentials,
-            self.dur_potentials, self.dur_survival_potentials)
+            self.dur_potentials, self.dur_survival_potentials,
+            right_censoring=self.right_censoring)
 
     def mf_Viterbi(self):
         self.stateseq = hsmm_maximizing_assignment(
@@ -354,7 +403,8 @@ class HSMMStatesPython(_StatesBase):
             self.mf_trans_potentials, np.log(self.mf_pi_0),
             self.mf_cumulative_obs_potentials,
             self.mf_reverse_cumulative_obs_potentials,
-            self.mf_dur_potentials, self.mf_dur_survival_potentials)
+            self.mf_dur_potentials, self.mf_dur_survival_potentials,
+            right_censoring=self.right_censoring)
 
     ### EM
 
@@ -376,6 +426,25 @@ class HSMMStatesPython(_StatesBase):
                 self.mf_dur_potentials, self.mf_reverse_dur_potentials,
                 self.mf_dur_survival_potentials, self.mf_reverse_dur_survival_potentials)
 
+    # NOTE: these are redefined here so that subclasses which also inherit from
+    # HMMStatesEigen (e.g. the integer negative binomial states) don't pick up
+    # its batched HMM versions through the MRO
+
+    @classmethod
+    def _E_step_multiple(cls,states_list):
+        for s in states_list:
+            s.E_step()
+
+    @classmethod
+    def _meanfieldupdate_multiple(cls,states_list):
+        for s in states_list:
+            s.meanfieldupdate()
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        for s in states_list:
+            s.Viterbi()
+
     @property
     def all_expected_stats(self):
         return self.expected_states, self.expected_transcounts, \
@@ -397,9 +466,9 @@ class HSMMStatesPython(_StatesBase):
             count_transitions(self.stateseq_norep,minlength=self.num_states)
 
         self.expected_durations = expected_durations = \
-                np.zeros((self.num_states,self.T))
+                np.zeros((self.T,self.num_states))
         for state in xrange(self.num_states):
-            expected_durations[state] += \
+            expected_durations[:,state] += \
                 np.bincount(
                     self.durations_censored[self.stateseq_norep == state],
                     minlength=self.T)[:self.T]
@@ -418,7 +487,8 @@ class HSMMStatesPython(_StatesBase):
                 reverse_cumulative_obs_potentials,
                 reverse_dur_potentials,
                 reverse_dur_survival_potentials,
-                np.empty((self.T,self.num_states)),np.empty((self.T,self.num_states)))
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                np.empty((self.T,self.num_states),dtype=self.dtype))
 
         betal, betastarl, normalizer = hsmm_messages_backwards_log(
                 trans_potentials,
@@ -426,7 +496,9 @@ class HSMMStatesPython(_StatesBase):
                 cumulative_obs_potentials,
                 dur_potentials,
                 dur_survival_potentials,
-                np.empty((self.T,self.num_states)),np.empty((self.T,self.num_states)))
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                np.empty((self.T,self.num_states),dtype=self.dtype),
+                right_censoring=self.right_censoring)
 
         expected_states = self._expected_states(
                 alphal, betal, alphastarl, betastarl, normalizer)
@@ -452,16 +524,16 @@ class HSMMStatesPython(_StatesBase):
         expected_states = \
             (gammastar - np.vstack((np.zeros(gamma.shape[1]),gamma[:-1]))).cumsum(0)
 
+        return self._normalize_expected_states(expected_states)
+
+    @staticmethod
+    def _normalize_expected_states(expected_states):
         assert not np.isnan(expected_states).any()
         assert expected_states.min() > 0.-1e-3 and expected_states.max() < 1 + 1e-3
         assert np.allclose(expected_states.sum(1),1.,atol=1e-2)
 
         expected_states = np.maximum(0.,expected_states)
         expected_states /= expected_states.sum(1)[:,na]
-
-        # TODO break this out into a function
-        self._changepoint_probs = gammastar.sum(1)
-
         return expected_states
 
     def _expected_transitions(self,alphal,betastarl,trans_potentials,normalizer):
@@ -475,18 +547,20 @@ class HSMMStatesPython(_StatesBase):
     def _expected_durations(self,
             dur_potentials,cumulative_obs_potentials,
             alphastarl,betal,normalizer):
-        if self.trunc is not None:
-            raise NotImplementedError, "_expected_durations can't handle trunc"
+        # NOTE: row d is for duration d+1; with trunc, the potentials at each t
+        # only cover the first trunc durations, and so does the output
         T = self.T
-        logpmfs = -np.inf*np.ones_like(alphastarl)
+        logpmfs = -np.inf*np.ones((T if self.trunc is None else min(self.trunc,T),
+            alphastarl.shape[1]))
         errs = np.seterr(invalid='ignore')
         for t in xrange(T):
             cB, offset = cumulative_obs_potentials(t)
-            np.logaddexp(dur_potentials(t) + alphastarl[t] + betal[t:] +
+            D = cB.shape[0]
+            np.logaddexp(dur_potentials(t) + alphastarl[t] + betal[t:t+D] +
                     cB - (normalizer + offset),
-                    logpmfs[:T-t], out=logpmfs[:T-t])
+                    logpmfs[:D], out=logpmfs[:D])
         np.seterr(**errs)
-        expected_durations = np.exp(logpmfs.T)
+        expected_durations = np.exp(logpmfs)
 
         return expected_durations
 
@@ -497,15 +571,8 @@ class HSMMStatesEigen(HSMMStatesPython):
     # overriding methods like cumulative_likelihood_block)
 
     def messages_backwards(self):
-        # NOTE: np.maximum calls are because the C++ code doesn't do
-        # np.logaddexp(-inf,-inf) = -inf, it likes nans instead
-        from hsmm_messages_interface import messages_backwards_log
-        betal, betastarl = messages_backwards_log(
-                np.maximum(self.trans_matrix,1e-50),self.aBl,np.maximum(self.aDl,-1000000),
-                self.aDsl,np.empty_like(self.aBl),np.empty_like(self.aBl),
-                self.right_censoring,self.trunc if self.trunc is not None else self.T)
-        assert not np.isnan(betal).any()
-        assert not np.isnan(betastarl).any()
+        betal, betastarl = self._messages_backwards_native(
+                self.trans_matrix,self.aBl,self.aDl,self.aDsl)
 
         if not self.left_censoring:
             self._normalizer = np.logaddexp.reduce(np.log(self.pi_0) + betastarl[0])
@@ -517,14 +584,180 @@ class HSMMStatesEigen(HSMMStatesPython):
     def messages_backwards_python(self):
         return super(HSMMStatesEigen,self).messages_backwards()
 
+    def messages_forwards(self):
+        alphal, alphastarl, self._normalizer = self._messages_forwards_native(
+                self.trans_matrix,self.pi_0,self.aBl,self.aDl,self.aDsl)
+        return alphal, alphastarl
+
+    def messages_forwards_python(self):
+        return super(HSMMStatesEigen,self).messages_forwards()
+
+    # NOTE: np.maximum calls are because the C++ code doesn't do
+    # np.logaddexp(-inf,-inf) = -inf, it likes nans instead
+
+    def _messages_backwards_native(self,trans_matrix,aBl,aDl,aDsl):
+        from hsmm_messages_interface import messages_backwards_log
+        betal, betastarl = messages_backwards_log(
+                np.maximum(trans_matrix,max(1e-50,np.finfo(self.dtype).tiny)),
+                aBl,np.maximum(aDl,-1e6),
+                aDsl,np.empty_like(aBl),np.empty_like(aBl),
+                self.right_censoring,self.trunc if self.trunc is not None else self.T)
+        assert not np.isnan(betal).any()
+        assert not np.isnan(betastarl).any()
+        return betal, betastarl
+
+    def _messages_forwards_native(self,trans_matrix,pi_0,aBl,aDl,aDsl):
+        from hsmm_messages_interface import messages_forwards_log
+        if self.left_censoring:
+            raise NotImplementedError('left censoring is not implemented in the forward messages')
+        errs = np.seterr(divide='ignore')
+        pil = np.log(pi_0)
+        np.seterr(**errs)
+        alphal, alphastarl, normalizer = messages_forwards_log(
+                np.maximum(trans_matrix,max(1e-50,np.finfo(self.dtype).tiny)),
+                aBl,np.maximum(aDl,-1e6),aDsl,pil,
+                np.empty_like(aBl),np.empty_like(aBl),
+                self.right_censoring,self.trunc if self.trunc is not None else self.T)
+        assert not np.isnan(alphal).any()
+        assert not np.isnan(alphastarl).any()
+        return alphal, alphastarl, normalizer
+
+    ### EM
+
+    def E_step(self):
+        if self.left_censoring:
+            return super(HSMMStatesEigen,self).E_step()
+        self.clear_caches()
+        self.all_expected_stats = self._expected_statistics_native(
+                self.trans_matrix,self.pi_0,self.aBl,self.aDl,self.aDsl)
+
+    def meanfieldupdate(self):
+        if self.left_censoring:
+            return super(HSMMStatesEigen,self).meanfieldupdate()
+        self.clear_caches()
+        self.all_expected_stats = self._expected_statistics_native(
+                self.mf_trans_matrix,self.mf_pi_0,self.mf_aBl,self.mf_aDl,self.mf_aDsl)
+
+    def _expected_statistics_native(self,trans_matrix,pi_0,aBl,aDl,aDsl):
+        from hsmm_messages_interface import expected_statistics_log
+        T, N = aBl.shape
+        A, pil, aDl, aDsl = self._native_potentials(trans_matrix,pi_0,aDl,aDsl)
+        expected_states, expected_transcounts, expected_durations, normalizer = \
+            expected_statistics_log(
+                A,aBl,aDl,aDsl,pil,self.right_censoring,
+                self.trunc if self.trunc is not None else T,
+                np.empty((T,N),dtype=aBl.dtype),np.empty((N,N),dtype=aBl.dtype),
+                np.empty((min(self.trunc,T) if self.trunc is not None else T,N),
+                    dtype=aBl.dtype))
+        return self._normalize_expected_states(expected_states), \
+                expected_transcounts, expected_durations, normalizer
+
+    @staticmethod
+    def _native_potentials(trans_matrix,pi_0,aDl,aDsl):
+        # NOTE: see the note on np.maximum above
+        errs = np.seterr(divide='ignore')
+        pil = np.log(pi_0)
+        np.seterr(**errs)
+        return np.maximum(trans_matrix,max(1e-50,np.finfo(trans_matrix.dtype).tiny)), \
+                pil, np.maximum(aDl,-1e6), aDsl
+
+    def _uses_native_E_step(self):
+        return not self.left_censoring \
+            and type(self).E_step.im_func is HSMMStatesEigen.E_step.im_func \
+            and type(self).meanfieldupdate.im_func is HSMMStatesEigen.meanfieldupdate.im_func
+
+    @classmethod
+    def _E_step_multiple(cls,states_list):
+        if not all(s._uses_native_E_step() for s in states_list):
+            return super(HSMMStatesEigen,cls)._E_step_multiple(states_list)
+        if len(states_list) > 0:
+            for s in states_list:
+                s.clear_caches()
+            longest = max(states_list,key=lambda s: s.T)
+            cls._expected_statistics_native_multiple(
+                    states_list,states_list[0].trans_matrix,states_list[0].pi_0,
+                    [s.aBl for s in states_list],longest.aDl,longest.aDsl)
+
+    @classmethod
+    def _meanfieldupdate_multiple(cls,states_list):
+        if not all(s._uses_native_E_step() for s in states_list):
+            return super(HSMMStatesEigen,cls)._meanfieldupdate_multiple(states_list)
+        if len(states_list) > 0:
+            for s in states_list:
+                s.clear_caches()
+            longest = max(states_list,key=lambda s: s.T)
+            cls._expected_statistics_native_multiple(
+                    states_list,states_list[0].mf_trans_matrix,states_list[0].mf_pi_0,
+                    [s.mf_aBl for s in states_list],longest.mf_aDl,longest.mf_aDsl)
+
+    @classmethod
+    def _expected_statistics_native_multiple(cls,states_list,trans_matrix,pi_0,aBls,aDl,aDsl):
+        from hsmm_messages_interface import expected_statistics_log_multiple
+        A, pil, aDl, aDsl = cls._native_potentials(trans_matrix,pi_0,aDl,aDsl)
+        allstats = zip(*expected_statistics_log_multiple(
+            A,pil,aDl,aDsl,aBls,
+            np.array([s.right_censoring for s in states_list],dtype=np.int32),
+            np.array([s.trunc if s.trunc is not None else s.T for s in states_list],
+                dtype=np.int32)))
+        for s, (expected_states, expected_transcounts, expected_durations, normalizer) \
+                in zip(states_list,allstats):
+            s.all_expected_stats = cls._normalize_expected_states(expected_states), \
+                    expected_transcounts, expected_durations, normalizer
+
+    ### Viterbi
+
+    def Viterbi(self):
+        if self.left_censoring:
+            return super(HSMMStatesEigen,self).Viterbi()
+        self.stateseq = self._Viterbi_native(
+                self.trans_matrix,self.pi_0,self.aBl,self.aDl,self.aDsl)
+
+    def mf_Viterbi(self):
+        if self.left_censoring:
+            return super(HSMMStatesEigen,self).mf_Viterbi()
+        self.stateseq = self._Viterbi_native(
+                self.mf_trans_matrix,self.mf_pi_0,self.mf_aBl,self.mf_aDl,self.mf_aDsl)
+
+    def Viterbi_python(self):
+        return super(HSMMStatesEigen,self).Viterbi()
+
+    def _Viterbi_native(self,trans_matrix,pi_0,aBl,aDl,aDsl):
+        from hsmm_messages_interface import viterbi
+        A, pil, aDl, aDsl = self._native_potentials(trans_matrix,pi_0,aDl,aDsl)
+        stateseq, _ = viterbi(A,aBl,aDl,aDsl,pil,self.right_censoring,
+                self.trunc if self.trunc is not None else aBl.shape[0],
+                np.empty(aBl.shape[0],dtype='int32'))
+        return stateseq
+
+    def _uses_native_Viterbi(self):
+        return not self.left_censoring \
+            and type(self).Viterbi.im_func is HSMMStatesEigen.Viterbi.im_func
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        from hsmm_messages_interface import viterbi_multiple
+        if not all(s._uses_native_Viterbi() for s in states_list):
+            return super(HSMMStatesEigen,cls)._Viterbi_multiple(states_list)
+        if len(states_list) > 0:
+            longest = max(states_list,key=lambda s: s.T)
+            A, pil, aDl, aDsl = cls._native_potentials(
+                    states_list[0].trans_matrix,states_list[0].pi_0,longest.aDl,longest.aDsl)
+            stateseqs, _ = viterbi_multiple(
+                    A,pil,aDl,aDsl,[s.aBl for s in states_list],
+                    np.array([s.right_censoring for s in states_list],dtype=np.int32),
+                    np.array([s.trunc if s.trunc is not None else s.T for s in states_list],
+                        dtype=np.int32),
+                    [np.empty(s.T,dtype='int32') for s in states_list])
+            for s, stateseq in zip(states_list,stateseqs):
+                s.stateseq = stateseq
+
     def sample_forwards(self,betal,betastarl):
         from hsmm_messages_interface import sample_forwards_log
         if self.left_censoring:
             raise NotImplementedError
-        caBl = np.vstack((np.zeros(betal.shape[1]),np.cumsum(self.aBl[:-1],axis=0)))
         self.stateseq = sample_forwards_log(
-                self.trans_matrix,caBl,self.aDl,self.pi_0,betal,betastarl,
-                np.empty(betal.shape[0],dtype='int32'))
+                self.trans_matrix,self.caBl,self.aDl,self.pi_0,betal,betastarl,
+                np.empty(betal.shape[0],dtype='int32'),self.rng_key)
         assert not (0 == self.stateseq).all()
 
     def sample_forwards_python(self,betal,betastarl):
@@ -543,9 +776,11 @@ class HSMMStatesEigen(HSMMStatesPython):
                     states_list[longest].aDl,
                     states_list[longest].aDsl,
                     [s.aBl for s in states_list],
+                    [s.caBl for s in states_list],
                     np.array([s.right_censoring for s in states_list],dtype=np.int32),
                     np.array([s.trunc for s in states_list],dtype=np.int32),
                     stateseqs,
+                    [s.rng_key for s in states_list],
                     )
             for s, loglike, stateseq in zip(states_list,loglikes,stateseqs):
                 s._normalizer = loglike
@@ -561,7 +796,8 @@ class GeoHSMMStates(HSMMStatesPython):
                 self.hmm_trans_matrix,self.pi_0,self.aBl)
         self.stateseq = HMMStatesEigen._sample_backwards_normalized(
                 alphan,
-                self.hmm_trans_matrix.T.copy())
+                self.hmm_trans_matrix.T.copy(),
+                self.rng_key)
 
     @property
     def hmm_trans_matrix(self):
@@ -603,7 +839,21 @@ class GeoHSMMStates(HSMMStatesPython):
     def expected_durations(self,val):
         raise NotImplementedError
 
-    # TODO viterbi!
+    def Viterbi(self):
+        from hmm_messages_interface import viterbi
+        self.stateseq = viterbi(self.hmm_trans_matrix,self.aBl,self.pi_0,
+                np.empty(self.aBl.shape[0],dtype='int32'))
+
+    @classmethod
+    def _Viterbi_multiple(cls,states_list):
+        from hmm_messages_interface import viterbi_multiple
+        if len(states_list) > 0:
+            stateseqs = viterbi_multiple(
+                    states_list[0].hmm_trans_matrix,states_list[0].pi_0,
+                    [s.aBl for s in states_list],
+                    [np.empty(s.T,dtype='int32') for s in states_list])
+            for s, stateseq in zip(states_list,stateseqs):
+                s.stateseq = stateseq
 
 class DelayedGeoHSMMStates(HSMMStatesPython):
     def clear_caches(self):
@@ -611,11 +861,18 @@ class DelayedGeoHSMMStates(HSMMStatesPython):
         self._hmm_aBl = None
         self._hmm_trans_matrix = None
 
+    def _clear_stale(self,changed):
+        super(DelayedGeoHSMMStates,self)._clear_stale(changed)
+        if changed & set(['obs','dur']):
+            self._hmm_aBl = None
+        if changed & set(['trans','dur']):
+            self._hmm_trans_matrix = None
+
     def resample(self):
         alphan, self._normalizer = HMMStatesEigen._messages_forwards_normalized(
                 self.hmm_trans_matrix,self.hmm_pi_0,self.hmm_aBl)
         self.stateseq = HMMStatesEigen._sample_backwards_normalized(
-                alphan,self.hmm_trans_matrix.T.copy())
+                alphan,self.hmm_trans_matrix.T.copy(),self.rng_key)
 
     @property
     def delays(self):
@@ -628,7 +885,8 @@ class DelayedGeoHSMMStates(HSMMStatesPython):
         if self._hmm_trans_matrix is None:
             ps, delays = map(np.array,zip(*[(d.p,d.delay) for d in self.dur_distns]))
             starts, ends = cumsum(delays,strict=True), cumsum(delays,strict=False)
-            trans_matrix = self._hmm_trans_matrix = np.zeros((ends[-1],ends[-1]))
+            trans_matrix = self._hmm_trans_matrix = np.zeros((ends[-1],ends[-1]),
+                    dtype=self.dtype)
 
             for (i,j), Aij in np.ndenumerate(self.trans_matrix):
                 block = trans_matrix[starts[i]:ends[i],starts[j]:ends[j]]
@@ -651,7 +909,7 @@ class DelayedGeoHSMMStates(HSMMStatesPython):
         delays = self.delays
         starts = cumsum(delays,strict=True)
 
-        pi_0 = np.zeros(delays.sum())
+        pi_0 = np.zeros(delays.sum(),dtype=self.dtype)
         pi_0[starts] = self.pi_0
         return pi_0
 
@@ -684,9 +942,9 @@ class _PossibleChangepointsMixin(hmm_states._PossibleChangepointsMixin,HSMMState
             count_transitions(self.stateseq_norep,minlength=self.num_states)
 
         self.expected_durations = expected_durations = \
-                np.zeros((self.num_states,self.Tfull))
+                np.zeros((self.Tfull,self.num_states))
         for state in xrange(self.num_states):
-            expected_durations[state] += \
+            expected_durations[:,state] += \
                 np.bincount(
                     self.durations_censored[self.stateseq_norep == state],
                     minlength=self.Tfull)[:self.Tfull]
@@ -695,15 +953,11 @@ class GeoHSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,GeoHSMMStates
     pass
 
 class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython):
-    def clear_caches(self):
-        self._caBl = None
-        super(HSMMStatesPossibleChangepoints,self).clear_caches()
-
     @property
     def aDl(self):
         # just like parent aDl, except we use Tfull
         if self._aDl is None:
-            aDl = np.empty((self.Tfull,self.num_states))
+            aDl = np.empty((self.Tfull,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.Tfull + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDl[:,idx] = dur_distn.log_pmf(possible_durations)
@@ -714,7 +968,7 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
     def aDsl(self):
         # just like parent aDl, except we use Tfull
         if self._aDsl is None:
-            aDsl = np.empty((self.Tfull,self.num_states))
+            aDsl = np.empty((self.Tfull,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.Tfull + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDsl[:,idx] = dur_distn.log_sf(possible_durations)
@@ -725,7 +979,7 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
     def mf_aDl(self):
         # just like parent aDl, except we use Tfull
         if self._aDl is None:
-            aDl = np.empty((self.Tfull,self.num_states))
+            aDl = np.empty((self.Tfull,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.Tfull + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDl[:,idx] = dur_distn.expected_log_pmf(possible_durations)
@@ -736,7 +990,7 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
     def mf_aDsl(self):
         # just like parent aDl, except we use Tfull
         if self._aDsl is None:
-            aDsl = np.empty((self.Tfull,self.num_states))
+            aDsl = np.empty((self.Tfull,self.num_states),dtype=self.dtype)
             possible_durations = np.arange(1,self.Tfull + 1,dtype=np.float64)
             for idx, dur_distn in enumerate(self.dur_distns):
                 aDsl[:,idx] = dur_distn.expected_log_sf(possible_durations)
@@ -750,18 +1004,10 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
     # TODO wrap the duration stuff into single functions. reduces passing
     # around, reduces re-computation in this case
 
-    # backwards messages potentials
-
-    @property
-    def caBl(self):
-        if self._caBl is None:
-            self._caBl = np.vstack((np.zeros(self.num_states),self.aBl.cumsum(0)))
-        return self._caBl
-
+    # NOTE: the cumulative observation potentials are inherited, since the
+    # blocks' likelihoods are in aBl
 
-    def cumulative_obs_potentials(self,tblock):
-        return self.caBl[tblock+1:][:self.trunc], self.caBl[tblock]
-        # return self.aBl[tblock:].cumsum(0)[:self.trunc]
+    # backwards messages potentials
 
     def dur_potentials(self,tblock):
         possible_durations = self.segmentlens[tblock:].cumsum()[:self.trunc].astype('int32')
@@ -774,10 +1020,6 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
 
     # forwards messages potentials
 
-    def reverse_cumulative_obs_potentials(self,tblock):
-        return rcumsum(self.aBl[:tblock+1])\
-                [-self.trunc if self.trunc is not None else None:]
-
     def reverse_dur_potentials(self,tblock):
         possible_durations = rcumsum(self.segmentlens[:tblock+1])\
                 [-self.trunc if self.trunc is not None else None:]
@@ -791,13 +1033,6 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
 
     # mean field messages potentials
 
-    def mf_cumulative_obs_potentials(self,tblock):
-        return self.mf_aBl[tblock:].cumsum(0)[:self.trunc], 0.
-
-    def mf_reverse_cumulative_obs_potentials(self,tblock):
-        return rcumsum(self.mf_aBl[:tblock+1])\
-                [-self.trunc if self.trunc is not None else None:]
-
     def mf_dur_potentials(self,tblock):
         possible_durations = self.segmentlens[tblock:].cumsum()[:self.trunc]
         return self.mf_aDl[possible_durations -1]
@@ -881,7 +1116,7 @@ class HSMMStatesPossibleChangepoints(_PossibleChangepointsMixin,HSMMStatesPython
                     + cB - (offset + normalizer),
                     logpmfs[possible_durations -1])
         np.seterr(**errs)
-        return np.exp(logpmfs.T)
+        return np.exp(logpmfs)
 
 
 ###################
@@ -912,7 +1147,7 @@ class DiagGaussStates(HSMMStatesPossibleChangepointsSeparateTrans):
                   + (mus**2*Js - 1./2*np.log(2*np.pi*sigmas)).sum(1)
             aBl[np.isnan(aBl).any(1)] = 0.
 
-            aBBl = np.empty((self.Tblock,self.num_states))
+            aBBl = np.empty((self.Tblock,self.num_states),dtype=self.dtype)
             for idx, (start,stop) in enumerate(self.changepoints):
                 aBBl[idx] = aBl[start:stop].sum(0)
 
@@ -950,7 +1185,7 @@ class DiagGaussGMMStates(HSMMStatesPossibleChangepointsSeparateTrans):
             aBl = self._aBl = np.logaddexp.reduce(all_likes, axis=2)
             aBl[np.isnan(aBl).any(1)] = 0.
 
-            aBBl = self._aBBl = np.empty((self.Tblock,self.num_states))
+            aBBl = self._aBBl = np.empty((self.Tblock,self.num_states),dtype=self.dtype)
             for idx, (start,stop) in enumerate(self.changepoints):
                 aBBl[idx] = aBl[start:stop].sum(0)
 
@@ -968,7 +1203,7 @@ class DiagGaussGMMStates(HSMMStatesPossibleChangepointsSeparateTrans):
                 sigmas *= self.model.temperature
 
             from pyhsmm.util.temp import gmm_likes
-            self._aBBl = np.empty((self.Tblock,self.num_states))
+            self._aBBl = np.empty((self.Tblock,self.num_states),dtype=self.dtype)
             gmm_likes(self.data,sigmas,mus,weights,changepoints,self._aBBl)
         return self._aBBl
 
@@ -994,11 +1229,11 @@ def hsmm_messages_backwards_log(
     for t in xrange(T-1,-1,-1):
         cB, offset = cumulative_obs_potentials(t)
         dp = dur_potentials(t)
+        cB = cB - offset # NOTE: before betastarl, which may be float32, sees it
         np.logaddexp.reduce(betal[t:t+cB.shape[0]] + cB + dur_potentials(t),
                 axis=0, out=betastarl[t])
-        betastarl[t] -= offset
         if right_censoring:
-            np.logaddexp(betastarl[t], cB[-1] - offset + dur_survival_potentials(t),
+            np.logaddexp(betastarl[t], cB[-1] + dur_survival_potentials(t),
                     out=betastarl[t])
         np.logaddexp.reduce(betastarl[t] + trans_potentials(t-1),
                 axis=1, out=betal[t-1])
@@ -1045,12 +1280,15 @@ def hsmm_sample_forwards_log(
     trans_potentials, initial_state_potential,
     cumulative_obs_potentials, dur_potentials, dur_survival_potentails,
     betal, betastarl,
-    left_censoring=False, right_censoring=True):
+    left_censoring=False, right_censoring=True, rng_key=None):
 
     T, _ = betal.shape
     stateseq = np.empty(T,dtype=np.int32)
     durations = []
 
+    # NOTE: two uniforms per segment, one for the state and one for the duration
+    randseq = uniform_stream(2*T,rng_key)
+
     t = 0
 
     if left_censoring:
@@ -1063,13 +1301,13 @@ def hsmm_sample_forwards_log(
         nextstate_distn_log = nextstate_unsmoothed + betastarl[t]
         nextstate_distn = np.exp(nextstate_distn_log - np.logaddexp.reduce(nextstate_distn_log))
         assert nextstate_distn.sum() > 0
-        state = sample_discrete(nextstate_distn)
+        state = sample_discrete(nextstate_distn,u=randseq[2*len(durations)])
 
         ## sample the duration
         dur_logpmf = dur_potentials(t)[:,state]
         obs, offset = cumulative_obs_potentials(t)
         obs, offset = obs[:,state], offset[state]
-        durprob = np.random.random()
+        durprob = randseq[2*len(durations)+1]
 
         dur = 0 # NOTE: always incremented at least once
         while durprob > 0 and dur < dur_logpmf.shape[0] and t+dur < T:
@@ -1120,7 +1358,7 @@ def hsmm_maximizing_assignment(
 
     t = 0
     state = (betastar_scores[t] + initial_state_potential).argmax()
-    dur = betastar_args[t,state]
+    dur = betastar_args[t,state] + 1
     stateseq[t:t+dur] = state
     t += dur
     while t < T:
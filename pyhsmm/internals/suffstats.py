@@ -0,0 +1,60 @@
+from __future__ import division
+import numpy as np
+
+from pyhsmm.basic.distributions import Gaussian, DiagonalGaussian
+
+# NOTE: these reduce the expected statistics of some sequences to fixed-size
+# weighted sufficient statistics for each observation distribution, and update
+# the distributions from sums of them, so parallel mean field and EM steps can
+# send back a few small arrays per worker instead of the T x N expected states.
+# they cover the families whose mean field and max likelihood updates only
+# depend on their weighted statistics; reducible says if all the distributions
+# in a list are covered.
+
+def _func(method):
+    return getattr(method,'im_func',method)
+
+def _family(o):
+    for cls in (Gaussian, DiagonalGaussian):
+        if _func(type(o).meanfieldupdate) is _func(cls.meanfieldupdate) \
+                and _func(type(o).max_likelihood) is _func(cls.max_likelihood):
+            return cls
+    return None
+
+def reducible(obs_distns):
+    return all(_family(o) is not None for o in obs_distns)
+
+def weighted_statistics(o,datas,weights):
+    if _family(o) is Gaussian:
+        return o._get_weighted_statistics(datas,weights,len(o.mu_0))
+    return o._get_weighted_statistics(datas,weights)
+
+def meanfieldupdate(o,stats):
+    # what meanfieldupdate does with the statistics it computes
+    o.mf_natural_hypparam = o.natural_hypparam + stats
+
+def identifiable(o,stats):
+    'whether stats carry enough weight for a non-degenerate max likelihood fit'
+    if _family(o) is Gaussian:
+        return stats[-1,-1] > stats.shape[0] - 2
+    return stats[2][0] > 1
+
+def max_likelihood(o,stats):
+    # NOTE: the distributions' max_likelihood methods only take data, so this
+    # repeats their updates on the statistics (test_suffstats checks they agree)
+    if _family(o) is Gaussian:
+        D = stats.shape[0] - 2
+        n, x, xxt = stats[-1,-1], stats[-2,:D], stats[:D,:D]
+        if n < D or (np.linalg.svd(xxt,compute_uv=False) > 1e-6).sum() < D:
+            # degenerate, as in Gaussian.max_likelihood
+            o.broken = True
+            o.mu = 99999999*np.ones(D)
+            o.sigma = np.eye(D)
+        else:
+            o.mu = x/n
+            o.sigma = xxt/n - np.outer(o.mu,o.mu)
+    else:
+        sumsq, sums, n, _ = stats
+        o.mu = sums/n
+        o.sigmas = sumsq/n - o.mu**2
+
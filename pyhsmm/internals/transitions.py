@@ -12,7 +12,7 @@ import pyhsmm
 from pyhsmm.basic.abstractions import GibbsSampling
 from pyhsmm.basic.distributions import GammaCompoundDirichlet, Multinomial, \
         MultinomialAndConcentration
-from pyhsmm.util.general import rle, cumsum, rcumsum
+from pyhsmm.util.general import rle, cumsum, rcumsum, bump_version
 try:
     from pyhsmm.util.cstats import sample_crp_tablecounts, count_transitions
 except ImportError:
@@ -49,6 +49,7 @@ class _HMMTransitionsBase(object):
         self._row_distns = \
                 [Multinomial(alpha_0=self.alpha,K=N,alphav_0=self.alphav,weights=row)
                         for row in trans_matrix]
+        bump_version(self) # NOTE: e.g. for the M steps, which don't bump it
 
     @property
     def alpha(self):
@@ -12,9 +12,10 @@ from warnings import warn
 import pyhsmm
 from pyhsmm.basic.abstractions import Model, ModelGibbsSampling, \
         ModelEM, ModelMAPEM, ModelMeanField, ModelMeanFieldSVI, ModelParallelTempering
+from pyhsmm.internals import suffstats, forecast
 from pyhsmm.internals import hmm_states, hsmm_states, hsmm_inb_states, \
         initial_state, transitions
-from pyhsmm.util.general import list_split
+from pyhsmm.util.general import list_split, bump_version, sum_padded
 from pyhsmm.util.profiling import line_profiled
 
 ################
@@ -32,10 +33,21 @@ class _HMMBase(Model):
             obs_distns,
             trans_distn=None,
             alpha=None,alpha_a_0=None,alpha_b_0=None,trans_matrix=None,
-            init_state_distn=None,init_state_concentration=None,pi_0=None):
+            init_state_distn=None,init_state_concentration=None,pi_0=None,
+            dtype=np.float64,seed=None):
         self.obs_distns = obs_distns
         self.states_list = []
 
+        # NOTE: the states objects do their likelihood computations and message
+        # passing in this precision; np.float32 halves their memory use
+        self.dtype = dtype
+
+        # NOTE: with a seed, each state sequence is sampled from a random stream
+        # keyed by (seed, iteration, sequence index), so resample_states gives
+        # the same sequences for any num_procs
+        self.seed = seed
+        self.iteration = 0
+
         if trans_distn is not None:
             self.trans_distn = trans_distn
         elif not None in (alpha_a_0,alpha_b_0):
@@ -65,12 +77,14 @@ class _HMMBase(Model):
                 self._states_class(
                     model=self,data=data,
                     stateseq=stateseq,**kwargs))
+        self._clear_reduced_stats()
 
     def generate(self,T,keep=True):
         s = self._states_class(model=self,T=T,initialize_from_prior=True)
         data = self._generate_obs(s)
         if keep:
             self.states_list.append(s)
+            self._clear_reduced_stats()
         return data, s.stateseq
 
     def _generate_obs(self,s):
@@ -90,21 +104,24 @@ class _HMMBase(Model):
 
         return s.data
 
-    def log_likelihood(self,data=None,**kwargs):
+    def log_likelihood(self,data=None,num_threads=0,**kwargs):
         if data is not None:
             if isinstance(data,np.ndarray):
-                self.add_data(data=data,generate=False,**kwargs)
-                return self.states_list.pop().log_likelihood()
+                return self.score([data],**kwargs)[0]
             else:
                 assert isinstance(data,list)
-                loglike = 0.
-                for d in data:
-                    self.add_data(data=d,generate=False,**kwargs)
-                    loglike += self.states_list.pop().log_likelihood()
-                return loglike
+                return self.score(data,num_threads=num_threads,**kwargs).sum()
+        elif num_threads > 0:
+            return self._threaded_log_likelihood(self.states_list,num_threads)
         else:
             return sum(s.log_likelihood() for s in self.states_list)
 
+    def _threaded_log_likelihood(self,states_list,num_threads):
+        import parallel
+        return sum(parallel.map_shards(
+            lambda shard: sum(s.log_likelihood() for s in shard),
+            states_list,num_threads))
+
     def predict(self,seed_data,timesteps,**kwargs):
         full_data = np.vstack((seed_data,np.nan*np.ones((timesteps,seed_data.shape[1]))))
         self.add_data(full_data,**kwargs)
@@ -112,44 +129,14 @@ class _HMMBase(Model):
         s.resample()  # fills in states
         return self._generate_obs(s), s.stateseq  # fills in nan obs
 
-    def predictive_likelihoods(self,test_data,forecast_horizons,num_procs=None,**kwargs):
-        assert all(k > 0 for k in forecast_horizons)
+    def predictive_likelihoods(self,test_data,forecast_horizons,num_procs=None,
+            num_threads=0,**kwargs):
+        # NOTE: num_procs is an old name for num_threads (see pyhsmm.internals.forecast)
         self.add_data(data=test_data,**kwargs)
         s = self.states_list.pop()
-        alphal = s.messages_forwards_log()
-
-        cmaxes = alphal.max(axis=1)
-        scaled_alphal = np.exp(alphal - cmaxes[:,None])
-
-        if not num_procs:
-            prev_k = 0
-            outs = []
-            for k in forecast_horizons:
-                step = k - prev_k
-                cmaxes = cmaxes[:-step]
-                scaled_alphal = scaled_alphal[:-step].dot(np.linalg.matrix_power(s.trans_matrix,step))
-
-                future_likelihoods = np.logaddexp.reduce(
-                        np.log(scaled_alphal) + cmaxes[:,None] + s.aBl[k:],axis=1)
-                past_likelihoods = np.logaddexp.reduce(alphal[:-k],axis=1)
-                outs.append(future_likelihoods - past_likelihoods)
-
-                prev_k = k
-        else:
-            from joblib import Parallel, delayed
-            import parallel
-
-            parallel.cmaxes = cmaxes
-            parallel.alphal = alphal
-            parallel.scaled_alphal = scaled_alphal
-            parallel.trans_matrix = s.trans_matrix
-            parallel.aBl = s.aBl
-
-            outs = Parallel(n_jobs=num_procs,backend='multiprocessing')\
-                    (delayed(parallel._get_predictive_likelihoods)(k)
-                            for k in forecast_horizons)
-
-        return outs
+        return forecast.predictive_likelihoods(
+                s.messages_forwards_log(),s.trans_matrix,s.aBl,forecast_horizons,
+                num_threads=num_threads or num_procs or 0)
 
     @property
     def stateseqs(self):
@@ -198,16 +185,49 @@ class _HMMBase(Model):
     ### predicting
 
     def heldout_viterbi(self,data,**kwargs):
-        self.add_data(data=data,stateseq=np.zeros(len(data)),**kwargs)
-        s = self.states_list.pop()
-        s.Viterbi()
-        return s.stateseq
+        'data can be an array or a list of arrays, which are decoded together'
+        stateseqs = self.decode(data if isinstance(data,list) else [data],**kwargs)
+        return stateseqs if isinstance(data,list) else stateseqs[0]
 
     def heldout_state_marginals(self,data,**kwargs):
-        self.add_data(data=data,stateseq=np.zeros(len(data)),**kwargs)
-        s = self.states_list.pop()
-        s.E_step()
-        return s.expected_states
+        return self.marginals([data],**kwargs)[0]
+
+    ### batched held-out inference
+
+    # NOTE: these work on states objects that are never added to states_list
+    # (and don't generate state sequences), so they leave the model alone and
+    # can be called from several threads at once. within a call, the states
+    # class's *_multiple methods batch the kernel calls, and num_threads splits
+    # the sequences over threads (see pyhsmm.parallel.map_shards).
+
+    def score(self,datas,num_threads=0,**kwargs):
+        'the log likelihood of each array in datas, as an array'
+        return np.array(self._heldout_map(
+            lambda states_list: [s.log_likelihood() for s in states_list],
+            datas,num_threads,**kwargs))
+
+    def decode(self,datas,num_threads=0,**kwargs):
+        'the Viterbi state sequence of each array in datas'
+        def decode(states_list):
+            self._states_class._Viterbi_multiple(states_list)
+            return [s.stateseq for s in states_list]
+        return self._heldout_map(decode,datas,num_threads,**kwargs)
+
+    def marginals(self,datas,num_threads=0,**kwargs):
+        'the posterior state marginals (a T x num_states array) of each array in datas'
+        def marginals(states_list):
+            self._states_class._E_step_multiple(states_list)
+            return [s.expected_states for s in states_list]
+        return self._heldout_map(marginals,datas,num_threads,**kwargs)
+
+    def _heldout_map(self,f,datas,num_threads=0,**kwargs):
+        states_list = [self._states_class(model=self,data=np.asarray(data),generate=False,**kwargs)
+                for data in datas]
+        if num_threads == 0:
+            return f(states_list)
+        import parallel
+        return list(itertools.chain.from_iterable(
+            parallel.map_shards(f,states_list,num_threads)))
 
     def _resample_from_mf(self):
         self.trans_distn._resample_from_mf()
@@ -215,12 +235,54 @@ class _HMMBase(Model):
         for o in self.obs_distns:
             o._resample_from_mf()
 
+    ### reduced expected statistics
+
+    # NOTE: these sum the expected statistics of some states objects into
+    # fixed-size statistics for the parameter updates, which is what the
+    # workers send back in the reduced parallel mean field and EM steps
+
+    def _reduce_expected_stats(self,states_list):
+        return dict(
+            obs=[suffstats.weighted_statistics(o,[s.data for s in states_list],
+                    [s.expected_states[:,state] for s in states_list])
+                for state, o in enumerate(self.obs_distns)],
+            trans=sum(s.expected_transcounts for s in states_list),
+            init=sum(s.expected_states[0] for s in states_list))
+
+    def _sum_expected_stats(self,allstats):
+        return dict(
+            obs=[sum(stats) for stats in zip(*[s['obs'] for s in allstats])],
+            trans=sum(s['trans'] for s in allstats),
+            init=sum(s['init'] for s in allstats))
+
+    def _check_reducible(self):
+        if not suffstats.reducible(self.obs_distns):
+            raise NotImplementedError(
+                'reduced statistics are only implemented for Gaussian '
+                'and DiagonalGaussian observation distributions')
+
+    def _collect_reduced(self,result):
+        # the states objects only get their normalizers back
+        allstats, normalizers = result
+        for s, normalizer in zip(self.states_list,normalizers):
+            s._normalizer = normalizer
+        return self._sum_expected_stats(allstats)
+
     ### caching
 
     def _clear_caches(self):
         for s in self.states_list:
             s.clear_caches()
 
+    # NOTE: the Gibbs steps bump the versions of the parameter objects they
+    # resample, so the states can keep whatever doesn't depend on them (e.g.
+    # the likelihoods when only the transitions were resampled, or the columns
+    # of the states whose observation distributions didn't change)
+
+    def _clear_stale_caches(self):
+        for s in self.states_list:
+            s.clear_stale_caches()
+
     def __getstate__(self):
         self._clear_caches()
         return self.__dict__.copy()
@@ -425,9 +487,9 @@ class _HMMBase(Model):
 
 class _HMMGibbsSampling(_HMMBase,ModelGibbsSampling):
     @line_profiled
-    def resample_model(self,num_procs=0):
+    def resample_model(self,num_procs=0,num_threads=0):
         self.resample_parameters()
-        self.resample_states(num_procs=num_procs)
+        self.resample_states(num_procs=num_procs,num_threads=num_threads)
 
     @line_profiled
     def resample_parameters(self):
@@ -438,22 +500,34 @@ class _HMMGibbsSampling(_HMMBase,ModelGibbsSampling):
     def resample_obs_distns(self):
         for state, distn in enumerate(self.obs_distns):
             distn.resample([s.data[s.stateseq == state] for s in self.states_list])
-        self._clear_caches()
+            bump_version(distn)
+        self._clear_stale_caches()
 
     def resample_trans_distn(self):
         self.trans_distn.resample([s.stateseq for s in self.states_list])
-        self._clear_caches()
+        bump_version(self.trans_distn)
+        self._clear_stale_caches()
 
     def resample_init_state_distn(self):
         self.init_state_distn.resample([s.stateseq[0] for s in self.states_list])
-        self._clear_caches()
+        bump_version(self.init_state_distn)
+        self._clear_stale_caches()
 
-    def resample_states(self,num_procs=0):
-        if num_procs == 0:
+    def resample_states(self,num_procs=0,num_threads=0):
+        self._set_rng_keys(self.states_list)
+        if num_procs == 0 and num_threads == 0:
             for s in self.states_list:
                 s.resample()
+        elif num_procs == 0:
+            self._threaded_resample_states(self.states_list,num_threads)
         else:
             self._joblib_resample_states(self.states_list,num_procs)
+        self.iteration += 1
+
+    def _set_rng_keys(self,states_list):
+        for idx, s in enumerate(states_list):
+            s.rng_key = (self.seed,self.iteration,idx) \
+                    if self.seed is not None else None
 
     def copy_sample(self):
         new = copy.copy(self)
@@ -461,52 +535,78 @@ class _HMMGibbsSampling(_HMMBase,ModelGibbsSampling):
         new.trans_distn = self.trans_distn.copy_sample()
         new.init_state_distn = self.init_state_distn.copy_sample()
         new.states_list = [s.copy_sample(new) for s in self.states_list]
+        new._clear_reduced_stats()
         return new
 
-    ### joblib parallel stuff here
+    ### parallel stuff here (see pyhsmm.parallel)
 
-    def _joblib_resample_states(self,states_list,num_procs):
-        from joblib import Parallel, delayed
+    def _threaded_resample_states(self,states_list,num_threads):
         import parallel
+        parallel.map_shards(lambda shard: [s.resample() for s in shard],
+                states_list,num_threads)
 
-        # warn('joblib is segfaulting on OS X only, not sure why')
+    def _joblib_resample_states(self,states_list,num_procs):
+        import parallel
 
         if len(states_list) > 0:
-            joblib_args = list_split(
-                    [self._get_joblib_pair(s) for s in states_list],
-                    num_procs)
-
-            parallel.model = self
-            parallel.args = joblib_args
-
-            raw_stateseqs = Parallel(n_jobs=num_procs,backend='multiprocessing')\
-                    (delayed(parallel._get_sampled_stateseq)(idx)
-                            for idx in range(len(joblib_args)))
-
-            for s, (stateseq, log_likelihood) in zip(
-                    [s for grp in list_split(states_list,num_procs) for s in grp],
-                    [seq for grp in raw_stateseqs for seq in grp]):
+            results = parallel.get_pool(self,num_procs).resample(self,states_list)
+            for s, (stateseq, log_likelihood) in zip(states_list,results):
                 s.stateseq, s._normalizer = stateseq, log_likelihood
 
     def _get_joblib_pair(self,states_obj):
-        return (states_obj.data,states_obj._kwargs)
+        return (states_obj.data,dict(states_obj._kwargs,rng_key=states_obj.rng_key))
 
 
 class _HMMMeanField(_HMMBase,ModelMeanField):
-    def meanfield_coordinate_descent_step(self,num_procs=0):
-        self._meanfield_update_sweep(num_procs=num_procs)
+    def meanfield_coordinate_descent_step(self,num_procs=0,num_threads=0,reduced=False):
+        if reduced:
+            self._reduced_meanfield_update_sweep(num_procs=num_procs)
+        else:
+            self._meanfield_update_sweep(num_procs=num_procs,num_threads=num_threads)
         return self._vlb()
 
-    def _meanfield_update_sweep(self,num_procs=0):
+    def _meanfield_update_sweep(self,num_procs=0,num_threads=0):
         # NOTE: we want to update the states factor last to make the VLB
         # computation efficient, but to update the parameters first we have to
         # ensure everything in states_list has expected statistics computed
         self._meanfield_update_states_list(
             [s for s in self.states_list if not hasattr(s,'expected_states')],
-            num_procs)
+            num_procs,num_threads)
 
         self.meanfield_update_parameters()
-        self.meanfield_update_states(num_procs)
+        self.meanfield_update_states(num_procs,num_threads)
+
+    def _reduced_meanfield_update_sweep(self,num_procs=0):
+        # NOTE: like _meanfield_update_sweep, except that the states objects
+        # don't keep their expected statistics, only the model keeps their sum
+        # from the last states update for the next parameter update
+        if getattr(self,'_reduced_stats',None) is None:
+            self._reduced_meanfield_update_states(num_procs)
+
+        self._meanfield_update_parameters_reduced(self._reduced_stats)
+        self._reduced_meanfield_update_states(num_procs)
+
+    def _reduced_meanfield_update_states(self,num_procs=0):
+        self._check_reducible()
+        if num_procs == 0:
+            self._states_class._meanfieldupdate_multiple(self.states_list)
+            self._reduced_stats = self._reduce_expected_stats(self.states_list)
+        else:
+            import parallel
+            self._reduced_stats = self._collect_reduced(
+                parallel.get_pool(self,num_procs).meanfield_reduced(self,self.states_list))
+
+    def _clear_reduced_stats(self):
+        # NOTE: the reduced statistics are a sum over states_list, so anything
+        # that adds or removes states objects other than add_data has to call
+        # this too
+        self._reduced_stats = None
+
+    def _meanfield_update_parameters_reduced(self,stats):
+        for o, ostats in zip(self.obs_distns,stats['obs']):
+            suffstats.meanfieldupdate(o,ostats)
+        self.trans_distn.meanfieldupdate([stats['trans']])
+        self.init_state_distn.meanfieldupdate([stats['init']])
 
     def meanfield_update_parameters(self):
         self.meanfield_update_obs_distns()
@@ -526,13 +626,17 @@ class _HMMMeanField(_HMMBase,ModelMeanField):
         self.init_state_distn.meanfieldupdate(
                 [s.expected_states[0] for s in self.states_list])
 
-    def meanfield_update_states(self,num_procs=0):
-        self._meanfield_update_states_list(self.states_list,num_procs=num_procs)
+    def meanfield_update_states(self,num_procs=0,num_threads=0):
+        self._meanfield_update_states_list(self.states_list,
+                num_procs=num_procs,num_threads=num_threads)
 
-    def _meanfield_update_states_list(self,states_list,num_procs=0):
-        if num_procs == 0:
-            for s in states_list:
-                s.meanfieldupdate()
+    def _meanfield_update_states_list(self,states_list,num_procs=0,num_threads=0):
+        if num_procs == 0 and num_threads == 0:
+            self._states_class._meanfieldupdate_multiple(states_list)
+        elif num_procs == 0:
+            import parallel
+            parallel.map_shards(self._states_class._meanfieldupdate_multiple,
+                    states_list,num_threads)
         else:
             self._joblib_meanfield_update_states(states_list,num_procs)
 
@@ -544,26 +648,14 @@ class _HMMMeanField(_HMMBase,ModelMeanField):
         vlb += sum(o.get_vlb() for o in self.obs_distns)
         return vlb
 
-    ### joblib parallel stuff here
+    ### parallel stuff here (see pyhsmm.parallel)
 
     def _joblib_meanfield_update_states(self,states_list,num_procs):
-        if len(states_list) > 0:
-            from joblib import Parallel, delayed
-            import parallel
-
-            joblib_args = list_split(
-                    [self._get_joblib_pair(s) for s in states_list],
-                    num_procs)
-
-            parallel.model = self
-            parallel.args = joblib_args
-
-            allstats = Parallel(n_jobs=num_procs,backend='multiprocessing')\
-                    (delayed(parallel._get_stats)(idx) for idx in range(len(joblib_args)))
+        import parallel
 
-            for s, stats in zip(
-                    [s for grp in list_split(states_list) for s in grp],
-                    [s for grp in allstats for s in grp]):
+        if len(states_list) > 0:
+            allstats = parallel.get_pool(self,num_procs).meanfield(self,states_list)
+            for s, stats in zip(states_list,allstats):
                 s.all_expected_stats = stats
 
     def _get_joblib_pair(self,states_obj):
@@ -577,8 +669,7 @@ class _HMMSVI(_HMMBase,ModelMeanFieldSVI):
         ## compute the local mean field step for the minibatch
         mb_states_list = self._get_mb_states_list(minibatch,**kwargs)
         if num_procs == 0:
-            for s in mb_states_list:
-                s.meanfieldupdate()
+            self._states_class._meanfieldupdate_multiple(mb_states_list)
         else:
             self._joblib_meanfield_update_states(mb_states_list,num_procs)
 
@@ -617,15 +708,114 @@ class _HMMSVI(_HMMBase,ModelMeanFieldSVI):
 
 
 class _HMMEM(_HMMBase,ModelEM):
-    def EM_step(self):
+    def EM_step(self,num_threads=0,num_procs=0):
         assert len(self.states_list) > 0, 'Must have data to run EM'
+        self._EM_M_step(self._EM_E_step(num_threads,num_procs)[1])
+
+    def accelerated_EM_fit(self,tol=1e-1,maxiter=100,num_threads=0,num_procs=0):
+        '''
+        EM with SQUAREM extrapolation (Varadhan and Roland, 2008). Each
+        iteration takes two EM steps, extrapolates the parameters along the
+        line through the three iterates, and keeps the extrapolated parameters
+        if they are valid and their likelihood is at least that of the
+        parameters the two EM steps reached. Otherwise the iteration keeps the
+        result of the two EM steps.
+
+        Returns the log likelihoods of the parameters kept at each iteration,
+        like EM_fit, and a dict with the number of iterations, E steps, and
+        accepted extrapolations.
+        '''
+        from pyhsmm.internals import extrapolation
+        assert len(self.states_list) > 0, 'Must have data to run EM'
+        params = extrapolation.parameters(self._EM_parameters())
+        likes, info = [], dict(iterations=0,E_steps=1,extrapolations=0)
+        max_step = 1.
+
+        # the E step at the parameters an iteration keeps is the first E step
+        # of the next iteration
+        like, stats = self._EM_E_step(num_threads,num_procs)
+        for itr in xrange(maxiter):
+            theta0 = extrapolation.pack(params)
+            self._EM_M_step(stats)
+            theta1 = extrapolation.pack(params)
+            self._EM_M_step(self._EM_E_step(num_threads,num_procs)[1])
+            theta2 = extrapolation.pack(params)
+            like, stats = self._EM_E_step(num_threads,num_procs)
+            info['iterations'] += 1
+            info['E_steps'] += 2
+
+            r, v = theta1 - theta0, theta2 - 2*theta1 + theta0
+            alpha = -np.sqrt(r.dot(r) / v.dot(v)) if v.dot(v) > 0 else -1.
+            alpha = min(-1.,max(-max_step,alpha))
+            if alpha == -max_step:
+                max_step *= 4 # the safeguard bound grows while steps hit it
+
+            if alpha < -1. and extrapolation.unpack(params,theta0 - 2*alpha*r + alpha**2*v):
+                extrapolated_like, extrapolated_stats = self._EM_E_step(num_threads,num_procs)
+                info['E_steps'] += 1
+                if extrapolated_like >= like:
+                    like, stats = extrapolated_like, extrapolated_stats
+                    info['extrapolations'] += 1
+                else:
+                    # the extrapolated E step replaced the one at theta2
+                    extrapolation.unpack(params,theta2)
+                    like, stats = self._EM_E_step(num_threads,num_procs)
+                    info['E_steps'] += 1
+                    max_step = max(1.,max_step/4)
+
+            likes.append(like)
+            if len(likes) > 1 and likes[-1] - likes[-2] < tol:
+                break
+        else:
+            print 'WARNING: accelerated_EM_fit reached maxiter of %d' % maxiter
+
         self._clear_caches()
-        self._E_step()
-        self._M_step()
+        return likes, info
 
-    def _E_step(self):
-        for s in self.states_list:
-            s.E_step()
+    def _EM_E_step(self,num_threads=0,num_procs=0):
+        # the log likelihood of the current parameters and the reduced
+        # statistics, which are None when the states objects hold the results
+        self._clear_caches()
+        if num_procs > 0:
+            stats = self._reduced_E_step(num_procs)
+        else:
+            stats = None
+            self._E_step(num_threads)
+        return sum(s._normalizer for s in self.states_list), stats
+
+    def _EM_M_step(self,stats):
+        if stats is None:
+            self._M_step()
+        else:
+            self._M_step_reduced(stats)
+
+    def _EM_parameters(self):
+        # the (object, attribute name) pairs set by the M step
+        params = [(o,name) for o in self.obs_distns for name in sorted(o.params)]
+        params.append((self.trans_distn,'trans_matrix'))
+        if not getattr(self.init_state_distn,'_is_steady_state',True):
+            params.append((self.init_state_distn,'weights'))
+        return params
+
+    def _reduced_E_step(self,num_procs):
+        import parallel
+        self._check_reducible()
+        return self._collect_reduced(
+            parallel.get_pool(self,num_procs).E_step_reduced(self,self.states_list))
+
+    def _M_step_reduced(self,stats):
+        for o, ostats in zip(self.obs_distns,stats['obs']):
+            suffstats.max_likelihood(o,ostats)
+        self.init_state_distn.max_likelihood(expected_states_list=[stats['init']])
+        self.trans_distn.max_likelihood(expected_transcounts=[stats['trans']])
+
+    def _E_step(self,num_threads=0):
+        if num_threads == 0:
+            self._states_class._E_step_multiple(self.states_list)
+        else:
+            import parallel
+            parallel.map_shards(self._states_class._E_step_multiple,
+                    self.states_list,num_threads)
 
     def _M_step(self):
         self._M_step_obs_distns()
@@ -673,8 +863,7 @@ class _HMMViterbiEM(_HMMBase,ModelMAPEM):
         self._Viterbi_M_step()
 
     def _Viterbi_E_step(self):
-        for s in self.states_list:
-            s.Viterbi()
+        self._states_class._Viterbi_multiple(self.states_list)
 
     def _Viterbi_M_step(self):
         self._Viterbi_M_step_obs_distns()
@@ -748,7 +937,7 @@ class _HMMPossibleChangepointsMixin(object):
             mb_states_list.append(self.states_list.pop())
         return mb_states_list
 
-    def log_likelihood(self,data=None,changepoints=None,**kwargs):
+    def log_likelihood(self,data=None,changepoints=None,num_threads=0,**kwargs):
         if data is not None:
             if isinstance(data,np.ndarray):
                 assert isinstance(changepoints,list) or changepoints is None
@@ -761,11 +950,19 @@ class _HMMPossibleChangepointsMixin(object):
                 changepoints = changepoints if changepoints is not None \
                         else [None]*len(data)
 
+                if num_threads > 0:
+                    states_list = []
+                    for d, c in zip(data,changepoints):
+                        self.add_data(data=d,changepoints=c,generate=False,**kwargs)
+                        states_list.append(self.states_list.pop())
+                    return self._threaded_log_likelihood(states_list,num_threads)
                 loglike = 0.
                 for d, c in zip(data,changepoints):
                     self.add_data(data=d,changepoints=c,generate=False,**kwargs)
                     loglike += self.states_list.pop().log_likelihood()
                 return loglike
+        elif num_threads > 0:
+            return self._threaded_log_likelihood(self.states_list,num_threads)
         else:
             return sum(s.log_likelihood() for s in self.states_list)
 
@@ -890,6 +1087,7 @@ class _HSMMBase(_HMMBase):
             left_censoring=left_censoring,
             trunc=trunc,
             **kwargs))
+        self._clear_reduced_stats()
 
     @property
     def num_parameters(self):
@@ -897,6 +1095,16 @@ class _HSMMBase(_HMMBase):
                 + sum(d.num_parameters() for d in self.dur_distns) \
                 + self.num_states**2 - self.num_states
 
+    def _reduce_expected_stats(self,states_list):
+        stats = super(_HSMMBase,self)._reduce_expected_stats(states_list)
+        stats['dur'] = sum_padded([s.expected_durations for s in states_list])
+        return stats
+
+    def _sum_expected_stats(self,allstats):
+        stats = super(_HSMMBase,self)._sum_expected_stats(allstats)
+        stats['dur'] = sum_padded([s['dur'] for s in allstats])
+        return stats
+
 #     def plot_durations(self,colors=None,states_objs=None):
 #         if colors is None:
 #             colors = self._get_colors()
@@ -943,7 +1151,8 @@ class _HSMMGibbsSampling(_HSMMBase,_HMMGibbsSampling):
             censored_data=
             [s.durations_censored[s.trunc_slice][s.stateseq_norep[s.trunc_slice] == state]
                 for s in self.states_list])
-        self._clear_caches()
+            bump_version(distn)
+        self._clear_stale_caches()
 
     def copy_sample(self):
         new = super(_HSMMGibbsSampling,self).copy_sample()
@@ -959,9 +1168,19 @@ class _HSMMEM(_HSMMBase,_HMMEM):
     def _M_step_dur_distns(self):
         for state, distn in enumerate(self.dur_distns):
             distn.max_likelihood(
-                    [np.arange(1,s.expected_durations[state].shape[0]+1)
+                    [np.arange(1,s.expected_durations.shape[0]+1)
                         for s in self.states_list],
-                    [s.expected_durations[state] for s in self.states_list])
+                    [s.expected_durations[:,state] for s in self.states_list])
+
+    def _EM_parameters(self):
+        return super(_HSMMEM,self)._EM_parameters() \
+                + [(d,name) for d in self.dur_distns for name in sorted(d.params)]
+
+    def _M_step_reduced(self,stats):
+        super(_HSMMEM,self)._M_step_reduced(stats)
+        durs = stats['dur']
+        for state, distn in enumerate(self.dur_distns):
+            distn.max_likelihood([np.arange(1,durs.shape[0]+1)],[durs[:,state]])
 
 
 class _HSMMMeanField(_HSMMBase,_HMMMeanField):
@@ -972,9 +1191,15 @@ class _HSMMMeanField(_HSMMBase,_HMMMeanField):
     def meanfield_update_dur_distns(self):
         for state, d in enumerate(self.dur_distns):
             d.meanfieldupdate(
-                    [np.arange(1,s.expected_durations[state].shape[0]+1)
+                    [np.arange(1,s.expected_durations.shape[0]+1)
                         for s in self.states_list],
-                    [s.expected_durations[state] for s in self.states_list])
+                    [s.expected_durations[:,state] for s in self.states_list])
+
+    def _meanfield_update_parameters_reduced(self,stats):
+        super(_HSMMMeanField,self)._meanfield_update_parameters_reduced(stats)
+        durs = stats['dur']
+        for state, d in enumerate(self.dur_distns):
+            d.meanfieldupdate([np.arange(1,durs.shape[0]+1)],[durs[:,state]])
 
     def _vlb(self):
         vlb = super(_HSMMMeanField,self)._vlb()
@@ -990,15 +1215,22 @@ class _HSMMSVI(_HSMMBase,_HMMSVI):
     def _meanfield_sgdstep_dur_distns(self,mb_states_list,minibatchfrac,stepsize):
         for state, d in enumerate(self.dur_distns):
             d.meanfield_sgdstep(
-                    [np.arange(1,s.expected_durations[state].shape[0]+1)
+                    [np.arange(1,s.expected_durations.shape[0]+1)
                         for s in mb_states_list],
-                    [s.expected_durations[state] for s in mb_states_list],
+                    [s.expected_durations[:,state] for s in mb_states_list],
                     minibatchfrac,stepsize)
 
 
 class _HSMMINBEMMixin(_HMMEM,ModelEM):
-    def EM_step(self):
-        super(_HSMMINBEMMixin,self).EM_step()
+    def EM_step(self,num_threads=0,num_procs=0):
+        if num_procs > 0:
+            raise NotImplementedError(
+                'parallel EM steps are not implemented for the negative binomial '
+                'duration HSMMs; use num_threads')
+        super(_HSMMINBEMMixin,self).EM_step(num_threads)
+
+    def _M_step(self):
+        super(_HSMMINBEMMixin,self)._M_step()
         for state, distn in enumerate(self.dur_distns):
             distn.max_likelihood(data=None,stats=(
                 sum(s.expected_dur_ns[state] for s in self.states_list),
@@ -1039,7 +1271,8 @@ class _DelayedMixin(object):
             censored_data=
             [s.durations_censored[s.trunc_slice][s.stateseq_norep[s.trunc_slice] == state]
                 - s.delays[state] for s in self.states_list])
-        self._clear_caches()
+            bump_version(distn)
+        self._clear_stale_caches()
 
 #################
 #  HSMM Models  #
@@ -1059,6 +1292,15 @@ class HSMM(HSMMPython):
 class GeoHSMM(HSMMPython):
     _states_class = hsmm_states.GeoHSMMStates
 
+    def _M_step_dur_distns(self):
+        # NOTE: the E step runs on the embedded HMM, so the geometric duration
+        # parameters come from its expected self-transition counts
+        for state, distn in enumerate(self.dur_distns):
+            stays = sum(s._expected_ns[state] for s in self.states_list)
+            tot = sum(s._expected_tots[state] for s in self.states_list)
+            if tot > 0:
+                distn.p = np.clip((tot - stays) / tot,1e-10,1.)
+
 
 class DelayedGeoHSMM(_DelayedMixin,HSMMPython):
     _states_class = hsmm_states.DelayedGeoHSMMStates
@@ -1112,29 +1354,12 @@ class HSMMIntNegBin(_HSMMGibbsSampling,_HSMMMeanField,_HSMMSVI,_HSMMViterbiEM,
     def _vlb(self):
         return 0.  # TODO
 
-    def predictive_likelihoods(self,test_data,forecast_horizons,**kwargs):
+    def predictive_likelihoods(self,test_data,forecast_horizons,num_threads=0,**kwargs):
         self.add_data(data=test_data,**kwargs)
         s = self.states_list.pop()
-        alphal = s.hmm_messages_forwards_log()
-
-        cmaxes = alphal.max(axis=1)
-        scaled_alphal = np.exp(alphal - cmaxes[:,None])
-
-        prev_k = 0
-        outs = []
-        for k in forecast_horizons:
-            step = k - prev_k
-            cmaxes = cmaxes[:-step]
-            scaled_alphal = scaled_alphal[:-step].dot(np.linalg.matrix_power(s.hmm_trans_matrix,step))
-
-            future_likelihoods = np.logaddexp.reduce(
-                    np.log(scaled_alphal) + cmaxes[:,None] + s.hmm_aBl[k:],axis=1)
-            past_likelihoods = np.logaddexp.reduce(alphal[:-k],axis=1)
-            outs.append(future_likelihoods - past_likelihoods)
-
-            prev_k = k
-
-        return outs
+        return forecast.predictive_likelihoods(
+                s.hmm_messages_forwards_log(),s.hmm_trans_matrix,s.hmm_aBl,
+                forecast_horizons,num_threads=num_threads)
 
 
 class WeakLimitHDPHSMMIntNegBin(_WeakLimitHDPMixin,HSMMIntNegBin):
@@ -1203,7 +1428,8 @@ class WeakLimitHDPHSMMTruncatedIntNegBin(_WeakLimitHDPMixin,HSMMIntNegBin):
                 # left truncation level
                 left_truncation_level = distn.delay,
                 )
-        self._clear_caches()
+            bump_version(distn)
+        self._clear_stale_caches()
 
 ##########
 #  meta  #
@@ -1250,13 +1476,15 @@ class _SeparateTransMixin(object):
         for group_id, trans_distn in self.trans_distns.iteritems():
             trans_distn.resample([s.stateseq for s in self.states_list
                 if hash(s.group_id) == hash(group_id)])
-        self._clear_caches()
+            bump_version(trans_distn)
+        self._clear_stale_caches()
 
     def resample_init_state_distn(self):
         for group_id, init_state_distn in self.init_state_distns.iteritems():
             init_state_distn.resample([s.stateseq[0] for s in self.states_list
                 if hash(s.group_id) == hash(group_id)])
-        self._clear_caches()
+            bump_version(init_state_distn)
+        self._clear_stale_caches()
 
     ### Mean field
 
@@ -1298,9 +1526,14 @@ class _SeparateTransMixin(object):
                         if hash(s.group_id) == hash(group_id)],
                     minibatchfrac,stepsize)
 
+    def _reduce_expected_stats(self,states_list):
+        raise NotImplementedError(
+            'reduced statistics are not implemented for models with separate '
+            'transition distributions')
+
     ### EM
 
-    def EM_step(self):
+    def EM_step(self,num_threads=0,num_procs=0):
         raise NotImplementedError
 
     ### Viterbi
@@ -1363,7 +1596,8 @@ class WeakLimitHDPHSMMDelayedIntNegBinSeparateTrans(
             censored_data=
             [s.durations_censored[s.trunc_slice][s.stateseq_norep[s.trunc_slice] == state]
                 - s.delays[state] for s in self.states_list])
-        self._clear_caches()
+            bump_version(distn)
+        self._clear_stale_caches()
 
 
 class WeakLimitHDPHSMMTruncatedIntNegBinSeparateTrans(
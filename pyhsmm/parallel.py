@@ -1,71 +1,258 @@
 from __future__ import division
 import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
+import traceback
+import weakref
 
-# NOTE: pass arguments through global variables instead of arguments to exploit
-# the fact that they're read-only and multiprocessing/joblib uses fork
+from pyhsmm.util.general import list_split
+from pyhsmm.util import datastore
 
-model = None
-args = None
+# NOTE: a model's worker pool is started the first time it's used and then kept
+# for the whole run. each worker holds a shard of the model's data sequences as
+# resident states objects, so an iteration sends just the pickled parameters
+# (the model without its states_list) and gets back state sequences or expected
+# statistics. the shards are reloaded only when a different list of states
+# objects is passed (e.g. for SVI minibatches). everything goes through the
+# pipes, so the workers don't depend on globals set before a fork.
+#
+# with the *_reduced methods, each worker sums the expected statistics of its
+# shard into fixed-size per-state statistics (model._reduce_expected_stats), so
+# what comes back doesn't grow with the lengths of the sequences.
+#
+# views into a pyhsmm.util.datastore.SequenceStore aren't copied to the workers,
+# which map the store's file instead, and sampled state sequences are written
+# into the store's buffers when the states objects use them.
+#
+# the pools are kept in a weak dictionary keyed by the model, so they don't get
+# pickled or copied with it and they're shut down when the model goes away;
+# close_pool shuts one down explicitly.
 
-def _get_stats(idx):
-    grp = args[idx]
+_pools = weakref.WeakKeyDictionary()
 
-    if len(grp) == 0:
-        return []
+def get_pool(model,num_procs):
+    pool = _pools.get(model)
+    if pool is None or pool.num_procs != num_procs:
+        close_pool(model)
+        pool = _pools[model] = WorkerPool(num_procs)
+    return pool
 
-    datas, kwargss = zip(*grp)
+def close_pool(model):
+    pool = _pools.pop(model,None)
+    if pool is not None:
+        pool.close()
 
-    states_list = []
-    for data, kwargs in zip(datas,kwargss):
-        model.add_data(data,stateseq=np.empty(data.shape[0]),**kwargs)
-        states_list.append(model.states_list.pop())
+class WorkerPool(object):
+    def __init__(self,num_procs):
+        self.num_procs = num_procs
+        self._loaded, self._bufs = [], []
+        self._procs, self._conns = [], []
+        for _ in range(num_procs):
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_worker,args=(child_conn,))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._procs.append(proc)
+            self._conns.append(conn)
 
-    for s in states_list:
-        s.meanfieldupdate()
+    def resample(self,model,states_list):
+        results = self._run(model,states_list,'resample',
+                [s.rng_key for s in states_list])
+        # a None stateseq was written into the shared buffer the states had
+        return [(stateseq if stateseq is not None else buf, log_likelihood)
+                for (stateseq, log_likelihood), buf in zip(results,self._bufs)]
 
-    return [s.all_expected_stats for s in states_list]
+    def meanfield(self,model,states_list):
+        return self._run(model,states_list,'meanfield',
+                [None for s in states_list])
 
-def _get_sampled_stateseq(idx):
-    grp = args[idx]
+    def meanfield_reduced(self,model,states_list):
+        return self._run_reduced(model,states_list,'meanfield_reduced')
 
-    if len(grp) == 0:
-        return []
+    def E_step_reduced(self,model,states_list):
+        return self._run_reduced(model,states_list,'E_step_reduced')
+
+    def close(self):
+        for conn, proc in zip(self._conns,self._procs):
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+            proc.join()
+            conn.close()
+        self._procs, self._conns, self._loaded, self._bufs = [], [], [], []
+
+    def __del__(self):
+        self.close()
+
+    def _run(self,model,states_list,method,args):
+        self._check_loaded(model,states_list)
+
+        params = _dumps_parameters(model)
+        for conn, shard in zip(self._conns,self._shards):
+            conn.send((method,params,[args[idx] for idx in shard]))
+
+        out = [None]*len(states_list)
+        for shard, results in zip(self._shards,self._recv_all()):
+            for idx, result in zip(shard,results):
+                out[idx] = result
+        return out
+
+    def _run_reduced(self,model,states_list,method):
+        # returns each worker's reduced statistics (see model._reduce_expected_stats)
+        # and the normalizers of the sequences, in order
+        self._check_loaded(model,states_list)
+
+        params = _dumps_parameters(model)
+        for conn in self._conns:
+            conn.send((method,params,None))
+
+        allstats, normalizers = [], [None]*len(states_list)
+        for shard, (stats, shard_normalizers) in zip(self._shards,self._recv_all()):
+            if len(shard) > 0:
+                allstats.append(stats)
+            for idx, normalizer in zip(shard,shard_normalizers):
+                normalizers[idx] = normalizer
+        return allstats, normalizers
+
+    def _check_loaded(self,model,states_list):
+        if len(self._loaded) != len(states_list) \
+                or any(s1 is not s2 for s1, s2 in zip(self._loaded,states_list)):
+            self._load(model,states_list)
 
-    datas, kwargss = zip(*grp)
+    def _load(self,model,states_list):
+        self._loaded = []
+        num = min(self.num_procs,len(states_list))
+        self._shards = list_split(range(len(states_list)),num) if num > 0 else []
+        self._shards += [[] for _ in range(self.num_procs - num)]
 
-    states_list = []
-    for data, kwargs in zip(datas,kwargss):
-        model.add_data(data,initialize_from_prior=False,**kwargs)
+        args = [_states_args(model,s) for s in states_list]
+        self._bufs = [s.stateseq if isinstance(stateseq,datastore.Reference) else None
+                for s, (_, _, stateseq) in zip(states_list,args)]
+
+        params = _dumps_parameters(model)
+        for conn, shard in zip(self._conns,self._shards):
+            conn.send(('load',params,[args[idx] for idx in shard]))
+        self._recv_all()
+        self._loaded = list(states_list)
+
+    def _recv_all(self):
+        results = [conn.recv() for conn in self._conns]
+        for ok, result in results:
+            if not ok:
+                raise RuntimeError('error in pyhsmm worker process:\n' + result)
+        return [result for ok, result in results]
+
+def _dumps_parameters(model):
+    # the model without its data, pickled once and sent to every worker
+    states_list, model.states_list = model.states_list, []
+    try:
+        return pickle.dumps(model,pickle.HIGHEST_PROTOCOL)
+    finally:
+        model.states_list = states_list
+
+def _states_args(model,s):
+    # views into a SequenceStore are sent as references to the shared file
+    data, kwargs = model._get_joblib_pair(s)
+    stateseq = getattr(s,'stateseq',None)
+    if stateseq is None:
+        stateseq = np.zeros(data.shape[0],dtype=np.int32)
+    return datastore.reference(data) or data, kwargs, \
+            datastore.reference(stateseq) or stateseq
+
+### worker side
+
+def _worker(conn):
+    states_list, bufs = [], []
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        method, params, args = msg
+        try:
+            model = pickle.loads(params)
+            if method == 'load':
+                states_list, bufs = _load(model,args)
+                result = None
+            else:
+                result = _methods[method](model,states_list,bufs,args)
+        except Exception:
+            conn.send((False,traceback.format_exc()))
+        else:
+            conn.send((True,result))
+    conn.close()
+
+def _load(model,args):
+    states_list, bufs = [], []
+    for data, kwargs, stateseq in args:
+        if isinstance(data,datastore.Reference):
+            data = datastore.resolve(data)
+        buf = None
+        if isinstance(stateseq,datastore.Reference):
+            stateseq = buf = datastore.resolve(stateseq)
+        model.add_data(data,stateseq=stateseq,**kwargs)
         states_list.append(model.states_list.pop())
+        bufs.append(buf)
+    return states_list, bufs
 
-    return [(s.stateseq, s.log_likelihood()) for s in states_list]
+def _resample(model,states_list,bufs,rng_keys):
+    out = []
+    for s, buf, rng_key in zip(states_list,bufs,rng_keys):
+        s.model, s.rng_key = model, rng_key
+        s.clear_stale_caches()
+        s.resample()
+        if buf is not None:
+            # the caller reads the sequence from the shared buffer
+            buf[...] = s.stateseq
+            out.append((None, s.log_likelihood()))
+        else:
+            out.append((s.stateseq, s.log_likelihood()))
+    return out
 
-def _get_sampled_stateseq_and_labels(idx):
-    grp = args[idx]
-    if len(grp) == 0:
-        return []
+def _meanfield(model,states_list,bufs,args):
+    # mean field updates don't bump parameter versions, so clear everything
+    for s in states_list:
+        s.model = model
+        s.clear_caches()
+    if len(states_list) > 0:
+        model._states_class._meanfieldupdate_multiple(states_list)
+    return [s.all_expected_stats for s in states_list]
 
-    data, kwargss = zip(*grp)
+def _meanfield_reduced(model,states_list,bufs,args):
+    _meanfield(model,states_list,bufs,args)
+    return _reduce(model,states_list)
 
-    states_list = []
-    for data, kwargs in zip(datas,kwargss):
-        model.add_data(data,initialize_from_prior=False,**kwargs)
-        states_list.apppend(model.states_list.pop())
+def _E_step_reduced(model,states_list,bufs,args):
+    for s in states_list:
+        s.model = model
+        s.clear_caches()
+    if len(states_list) > 0:
+        model._states_class._E_step_multiple(states_list)
+    return _reduce(model,states_list)
+
+def _reduce(model,states_list):
+    stats = model._reduce_expected_stats(states_list) if len(states_list) > 0 else None
+    return stats, [s._normalizer for s in states_list]
 
-    return [(s.stateseq,s.component_labels,s.log_likelihood())
-            for s in states_list]
+_methods = dict(resample=_resample,meanfield=_meanfield,
+        meanfield_reduced=_meanfield_reduced,E_step_reduced=_E_step_reduced)
 
+### threads
 
-cmaxes = None
-alphal = None
-scaled_alphal = None
-trans_matrix = None
-aBl = None
-def _get_predictive_likelihoods(k):
-    future_likelihoods = np.logaddexp.reduce(
-            np.log(scaled_alphal[:-k].dot(np.linalg.matrix_power(trans_matrix,k))) \
-                    + cmaxes[:-k,None] + aBl[k:], axis=1)
-    past_likelihoods = np.logaddexp.reduce(alphal[:-k], axis=1)
+# NOTE: the message passing wrappers in hmm_messages_interface and
+# hsmm_messages_interface release the gil, as do the numpy and scipy routines
+# most of the likelihood computations go through, so threads can work on
+# different sequences at once without pickling anything. map_shards calls a
+# function on contiguous shards of a list in a persistent pool of threads.
 
-    return future_likelihoods - past_likelihoods
+_thread_pools = {}
 
+def map_shards(f,lst,num_threads):
+    if num_threads not in _thread_pools:
+        _thread_pools[num_threads] = ThreadPool(num_threads)
+    if len(lst) == 0:
+        return []
+    shards = list_split(lst,min(num_threads,len(lst)))
+    return _thread_pools[num_threads].map(f,shards)
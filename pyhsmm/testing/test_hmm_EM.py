@@ -0,0 +1,56 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm import models as m, distributions as d
+from pyhsmm.testing.util import random_model, random_datas
+
+##########
+#  util  #
+##########
+
+def check_accelerated_EM(model,**kwargs):
+    import copy
+    for data in random_datas(model,[300,200]):
+        model.add_data(data,**kwargs)
+    accelerated = copy.deepcopy(model)
+
+    likes = model.EM_fit(tol=1e-3,maxiter=500)
+    accelerated_likes, info = accelerated.accelerated_EM_fit(tol=1e-3,maxiter=500)
+
+    assert np.all(np.diff(accelerated_likes) > -1e-8)
+    assert np.isclose(accelerated_likes[-1],accelerated.log_likelihood(),rtol=0,atol=1e-6)
+    assert accelerated.log_likelihood() > model.log_likelihood() - 1e-2
+    assert np.isclose(accelerated.log_likelihood(),model.log_likelihood(),atol=0.5)
+    assert info['extrapolations'] > 0
+    return accelerated, info['E_steps'] < len(likes)
+
+###########
+#  tests  #
+###########
+
+@attr('hmm','EM')
+def accelerated_EM_test():
+    np.random.seed(1)
+    _, fewer_E_steps = check_accelerated_EM(random_model(nstates=3))
+    assert fewer_E_steps
+
+@attr('hsmm','EM')
+def hsmm_accelerated_EM_test():
+    np.random.seed(1)
+    model = random_model(3,m.HSMM,dur_distns=[
+        d.PoissonDuration(alpha_0=2.,beta_0=0.2,lmbda=lmbda) for lmbda in [3.,6.,10.]])
+
+    # NOTE: the duration M step only counts the segments that end before T, so
+    # it's only an exact M step (and EM only monotone) without right censoring
+    accelerated, _ = check_accelerated_EM(model,right_censoring=False)
+    assert all(distn.lmbda > 0 for distn in accelerated.dur_distns)
+
+@attr('hsmm','EM')
+def geo_hsmm_accelerated_EM_test():
+    np.random.seed(1)
+    model = random_model(3,m.GeoHSMM,dur_distns=[
+        d.GeometricDuration(alpha_0=2.,beta_0=2.,p=p) for p in [0.1,0.2,0.3]])
+    accelerated, _ = check_accelerated_EM(model)
+    assert all(0 < distn.p <= 1 for distn in accelerated.dur_distns)
+
@@ -148,3 +148,127 @@ def gaussian_exhaustive_test():
     target_val = compute_likelihood_enumeration(obs_distns=obs_distns,data=data,**model)
     likelihood_check(target_val=target_val,data=data,obs_distns=obs_distns,**model)
 
+
+@attr('hmm','likelihood')
+@runmultiple(2)
+def batched_emissions_test():
+    from pyhsmm.internals import emissions
+    D = 3
+    def random_cov():
+        A = np.random.randn(D,D)
+        return A.dot(A.T) + np.eye(D)
+    obs_distns = [
+            d.Gaussian(mu=np.random.randn(D),sigma=random_cov(),
+                mu_0=np.random.randn(D),sigma_0=random_cov(),kappa_0=0.5,nu_0=D+3),
+            d.DiagonalGaussian(mu=np.random.randn(D),sigmas=np.random.rand(D)+0.5,
+                mu_0=np.zeros(D),nus_0=1.,alphas_0=2.,betas_0=np.random.rand(D)+1.),
+            d.Gaussian(mu=np.random.randn(D),sigma=random_cov(),
+                mu_0=np.random.randn(D),sigma_0=random_cov(),kappa_0=2.,nu_0=D+1)]
+    data = np.random.randn(20,D)
+    data[4,1] = np.nan
+
+    def check(method,batched):
+        target = np.hstack([getattr(o,method)(data)[:,na] for o in obs_distns])
+        out = batched(obs_distns,data,np.empty((20,3)))
+        assert np.allclose(target,out,equal_nan=True)
+
+    for i in range(2):
+        check('log_likelihood',emissions.log_likelihoods)
+        check('expected_log_likelihood',emissions.expected_log_likelihoods)
+
+        # the cached factors are recomputed when the parameters are replaced
+        obs_distns[0].mu = np.random.randn(D)
+        obs_distns[1].sigmas = np.random.rand(D)+0.5
+        obs_distns[2].sigma_mf = random_cov()
+
+    # and when they're modified in place (the distributions' own Cholesky
+    # caches don't notice that, so they're reset for the targets)
+    obs_distns[0].mu += 1.
+    obs_distns[1].sigmas *= 2.
+    obs_distns[2].sigma[...] = random_cov()
+    obs_distns[2]._sigma_chol = None
+    obs_distns[0].sigma_mf[...] = random_cov()
+    obs_distns[0]._sigma_mf_chol = None
+    check('log_likelihood',emissions.log_likelihoods)
+    check('expected_log_likelihood',emissions.expected_log_likelihoods)
+
+@attr('hmm','likelihood')
+def stale_cache_test():
+    from pyhsmm.util.general import bump_version
+    D = 2
+    obs_distns = [d.Gaussian(mu=np.random.randn(D),sigma=np.eye(D),
+        mu_0=np.zeros(D),sigma_0=np.eye(D),kappa_0=0.5,nu_0=D+2) for _ in range(3)]
+    hmm = m.HMM(alpha=3.,init_state_concentration=1.,obs_distns=obs_distns)
+    hmm.add_data(np.random.randn(50,D))
+    states = hmm.states_list[0]
+    aBl = states.aBl
+    states.log_likelihood()
+
+    # resampling the transitions keeps the likelihoods
+    hmm.resample_trans_distn()
+    assert states._aBl is aBl and states._normalizer is None
+
+    # changing one observation distribution recomputes just its column
+    before = aBl.copy()
+    obs_distns[1].mu = np.random.randn(D)
+    bump_version(obs_distns[1])
+    hmm._clear_stale_caches()
+    assert states._aBl is aBl
+    assert np.allclose(aBl[:,[0,2]],before[:,[0,2]])
+    assert np.allclose(aBl[:,1],obs_distns[1].log_likelihood(states.data))
+
+@attr('hmm','likelihood')
+def predictive_likelihoods_test():
+    from pyhsmm.internals import forecast
+    D, N = 2, 4
+    obs_distns = [d.Gaussian(mu=np.random.randn(D),sigma=np.eye(D),
+        mu_0=np.zeros(D),sigma_0=np.eye(D),kappa_0=0.5,nu_0=D+2) for _ in range(N)]
+    hmm = m.HMM(alpha=3.,init_state_concentration=1.,obs_distns=obs_distns)
+    data = hmm.generate(100,keep=False)[0]
+    hmm.add_data(data)
+    s = hmm.states_list.pop()
+    alphal, A = s.messages_forwards_log(), s.trans_matrix
+
+    def naive(k):
+        return np.logaddexp.reduce(
+                np.log(np.exp(alphal[:-k]).dot(np.linalg.matrix_power(A,k)))
+                + s.aBl[k:],axis=1) - np.logaddexp.reduce(alphal[:-k],axis=1)
+
+    horizons = [5,1,20,2,99]
+    targets = [naive(k) for k in horizons]
+    forecast._CHUNKSIZE, chunksize = 37, forecast._CHUNKSIZE
+    try:
+        for num_threads in [0,3]:
+            outs = hmm.predictive_likelihoods(data,horizons,num_threads=num_threads)
+            assert all(np.allclose(out,target) for out, target in zip(outs,targets))
+    finally:
+        forecast._CHUNKSIZE = chunksize
+
+@attr('hmm','likelihood')
+def heldout_batch_test():
+    D = 2
+    obs_distns = [d.Gaussian(mu=3*np.random.randn(D),sigma=np.eye(D),
+        mu_0=np.zeros(D),sigma_0=np.eye(D),kappa_0=0.5,nu_0=D+2) for _ in range(3)]
+    hmm = m.HMM(alpha=3.,init_state_concentration=1.,obs_distns=obs_distns)
+    datas = [hmm.generate(T,keep=False)[0] for T in [40,2,75,20]]
+
+    targets = []
+    for data in datas:
+        hmm.add_data(data)
+        s = hmm.states_list.pop()
+        loglike = s.log_likelihood()
+        s.E_step()
+        expected_states = s.expected_states
+        s.Viterbi()
+        targets.append((loglike,expected_states,s.stateseq))
+
+    for num_threads in [0,2]:
+        scores = hmm.score(datas,num_threads=num_threads)
+        marginals = hmm.marginals(datas,num_threads=num_threads)
+        stateseqs = hmm.decode(datas,num_threads=num_threads)
+        assert np.allclose(scores,[loglike for loglike, _, _ in targets])
+        assert all(np.allclose(marg,expected_states)
+                for marg, (_, expected_states, _) in zip(marginals,targets))
+        assert all(np.array_equal(seq,stateseq)
+                for seq, (_, _, stateseq) in zip(stateseqs,targets))
+    assert len(hmm.states_list) == 0
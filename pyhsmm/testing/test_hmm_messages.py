@@ -0,0 +1,262 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm import models as m
+from pyhsmm.testing.util import runmultiple, random_model, random_datas
+
+##########
+#  util  #
+##########
+
+def left_right_model(nstates=8,obs_dim=2):
+    model = random_model(nstates=nstates,obs_dim=obs_dim)
+    trans_matrix = np.zeros((nstates,nstates))
+    for i in range(nstates-1):
+        trans_matrix[i,i:i+3] = np.random.dirichlet(np.ones(len(trans_matrix[i,i:i+3])))
+    trans_matrix[-1,-1] = 1.
+    model.trans_distn.trans_matrix = trans_matrix
+    model.init_state_distn.weights = np.r_[1.,np.zeros(nstates-1)]
+    return model
+
+###########
+#  tests  #
+###########
+
+@attr('hmm','messages','EM')
+@runmultiple(3)
+def batched_E_step_test():
+    model = random_model()
+    for data in random_datas(model,[50,1,120,75]):
+        model.add_data(data)
+
+    model._E_step()
+    batched = [s.all_expected_stats for s in model.states_list]
+
+    for s, (expected_states, expected_transcounts, normalizer) \
+            in zip(model.states_list,batched):
+        s.E_step()
+        assert np.allclose(expected_states,s.expected_states)
+        assert np.allclose(expected_transcounts,s.expected_transcounts)
+        assert np.isclose(normalizer,s._normalizer)
+
+@attr('hmm','messages','meanfield')
+def batched_meanfield_test():
+    model = random_model()
+    for data in random_datas(model,[40,80]):
+        model.add_data(data)
+    model.meanfield_update_states()
+    model.meanfield_update_parameters()
+
+    model.meanfield_update_states()
+    batched = [s.all_expected_stats for s in model.states_list]
+
+    for s, (expected_states, expected_transcounts, normalizer) \
+            in zip(model.states_list,batched):
+        s.meanfieldupdate()
+        assert np.allclose(expected_states,s.expected_states)
+        assert np.allclose(expected_transcounts,s.expected_transcounts)
+        assert np.isclose(normalizer,s._normalizer)
+
+@attr('hmm','messages','EM')
+@runmultiple(2)
+def scaled_expected_statistics_test():
+    from pyhsmm.internals.hmm_states import HMMStatesPython
+    model = left_right_model()
+    data = model.generate(100,keep=False)[0]
+    model.add_data(data)
+    s = model.states_list.pop()
+
+    # the last aBl doesn't underflow in the scaled messages, the second one does
+    # (the reachable states are all much less likely than the unreachable one)
+    aBl = s.aBl.copy()
+    underflowing = aBl.copy()
+    underflowing[2] = -1000.
+    underflowing[2,-1] = 0.
+
+    for s._aBl in [aBl,underflowing]:
+        s.E_step()
+        expected_states, expected_transcounts, normalizer = \
+                HMMStatesPython._expected_statistics(s,s.trans_matrix,s.pi_0,s.aBl)
+        assert np.allclose(expected_states,s.expected_states)
+        assert np.allclose(expected_transcounts,s.expected_transcounts)
+        assert np.isclose(normalizer,s._normalizer)
+
+@attr('hmm','messages','sparse')
+@runmultiple(3)
+def sparse_trans_test():
+    model = left_right_model()
+    data = model.generate(100,keep=False)[0]
+
+    model.add_data(data,trans_format='dense')
+    dense = model.states_list.pop()
+    dense.E_step()
+    dense.Viterbi()
+
+    for trans_format in ['sparse','banded']:
+        model.add_data(data,trans_format=trans_format)
+        s = model.states_list.pop()
+
+        assert np.isclose(dense.log_likelihood(),s.log_likelihood())
+
+        s.E_step()
+        assert np.allclose(dense.expected_states,s.expected_states)
+        assert np.allclose(dense.expected_transcounts,s.expected_transcounts)
+        assert np.isclose(dense._normalizer,s._normalizer)
+
+        s.Viterbi()
+        assert np.all(dense.stateseq == s.stateseq)
+
+        s.resample()
+        trans_matrix = model.trans_distn.trans_matrix
+        assert s.stateseq[0] == 0
+        assert np.all(trans_matrix[s.stateseq[:-1],s.stateseq[1:]] > 0)
+
+    # the operators are built once per transition matrix, and shared by the
+    # states objects
+    for i in range(2):
+        model.add_data(data,trans_format='sparse')
+    s, other = model.states_list
+    op, op_T = s._sparse_operators
+    s.clear_caches()
+    assert s._messages_trans_matrix is op and other._messages_trans_matrix is op
+    assert np.allclose(op_T.toarray(),op.toarray().T)
+    model.EM_step()
+    assert s._messages_trans_matrix is not op
+    assert other._messages_trans_matrix is s._messages_trans_matrix
+    assert np.allclose(s._messages_trans_matrix.toarray(),model.trans_distn.trans_matrix)
+
+@attr('hmm','messages','checkpointing')
+@runmultiple(2)
+def checkpointed_messages_test():
+    model = random_model()
+    data = model.generate(103,keep=False)[0]
+    model.add_data(data)
+    s = model.states_list[-1]
+
+    s.E_step()
+    expected_states, expected_transcounts, normalizer = s.all_expected_stats
+    s.meanfieldupdate()
+    mf_expected_states, mf_expected_transcounts, vlb = s.all_expected_stats
+
+    for cls in [m.HMMPython, m.HMM]:
+        model.__class__ = cls
+        for interval in [1,10,50,103,200]:
+            model.add_data(data,checkpoint_interval=interval)
+            c = model.states_list.pop()
+
+            assert np.isclose(normalizer,c.log_likelihood())
+
+            c.E_step()
+            assert np.allclose(expected_states,c.expected_states)
+            assert np.allclose(expected_transcounts,c.expected_transcounts)
+            assert np.isclose(normalizer,c._normalizer)
+
+            c.meanfieldupdate()
+            assert np.allclose(mf_expected_states,c.expected_states)
+            assert np.allclose(mf_expected_transcounts,c.expected_transcounts)
+            assert np.isclose(vlb,c._normalizer)
+    model.__class__ = m.HMM
+
+@attr('hmm','messages','checkpointing')
+def checkpointed_resample_test():
+    # with well-separated observations the posterior is concentrated on the
+    # true state sequence
+    model = random_model(nstates=3)
+    for idx, o in enumerate(model.obs_distns):
+        o.mu = np.array([20.*idx,0.])
+    data, stateseq = model.generate(100,keep=False)
+
+    for trans_format in ['dense','sparse']:
+        model.add_data(data,checkpoint_interval=7,trans_format=trans_format)
+        s = model.states_list.pop()
+        s.resample()
+        assert np.all(s.stateseq == stateseq)
+        assert np.isclose(s._normalizer,model.log_likelihood(data))
+
+@attr('hmm','messages','viterbi')
+@runmultiple(2)
+def batched_viterbi_test():
+    # 300 states exercises the wider backpointer type
+    for nstates in [4,300]:
+        model = random_model(nstates=nstates)
+        datas = random_datas(model,[60,1,25])
+
+        stateseqs = model.heldout_viterbi(datas)
+        for data, stateseq in zip(datas,stateseqs):
+            model.add_data(data)
+            s = model.states_list.pop()
+            scores, args = s.maxsum_messages_backwards()
+            assert args.dtype == (np.uint8 if nstates <= 256 else np.uint16)
+            s.maximize_forwards(scores,args)
+            assert np.all(s.stateseq == stateseq)
+
+@attr('hmm','messages','parallel')
+@runmultiple(2)
+def parallel_time_chunks_test():
+    model = random_model()
+    data = model.generate(157,keep=False)[0]
+    model.add_data(data)
+    s = model.states_list.pop()
+    s.E_step()
+
+    for chunks in [1,4,13,157,300]:
+        model.add_data(data,parallel_time_chunks=chunks)
+        p = model.states_list.pop()
+
+        assert np.isclose(s._normalizer,p.log_likelihood())
+
+        p.E_step()
+        assert np.allclose(s.expected_states,p.expected_states)
+        assert np.allclose(s.expected_transcounts,p.expected_transcounts)
+        assert np.isclose(s._normalizer,p._normalizer)
+
+@attr('hmm','messages','parallel')
+def parallel_time_chunks_resample_test():
+    model = random_model(nstates=3)
+    for idx, o in enumerate(model.obs_distns):
+        o.mu = np.array([20.*idx,0.])
+    data, stateseq = model.generate(200,keep=False)
+
+    model.add_data(data,parallel_time_chunks=7)
+    s = model.states_list.pop()
+    s.resample()
+    assert np.all(s.stateseq == stateseq)
+    assert np.isclose(s._normalizer,model.log_likelihood(data))
+
+@attr('hmm','messages','float32')
+@runmultiple(2)
+def float32_test():
+    model = random_model()
+    datas = random_datas(model,[500,2000])
+    loglike = model.log_likelihood(datas[0])
+    for data in datas:
+        model.add_data(data)
+    model._E_step()
+    expected_stats = [s.all_expected_stats for s in model.states_list]
+    model.states_list = []
+
+    model.dtype = np.float32
+    for data in datas:
+        model.add_data(data)
+    s = model.states_list[0]
+    assert s.aBl.dtype == np.float32
+
+    # the log likelihood is accumulated in double precision
+    assert abs(s.log_likelihood() - loglike) < 1e-4*abs(loglike)
+
+    # the log messages lose absolute precision over long sequences, so the
+    # expected statistics are only close
+    model._E_step()
+    for s, (expected_states, expected_transcounts, normalizer) \
+            in zip(model.states_list,expected_stats):
+        assert s.expected_states.dtype == np.float32
+        assert np.abs(expected_states - s.expected_states).max() < 5e-2
+        assert np.abs(expected_transcounts - s.expected_transcounts).max() \
+                < 2e-2*expected_transcounts.max()
+        assert abs(s._normalizer - normalizer) < 1e-4*abs(normalizer)
+
+    model.resample_states()
+    model.Viterbi_EM_step()
+    assert all(s.stateseq.dtype == np.int32 for s in model.states_list)
+
@@ -0,0 +1,110 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm import models as m
+from pyhsmm.testing.util import random_model
+
+###########
+#  tests  #
+###########
+
+@attr('hmm','messages','online')
+def online_filter_test():
+    from pyhsmm.internals.hmm_online import HMMFilter
+
+    for cls in [m.HMMPython, m.HMM]:
+        model = random_model(cls=cls)
+        data = model.generate(60,keep=False)[0]
+        model.add_data(data)
+        alphan = model.states_list.pop().messages_forwards_normalized()
+
+        f = HMMFilter(model)
+        filtered, loglike = [], 0.
+        for chunk in np.array_split(data,[1,2,10,30,31]):
+            chunk_alphan, chunk_loglike = f.update(chunk)
+            filtered.append(chunk_alphan)
+            loglike += chunk_loglike
+
+        assert np.allclose(alphan,np.vstack(filtered))
+        assert np.isclose(model.log_likelihood(data),loglike)
+        assert np.isclose(f.log_likelihood,loglike) and f.t == 60
+
+@attr('hmm','messages','online')
+def fixed_lag_smoother_test():
+    from pyhsmm.internals.hmm_online import HMMFixedLagSmoother
+
+    model = random_model()
+    data = model.generate(50,keep=False)[0]
+    lag = 5
+
+    f = HMMFixedLagSmoother(model,lag)
+    smoothed = np.vstack([f.update(chunk) for chunk in np.array_split(data,7)])
+    assert smoothed.shape == (50-lag,model.num_states)
+
+    for t in [0,17,44]:
+        expected_states = model.heldout_state_marginals(data[:t+lag+1])
+        assert np.allclose(smoothed[t],expected_states[t])
+
+    assert np.allclose(f.flush(),model.heldout_state_marginals(data)[-lag:])
+
+@attr('hmm','messages','online','viterbi')
+def online_viterbi_test():
+    from pyhsmm.internals.hmm_online import HMMOnlineViterbi
+
+    model = random_model()
+    data = model.generate(80,keep=False)[0]
+    stateseq = model.heldout_viterbi(data)
+
+    # with a lag longer than the stream every decision is exact
+    f = HMMOnlineViterbi(model,lag=100)
+    decoded = np.concatenate([f.update(chunk) for chunk in np.array_split(data,9)]
+            + [f.flush()])
+    assert np.all(decoded == stateseq)
+
+    # with a short lag the delay is bounded
+    f = HMMOnlineViterbi(model,lag=3)
+    decoded = []
+    for t, x in enumerate(data):
+        decoded.extend(f.update(x[None]))
+        assert t - f.decided + 1 < 3
+    decoded.extend(f.flush())
+    assert len(decoded) == len(data)
+
+@attr('hmm','EM','online')
+def online_EM_test():
+    import copy
+    from pyhsmm.internals.hmm_online import HMMOnlineEM
+    model = random_model(nstates=3)
+    data = model.generate(200,keep=False)[0]
+
+    # with one chunk, an update is a batch EM step
+    batch, online = copy.deepcopy(model), copy.deepcopy(model)
+    batch.add_data(data)
+    batch.EM_step()
+    HMMOnlineEM(online).update(data)
+    assert np.allclose(batch.trans_distn.trans_matrix,online.trans_distn.trans_matrix)
+    assert all(np.allclose(o1.mu,o2.mu) and np.allclose(o1.sigma,o2.sigma)
+            for o1, o2 in zip(batch.obs_distns,online.obs_distns))
+
+    # the running statistics don't grow with the stream
+    em = HMMOnlineEM(copy.deepcopy(model))
+    loglike = em.update(data[:50])
+    assert np.isclose(loglike,model.log_likelihood(data[:50]))
+    shapes = [stats.shape for stats in em.stats['obs']]
+    for chunk in np.array_split(data[50:],5):
+        assert np.isfinite(em.update(chunk))
+    assert [stats.shape for stats in em.stats['obs']] == shapes
+    assert em.stats['trans'].shape == (3,3) and em.t == 200 and em.num_updates == 6
+
+    # a float32 model runs the same updates in single precision
+    float32 = copy.deepcopy(model)
+    float32.dtype = np.float32
+    em32, em = HMMOnlineEM(float32), HMMOnlineEM(copy.deepcopy(model))
+    for chunk in np.array_split(data,4):
+        assert np.isclose(em32.update(chunk),em.update(chunk),rtol=1e-4)
+    assert em32.trans_matrix.dtype == np.float32
+    assert np.allclose(em32.trans_matrix,em.trans_matrix,atol=1e-4)
+    assert all(np.allclose(o1.mu,o2.mu,atol=1e-4)
+            for o1, o2 in zip(em.model.obs_distns,em32.model.obs_distns))
+
@@ -0,0 +1,151 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm import models as m, distributions as d
+from pyhsmm.testing.util import random_model, random_datas, poisson_durations
+
+###########
+#  tests  #
+###########
+
+@attr('hsmm','messages')
+def hsmm_native_forwards_test():
+    from pyhsmm.internals.hsmm_states import HSMMStatesPython
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    data = model.generate(100,keep=False)[0]
+
+    for kwargs in [{},dict(trunc=12),dict(trunc=5,right_censoring=False)]:
+        model.add_data(data,**kwargs)
+        s = model.states_list.pop()
+        alphal, alphastarl = s.messages_forwards()
+        python_alphal, python_alphastarl = s.messages_forwards_python()
+        assert np.allclose(alphal,python_alphal) and np.allclose(alphastarl,python_alphastarl)
+
+        normalizer = s._normalizer
+        s.messages_backwards()
+        assert np.isclose(normalizer,s._normalizer)
+
+    model.add_data(data)
+    s = model.states_list.pop()
+    s.E_step()
+    expected_stats = [np.copy(a) for a in s.all_expected_stats]
+    HSMMStatesPython.E_step(s)
+    assert all(np.allclose(a,b) for a, b in zip(expected_stats,s.all_expected_stats))
+
+@attr('hsmm','messages','EM')
+def hsmm_native_expected_stats_test():
+    from pyhsmm.internals.hsmm_states import HSMMStatesPython
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    datas = random_datas(model,[60,100,30])
+
+    for data in datas:
+        model.add_data(data)
+    python_stats = []
+    for s in model.states_list:
+        HSMMStatesPython.E_step(s)
+        python_stats.append([np.copy(a) for a in s.all_expected_stats])
+    model._states_class._E_step_multiple(model.states_list)
+    for s, stats in zip(model.states_list,python_stats):
+        assert all(np.allclose(a,b) for a, b in zip(stats,s.all_expected_stats))
+
+    # with trunc, everything is computed over the first trunc durations only
+    model.states_list = []
+    for data in datas:
+        model.add_data(data,trunc=10)
+    model._states_class._E_step_multiple(model.states_list)
+    for s in model.states_list:
+        expected_stats = [np.copy(a) for a in s.all_expected_stats]
+        assert expected_stats[2].shape == (10,3)
+        HSMMStatesPython.E_step(s)
+        assert all(np.allclose(a,b) for a, b in zip(expected_stats,s.all_expected_stats))
+
+@attr('hsmm','messages','float32')
+def hsmm_float32_test():
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    data = model.generate(50000,keep=False)[0]
+    model.add_data(data,trunc=40)
+    s = model.states_list.pop()
+    s.E_step()
+    expected_stats = [np.copy(a) for a in s.all_expected_stats]
+
+    # the unnormalized log messages of a long sequence don't fit in single
+    # precision, but the statistics computed from them should
+    model.dtype = np.float32
+    model.add_data(data,trunc=40)
+    s = model.states_list.pop()
+    assert s.aBl.dtype == np.float32
+    s.E_step()
+    assert s.expected_states.dtype == np.float32
+    assert np.allclose(s.expected_states.sum(1),1.)
+    assert np.abs(expected_stats[0] - s.expected_states).max() < 1e-4
+    assert np.allclose(expected_stats[1],s.expected_transcounts,rtol=1e-4)
+    assert np.allclose(expected_stats[2],s.expected_durations,rtol=1e-4,atol=1e-3)
+    assert abs(expected_stats[3] - s._normalizer) < 1e-5*abs(expected_stats[3])
+
+    model._states_class._E_step_multiple([s])
+    assert np.abs(expected_stats[0] - s.expected_states).max() < 1e-4
+
+@attr('hsmm','messages')
+def hsmm_cumulative_potentials_test():
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    model.add_data(model.generate(50,keep=False)[0],trunc=8)
+    s = model.states_list[0]
+    s.aBl[20,1] = -np.inf
+
+    for t in [0,5,20,49]:
+        cB, offset = s.cumulative_obs_potentials(t)
+        assert np.allclose(np.exp(cB - offset),np.exp(np.cumsum(s.aBl[t:t+8],axis=0)))
+        rcB = s.reverse_cumulative_obs_potentials(t)
+        start = max(0,t-7)
+        assert np.allclose(np.exp(rcB),
+                np.exp(np.cumsum(s.aBl[start:t+1][::-1],axis=0)[::-1]))
+
+@attr('hsmm','messages','float32')
+def hsmm_float32_cumulative_potentials_test():
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    model.dtype = np.float32
+    model.add_data(np.random.randn(200000,2),trunc=8)
+    s = model.states_list[0]
+    assert s.caBl.dtype == np.float64
+    aBl = s.aBl.astype(np.float64)
+
+    # the potentials of a segment at the end of a long sequence are
+    # differences of two large prefix sums, but they should be as accurate as
+    # the segment's own sum
+    for t in [0,100000,199999]:
+        cB, offset = s.cumulative_obs_potentials(t)
+        assert np.abs((cB - offset) - np.cumsum(aBl[t:t+8],axis=0)).max() < 1e-6
+        rcB = s.reverse_cumulative_obs_potentials(t)
+        assert rcB.dtype == np.float32
+        start = max(0,t-7)
+        assert np.allclose(rcB,np.cumsum(aBl[start:t+1][::-1],axis=0)[::-1],rtol=1e-6)
+
+    s.resample()
+    assert s.stateseq.shape == (200000,)
+
+@attr('hsmm','viterbi')
+def hsmm_native_viterbi_test():
+    model = random_model(3,m.HSMM,dur_distns=poisson_durations())
+    datas = random_datas(model,[60,100,30])
+
+    for kwargs in [{},dict(trunc=10),dict(trunc=6,right_censoring=False)]:
+        model.states_list = []
+        for data in datas:
+            model.add_data(data,**kwargs)
+        model._states_class._Viterbi_multiple(model.states_list)
+        for s in model.states_list:
+            stateseq = s.stateseq.copy()
+            s.Viterbi_python()
+            assert np.array_equal(stateseq,s.stateseq)
+
+    geo_model = random_model(3,m.GeoHSMM,dur_distns=[
+        d.GeometricDuration(p=p) for p in [0.1,0.2,0.3]])
+    for data in datas:
+        geo_model.add_data(data)
+    geo_model._states_class._Viterbi_multiple(geo_model.states_list)
+    stateseqs = [s.stateseq.copy() for s in geo_model.states_list]
+    for s, stateseq in zip(geo_model.states_list,stateseqs):
+        s.Viterbi()
+        assert np.array_equal(stateseq,s.stateseq)
+
@@ -0,0 +1,156 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm.testing.util import random_model, random_datas
+
+###########
+#  tests  #
+###########
+
+@attr('hmm','messages','random')
+def rng_key_test():
+    from pyhsmm.util.stats import uniform_stream
+    model = random_model(seed=0)
+    for data in random_datas(model,[50,1,120,75]):
+        model.add_data(data)
+
+    model.resample_states()
+    serial = [s.stateseq.copy() for s in model.states_list]
+
+    model.iteration = 0
+    model.resample_states(num_procs=2)
+    assert all(np.all(a == s.stateseq) for a, s in zip(serial,model.states_list))
+
+    model._states_class._resample_multiple(model.states_list)
+    assert all(np.all(a == s.stateseq) for a, s in zip(serial,model.states_list))
+
+    # the streams are independent of the global state and of each other
+    np.random.seed(0)
+    a = uniform_stream(100,(0,1,2),dtype=np.float32)
+    b = uniform_stream(100,(0,1,2),dtype=np.float32)
+    assert np.all(a == b) and a.dtype == np.float32 and 0 <= a.min() and a.max() < 1
+    assert np.all(uniform_stream(50,(0,1,2),offset=50) == uniform_stream(100,(0,1,2))[50:])
+    assert not np.any(uniform_stream(100,(0,1,3)) == uniform_stream(100,(0,1,2)))
+
+@attr('hmm','messages','random')
+def worker_pool_test():
+    from pyhsmm import parallel
+    from pyhsmm.util.general import bump_version
+    model = random_model(seed=0)
+    for data in random_datas(model,[50,20,80]):
+        model.add_data(data)
+
+    model.resample_states(num_procs=2)
+    pool = parallel._pools[model]
+    pids = [p.pid for p in pool._procs]
+
+    # the workers and their states objects stay put across iterations
+    model.iteration = 0
+    model.resample_states(num_procs=2)
+    assert parallel._pools[model] is pool and [p.pid for p in pool._procs] == pids
+    loaded = pool._loaded
+    model.resample_states(num_procs=2)
+    assert pool._loaded is loaded
+
+    # and they match serial sampling after a parameter update
+    model.trans_distn.resample()
+    bump_version(model.trans_distn)
+    model._clear_stale_caches()
+    model.iteration = 5
+    model.resample_states(num_procs=2)
+    parallel_seqs = [s.stateseq.copy() for s in model.states_list]
+    model.iteration = 5
+    model.resample_states()
+    assert all(np.all(a == s.stateseq) for a, s in zip(parallel_seqs,model.states_list))
+
+    procs = pool._procs
+    parallel.close_pool(model)
+    assert model not in parallel._pools and not any(p.is_alive() for p in procs)
+
+@attr('hmm','messages','random')
+def sequence_store_test():
+    from pyhsmm import parallel
+    from pyhsmm.util.datastore import SequenceStore, reference
+    model = random_model(seed=0)
+    datas = random_datas(model,[50,20,80])
+    store = SequenceStore(datas)
+    store.add_to(model)
+    assert all(np.all(s.data == data) for s, data in zip(model.states_list,datas))
+
+    # the workers write the sampled sequences into the store's buffers
+    model.resample_states(num_procs=2)
+    parallel_seqs = [s.stateseq.copy() for s in model.states_list]
+    assert all(reference(s.stateseq) is not None for s in model.states_list)
+    assert all(np.all(store.stateseq(idx) == seq) for idx, seq in enumerate(parallel_seqs))
+
+    model.iteration = 0
+    model.resample_states()
+    assert all(np.all(a == s.stateseq) for a, s in zip(parallel_seqs,model.states_list))
+    parallel.close_pool(model)
+
+@attr('hmm','messages','random')
+def threads_test():
+    model = random_model(seed=0)
+    for data in random_datas(model,[50,1,120,75,30]):
+        model.add_data(data)
+
+    model.resample_states()
+    serial = [s.stateseq.copy() for s in model.states_list]
+    model.iteration = 0
+    model.resample_states(num_threads=3)
+    assert all(np.all(a == s.stateseq) for a, s in zip(serial,model.states_list))
+
+    model._E_step()
+    expected_states = [s.expected_states.copy() for s in model.states_list]
+    model._clear_caches()
+    model._E_step(num_threads=2)
+    assert all(np.allclose(a,s.expected_states)
+            for a, s in zip(expected_states,model.states_list))
+
+    datas = [s.data for s in model.states_list]
+    assert np.isclose(model.log_likelihood(),model.log_likelihood(num_threads=2))
+    assert np.isclose(model.log_likelihood(datas),model.log_likelihood(datas,num_threads=4))
+
+@attr('hmm','messages','EM')
+def reduced_stats_test():
+    import copy
+    from pyhsmm import parallel
+    model = random_model(seed=0)
+    for data in random_datas(model,[50,20,80]):
+        model.add_data(data)
+    reduced = copy.deepcopy(model)
+    mf_model, mf_reduced = copy.deepcopy(model), copy.deepcopy(model)
+
+    def params(model):
+        return [o.mu for o in model.obs_distns] + [o.sigma for o in model.obs_distns] \
+                + [model.trans_distn.trans_matrix, model.init_state_distn.pi_0]
+
+    model.EM_step()
+    reduced.EM_step(num_procs=2)
+    assert all(np.allclose(a,b) for a, b in zip(params(model),params(reduced)))
+
+    # what comes back from a worker doesn't depend on the sequence lengths
+    pool = parallel._pools[reduced]
+    allstats, normalizers = pool.E_step_reduced(reduced,reduced.states_list)
+    assert len(allstats) == 2 and len(normalizers) == 3
+    assert all(stats['trans'].shape == (4,4) for stats in allstats)
+
+    parallel.close_pool(reduced)
+
+    for itr in range(2):
+        vlb = mf_model.meanfield_coordinate_descent_step()
+        reduced_vlb = mf_reduced.meanfield_coordinate_descent_step(num_procs=2,reduced=True)
+        assert np.isclose(vlb,reduced_vlb)
+
+    # adding data drops the reduced statistics of the old states_list
+    data = mf_model.generate(40,keep=False)[0]
+    mf_model.add_data(data)
+    mf_reduced.add_data(data)
+    assert mf_reduced._reduced_stats is None
+    vlb = mf_model.meanfield_coordinate_descent_step()
+    assert np.isclose(vlb,mf_reduced.meanfield_coordinate_descent_step(num_procs=2,reduced=True))
+    assert all(np.allclose(o1.mu_mf,o2.mu_mf) and np.allclose(o1.sigma_mf,o2.sigma_mf)
+            for o1, o2 in zip(mf_model.obs_distns,mf_reduced.obs_distns))
+    parallel.close_pool(mf_reduced)
+
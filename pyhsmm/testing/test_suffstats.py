@@ -0,0 +1,48 @@
+from __future__ import division
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pyhsmm import distributions as d
+from pyhsmm.internals import suffstats
+
+##########
+#  util  #
+##########
+
+def random_distns(D=3):
+    return [d.Gaussian(mu=np.zeros(D),sigma=np.eye(D),
+                mu_0=np.zeros(D),sigma_0=np.eye(D),kappa_0=0.1,nu_0=D+2),
+            d.DiagonalGaussian(mu=np.zeros(D),sigmas=np.ones(D),
+                mu_0=np.zeros(D),nus_0=D+2.,alphas_0=1.,betas_0=1.)]
+
+###########
+#  tests  #
+###########
+
+@attr('suffstats','EM')
+def max_likelihood_test():
+    datas = [np.random.randn(T,3) + np.arange(3) for T in [40,25]]
+    weights = [np.random.rand(T) for T in [40,25]]
+    gaussian, diagonal = random_distns()
+
+    # NOTE: DiagonalGaussian.max_likelihood doesn't take weights, but its fit
+    # is the diagonal of the full covariance one
+    ref = random_distns()[0]
+    ref.max_likelihood(datas,weights)
+
+    suffstats.max_likelihood(gaussian,suffstats.weighted_statistics(gaussian,datas,weights))
+    assert np.allclose(gaussian.mu,ref.mu) and np.allclose(gaussian.sigma,ref.sigma)
+
+    suffstats.max_likelihood(diagonal,suffstats.weighted_statistics(diagonal,datas,weights))
+    assert np.allclose(diagonal.mu,ref.mu) and np.allclose(diagonal.sigmas,np.diag(ref.sigma))
+
+@attr('suffstats','meanfield')
+def meanfieldupdate_test():
+    datas = [np.random.randn(T,3) for T in [40,25]]
+    weights = [np.random.rand(T) for T in [40,25]]
+
+    for o, ref in zip(random_distns(),random_distns()):
+        suffstats.meanfieldupdate(o,suffstats.weighted_statistics(o,datas,weights))
+        ref.meanfieldupdate(datas,weights)
+        assert np.allclose(o.mf_natural_hypparam,ref.mf_natural_hypparam)
+
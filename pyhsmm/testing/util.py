@@ -0,0 +1,35 @@
+from __future__ import division
+import numpy as np
+from functools import wraps
+
+from pyhsmm import models as m, distributions as d
+
+# NOTE: the models and data the test modules share
+
+def runmultiple(n):
+    def dec(fn):
+        @wraps(fn)
+        def wrapper():
+            for i in range(n):
+                yield fn
+        return wrapper
+    return dec
+
+def random_obs_distns(nstates,obs_dim=2):
+    return [d.Gaussian(mu=np.random.randn(obs_dim),sigma=np.eye(obs_dim),
+                mu_0=np.zeros(obs_dim),sigma_0=np.eye(obs_dim),kappa_0=0.1,nu_0=obs_dim+2)
+            for state in range(nstates)]
+
+def random_model(nstates=4,cls=m.HMM,obs_dim=2,**kwargs):
+    model = cls(alpha=6.,init_state_concentration=1.,
+            obs_distns=random_obs_distns(nstates,obs_dim),**kwargs)
+    model.trans_distn.trans_matrix = \
+            np.vstack([np.random.dirichlet(np.ones(nstates)) for i in range(nstates)])
+    model.init_state_distn.weights = np.random.dirichlet(np.ones(nstates))
+    return model
+
+def poisson_durations(lmbdas=(3.,5.,8.)):
+    return [d.PoissonDuration(alpha_0=2.,beta_0=0.2,lmbda=lmbda) for lmbda in lmbdas]
+
+def random_datas(model,lengths):
+    return [model.generate(T,keep=False)[0] for T in lengths]
@@ -1,2 +1,2 @@
-__all__ = ['general','plot','stats','text']
-import general, plot, stats, text
+__all__ = ['general','plot','stats','text','datastore']
+import general, plot, stats, text, datastore
@@ -12,6 +12,8 @@ from cython cimport floating, integral
 
 from cython.parallel import prange
 
+from pyhsmm.util.stats import uniform_stream
+
 cdef inline int32_t csample_discrete_normalized(floating[::1] distn, floating u):
     cdef int i
     cdef int N = distn.shape[0]
@@ -47,17 +49,17 @@ cdef np.ndarray[int32_t,ndim=1,mode='c'] _sample_discrete_multi(
 def sample_markov(
         int T,
         np.ndarray[floating, ndim=2, mode="c"] trans_matrix,
-        np.ndarray[floating, ndim=1, mode="c"] init_state_distn
-        ):
+        np.ndarray[floating, ndim=1, mode="c"] init_state_distn,
+        rng_key=None):
     cdef int32_t[::1] out = np.empty(T,dtype=np.int32)
     cdef floating[:,::1] A = trans_matrix / trans_matrix.sum(1)[:,None]
     cdef floating[::1] pi = init_state_distn / init_state_distn.sum()
 
     cdef floating[::1] randseq
     if floating is double:
-        randseq = np.random.random(T).astype(np.double)
+        randseq = uniform_stream(T,rng_key,dtype=np.double)
     else:
-        randseq = np.random.random(T).astype(np.float)
+        randseq = uniform_stream(T,rng_key,dtype=np.float32)
 
     cdef int t
     out[0] = csample_discrete_normalized(pi,randseq[0])
@@ -79,7 +81,7 @@ def sample_crp_tablecounts(
     if floating is double:
         randseq = np.random.random(tot).astype(np.double)
     else:
-        randseq = np.random.random(tot).astype(np.float)
+        randseq = np.random.random(tot).astype(np.float32)
 
     tmp = np.empty_like(customers)
     tmp[0,0] = 0
@@ -0,0 +1,143 @@
+from __future__ import division
+import numpy as np
+import os, tempfile, weakref, collections
+
+# NOTE: a SequenceStore keeps the observation arrays of many sequences (and,
+# optionally, buffers for their state sequences) in one memory-mapped file, and
+# hands out array views into it. the worker processes in pyhsmm.parallel map
+# the same file, so a states object built on a view is sent to a worker as a
+# small reference instead of a copy of its data, and sampled state sequences
+# are written back into the shared buffers instead of being sent back. the
+# operating system keeps one copy of the pages for all the processes.
+
+_stores = weakref.WeakValueDictionary() # id -> open store, for finding views
+
+class SequenceStore(object):
+    '''
+    Memory-mapped storage for the observation sequences of a model.
+
+    datas is a list of arrays (or array-likes like np.memmaps, which are copied
+    over in blocks) with the same trailing shape. If filename is None, a
+    temporary file is used and deleted when the store is garbage collected.
+    With stateseqs=True, the store also has an int32 state sequence buffer for
+    each sequence.
+
+    A store pickles as a reference to its file, so it can be reopened elsewhere
+    as long as the file is there.
+    '''
+
+    _blocksize = 2**16 # time steps copied at a time
+
+    def __init__(self,datas,filename=None,stateseqs=True,dtype=None):
+        self.lengths = [d.shape[0] for d in datas]
+        self.trailing_shape = tuple(datas[0].shape[1:])
+        assert all(tuple(d.shape[1:]) == self.trailing_shape for d in datas)
+        self.dtype = np.dtype(dtype if dtype is not None
+                else np.result_type(*[d.dtype for d in datas]))
+        self.has_stateseqs = stateseqs
+
+        self._owns_file = filename is None
+        if filename is None:
+            fd, filename = tempfile.mkstemp(suffix='.pyhsmm')
+            os.close(fd)
+        self.filename = os.path.abspath(filename)
+
+        self._open('w+')
+        for idx, d in enumerate(datas):
+            out = self.data(idx)
+            for start in xrange(0,d.shape[0],self._blocksize):
+                out[start:start+self._blocksize] = d[start:start+self._blocksize]
+        self._mm.flush()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def data(self,idx):
+        return self._view(self._data_offsets[idx],
+                (self.lengths[idx],)+self.trailing_shape,self.dtype)
+
+    def stateseq(self,idx):
+        assert self.has_stateseqs
+        return self._view(self._stateseq_offsets[idx],(self.lengths[idx],),np.int32)
+
+    def add_to(self,model,**kwargs):
+        '''
+        Adds every sequence to model, so that the states objects' data (and
+        state sequences, if the store has buffers for them) are views into the
+        store. kwargs are passed to model.add_data.
+        '''
+        for idx in range(len(self)):
+            model.add_data(self.data(idx),**kwargs)
+            if self.has_stateseqs:
+                s = model.states_list[-1]
+                buf = self.stateseq(idx)
+                buf[...] = s.stateseq
+                s.stateseq = buf
+
+    def close(self):
+        self._mm = None
+        if self._owns_file and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def __del__(self):
+        # views keep the mapping itself alive after the store is gone
+        if getattr(self,'_owns_file',False):
+            self.close()
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        del dct['_mm']
+        dct['_owns_file'] = False
+        return dct
+
+    def __setstate__(self,dct):
+        self.__dict__.update(dct)
+        self._open('r+')
+
+    ### layout
+
+    def _open(self,mode):
+        itemsize = self.dtype.itemsize * int(np.prod(self.trailing_shape))
+        sizes = [T*itemsize for T in self.lengths]
+        if self.has_stateseqs:
+            sizes += [T*4 for T in self.lengths]
+        sizes = [size + (-size % 8) for size in sizes] # keep views aligned
+        offsets = np.concatenate(((0,),np.cumsum(sizes))).astype('int64')
+
+        n = len(self.lengths)
+        self._data_offsets = offsets[:n]
+        self._stateseq_offsets = offsets[n:2*n] if self.has_stateseqs else None
+        self.nbytes = int(max(offsets[-1],1))
+
+        self._mm = np.memmap(self.filename,dtype=np.uint8,mode=mode,shape=(self.nbytes,))
+        _stores[id(self)] = self
+
+    def _view(self,offset,shape,dtype):
+        return np.ndarray(shape,dtype=dtype,buffer=self._mm,offset=offset)
+
+### references to views, for sending to other processes
+
+Reference = collections.namedtuple(
+        'Reference',['filename','offset','shape','dtype','strides'])
+
+_mapped = {} # filename -> memmap, for resolving references
+
+def reference(arr):
+    'a Reference if arr is a view into an open SequenceStore, otherwise None'
+    if not isinstance(arr,np.ndarray):
+        return None
+    addr = arr.__array_interface__['data'][0]
+    for store in _stores.values():
+        if store._mm is None:
+            continue
+        start = store._mm.__array_interface__['data'][0]
+        if start <= addr < start + store.nbytes:
+            return Reference(store.filename,addr-start,arr.shape,arr.dtype.str,arr.strides)
+    return None
+
+def resolve(ref):
+    if ref.filename not in _mapped:
+        _mapped[ref.filename] = np.memmap(ref.filename,dtype=np.uint8,mode='r+')
+    return np.ndarray(ref.shape,dtype=ref.dtype,buffer=_mapped[ref.filename],
+            offset=ref.offset,strides=ref.strides)
+
@@ -302,6 +302,13 @@ def ndarrayhash(v):
     return hashlib.sha1(v).hexdigest()
 
 
+def sum_padded(arrays):
+    'sums arrays of different lengths (along the first axis), as if they were padded with zeros'
+    out = np.zeros((max(a.shape[0] for a in arrays),)+arrays[0].shape[1:])
+    for a in arrays:
+        out[:a.shape[0]] += a
+    return out
+
 def flatiter(l):
     if isinstance(l,list):
         for x in l:
@@ -316,3 +323,21 @@ def treemap(f,l):
     else:
         return f(l)
 
+
+# NOTE: parameter objects (e.g. observation distributions) carry a version
+# number, which bump_version changes whenever the object's parameters are
+# updated. versions come from one counter, so they never repeat across objects
+# and a cached value can record the versions it was computed from.
+
+_version_counter = count(1)
+
+def version(obj):
+    if getattr(obj,'_version',None) is None:
+        bump_version(obj)
+    return obj._version
+
+def bump_version(obj):
+    obj._version = next(_version_counter)
+
+def versions(objs):
+    return tuple(version(obj) for obj in objs)
@@ -111,16 +111,55 @@ def count_transitions(stateseq, num_states):
         out[i,j] += 1
     return out
 
+### Random streams
+
+# NOTE: a counter-based generator: the i-th uniform of the stream for a key is
+# a hash of (key, i), so a stream doesn't depend on what was drawn before it,
+# on which process or thread draws it, or in what order. the samplers take an
+# rng_key, usually (seed, iteration, sequence index), and draw their uniforms
+# from its stream, so serial and parallel sweeps give the same samples. the
+# hash is the SplitMix64 finalizer.
+
+_golden = np.array([0x9e3779b97f4a7c15],dtype=np.uint64)
+
+def _mix64(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+def _stream_key(rng_key):
+    key = np.zeros(1,dtype=np.uint64)
+    for k in rng_key:
+        key = _mix64(key + _golden + np.array([k & 0xffffffffffffffff],dtype=np.uint64))
+    return key
+
+def uniform_stream(n,rng_key=None,offset=0,dtype=np.double):
+    '''
+    Returns uniforms offset...offset+n-1 of the stream for rng_key, a tuple of
+    nonnegative ints, or n draws from np.random if rng_key is None.
+    '''
+    if rng_key is None:
+        return random(n).astype(dtype)
+    counters = np.arange(offset+1,offset+n+1,dtype=np.uint64)
+    bits = _mix64(_stream_key(rng_key) + _golden * counters)
+    if dtype == np.float32:
+        return ((bits >> np.uint64(40)) * 2.**-24).astype(np.float32)
+    return ((bits >> np.uint64(11)) * 2.**-53).astype(dtype)
+
 ### Sampling functions
 
-def sample_discrete(distn,size=[],dtype=np.int32):
-    'samples from a one-dimensional finite pmf'
+def sample_discrete(distn,size=[],dtype=np.int32,u=None):
+    '''
+    samples from a one-dimensional finite pmf, using the uniforms u (with
+    shape size) if given
+    '''
     distn = np.atleast_1d(distn)
     assert (distn >=0).all() and distn.ndim == 1
+    u = np.array(random(size) if u is None else u)
     if (0 == distn).all():
-        return np.random.randint(distn.shape[0],size=size)
+        return (u * distn.shape[0]).astype(dtype)
     cumvals = np.cumsum(distn)
-    return np.sum(np.array(random(size))[...,na] * cumvals[-1] > cumvals, axis=-1,dtype=dtype)
+    return np.sum(u[...,na] * cumvals[-1] > cumvals, axis=-1,dtype=dtype)
 
 def sample_discrete_from_log(p_log,axis=0,dtype=np.int32):
     'samples log probability array along specified axis'
@@ -132,11 +171,12 @@ def sample_discrete_from_log(p_log,axis=0,dtype=np.int32):
                 for i in range(p_log.ndim)]],thesize)
     return np.sum(randvals > cumvals,axis=axis,dtype=dtype)
 
-def sample_markov(T,trans_matrix,init_state_distn):
+def sample_markov(T,trans_matrix,init_state_distn,rng_key=None):
+    randseq = uniform_stream(T,rng_key)
     out = np.empty(T,dtype=np.int32)
-    out[0] = sample_discrete(init_state_distn)
+    out[0] = sample_discrete(init_state_distn,u=randseq[0])
     for t in range(1,T):
-        out[t] = sample_discrete(trans_matrix[out[t-1]])
+        out[t] = sample_discrete(trans_matrix[out[t-1]],u=randseq[t])
     return out
 
 def sample_niw(mu,lmbda,kappa,nu):